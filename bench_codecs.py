@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Throughput of the compression codecs of dpark.codec
+
+    python bench_codecs.py
+    python bench_codecs.py -c gzip:1 -c gzip:9 -c zstd:3 -c zstd:19 FILE -o result.json
+
+For every codec (NAME or NAME:LEVEL, all available ones by default)
+measures compression and decompression MB/s of the uncompressed data and
+the compression ratio, of independent blocks and of the stream writer,
+on FILE or on generated log-like text. Use it to pick the speed/ratio
+trade-off of a dataset before choosing `codec=` of the saveAs* methods.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import io
+import sys
+import json
+import time
+import random
+import argparse
+
+from dpark.codec import get_codec, available_codecs
+
+DEFAULT_SIZE = 64 << 20
+
+
+def make_text(size, seed=0):
+    "log-like lines, compressible as real data rather than random bytes"
+    rd = random.Random(seed)
+    words = ['GET', 'POST', '/api/v1/items', '/static/app.js', 'user', 'session',
+             'ok', 'error', 'timeout', 'retry', 'cache', 'hit', 'miss']
+    lines, n = [], 0
+    while n < size:
+        line = '%d\t%s\t%s\t%d\t%s\n' % (
+            1500000000 + rd.randint(0, 10 ** 7), rd.choice(words), rd.choice(words),
+            rd.randint(0, 10 ** 6), ' '.join(rd.choice(words) for _ in range(rd.randint(1, 12))))
+        lines.append(line)
+        n += len(line)
+    return ''.join(lines).encode('utf-8')
+
+
+def parse_codec(spec):
+    name, _, level = spec.partition(':')
+    return get_codec(name, level=int(level) if level else None)
+
+
+def best(func, repeat):
+    "(result, fastest seconds) of repeat calls"
+    seconds = None
+    for _ in range(repeat):
+        t = time.time()
+        r = func()
+        t = time.time() - t
+        if seconds is None or t < seconds:
+            seconds = t
+    return r, seconds
+
+
+def mb_per_sec(nbytes, seconds):
+    return nbytes / seconds / (1 << 20) if seconds else None
+
+
+def bench_codec(codec, data, repeat=3):
+    """ block and stream throughput of codec on data, MB/s are of the
+        uncompressed size """
+    bs = codec.block_size
+    blocks = [data[i:i + bs] for i in range(0, len(data), bs)]
+    compressed, ct = best(lambda: [codec.compress(b) for b in blocks], repeat)
+    _, dt = best(lambda: [codec.decompress(b) for b in compressed], repeat)
+    csize = sum(len(c) for c in compressed)
+    result = {
+        'codec': codec.name,
+        'level': codec.level,
+        'block_size': bs,
+        'splittable': codec.splittable,
+        'bytes': len(data),
+        'block_ratio': float(len(data)) / csize,
+        'block_compress_mb_per_sec': mb_per_sec(len(data), ct),
+        'block_decompress_mb_per_sec': mb_per_sec(len(data), dt),
+    }
+    if codec.ext:
+        lines = data.splitlines(True)
+
+        def write():
+            out = io.BytesIO()
+            with codec.writer(out) as w:
+                for line in lines:
+                    w.write(line)
+            return out.getvalue()
+
+        stream, st = best(write, repeat)
+        result.update({
+            'stream_ratio': float(len(data)) / len(stream),
+            'stream_write_mb_per_sec': mb_per_sec(len(data), st),
+        })
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='throughput of dpark codecs')
+    parser.add_argument('path', nargs='?', metavar='FILE', help='sample data, default generated text')
+    parser.add_argument('-c', '--codec', action='append', metavar='NAME[:LEVEL]',
+                        help='codec to measure, default all available ones')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE,
+                        help='bytes of sample data, default %d' % DEFAULT_SIZE)
+    parser.add_argument('--repeat', type=int, default=3, help='keep the fastest of REPEAT runs')
+    parser.add_argument('-o', '--output', help='JSON output file, default stdout')
+    args = parser.parse_args(argv)
+
+    if args.path:
+        with open(args.path, 'rb') as f:
+            data = f.read(args.size)
+    else:
+        data = make_text(args.size)
+
+    results = []
+    for spec in args.codec or available_codecs():
+        r = bench_codec(parse_codec(spec), data, args.repeat)
+        print('%-8s level=%-4s ratio %6.2f  compress %8.1f MB/s  decompress %8.1f MB/s' % (
+            r['codec'], r['level'], r['block_ratio'], r['block_compress_mb_per_sec'],
+            r['block_decompress_mb_per_sec']), file=sys.stderr)
+        results.append(r)
+
+    report = {'python': sys.version.split()[0], 'bytes': len(data), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Import time of dpark modules
+
+    python bench_import.py
+    python bench_import.py -m dpark.rdd -m dpark.util --repeat 5 -o result.json
+
+Runs `python -X importtime -c "import MODULE"` in fresh interpreters and
+reports the best cumulative import time of MODULE together with the
+modules costing the most self time, so that executors, which import
+dpark.rdd in every task process, do not silently get slower to start.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+DEFAULT_MODULES = ['dpark.util', 'dpark.rdd']
+
+# modules that should only be imported on first use
+LAZY_MODULES = ['csv', 'gzip', 'bz2', 'mmap', 'socket', 'uuid', 'pyximport', 'msgpack',
+                'snappy', 'dpark.lz4wrapper', 'dpark.beansdb', 'dpark.shuffle',
+                'dpark.tfrecord', 'dpark.gzindex', 'dpark.zstdfile', 'dpark.codec',
+                'dpark.checkpoint', 'dpark.lineage', 'dpark.buffers',
+                'dpark.tablefooter']
+
+
+def run_importtime(module, python=sys.executable):
+    """ {module name: (self us, cumulative us)} of one `import module` """
+    env = dict(os.environ)
+    env.pop('PYTHONSTARTUP', None)
+    p = subprocess.Popen([python, '-X', 'importtime', '-c', 'import %s' % module],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    _, err = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError('import %s failed: %s' % (module, err.decode('utf-8', 'replace')))
+    times = {}
+    for line in err.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue  # the header line
+        times[fields[2].strip()] = (self_us, cumulative_us)
+    return times
+
+
+def import_time(module, repeat=3, python=sys.executable):
+    """ best cumulative import time of module in seconds, and the
+        timings of that run """
+    best = None
+    for _ in range(repeat):
+        times = run_importtime(module, python)
+        t = times[module][1] / 1e6
+        if best is None or t < best[0]:
+            best = (t, times)
+    return best
+
+
+def loaded_modules(module, python=sys.executable):
+    """ names in sys.modules after `import module` """
+    out = subprocess.check_output(
+        [python, '-c', 'import sys, %s; print("\\n".join(sorted(sys.modules)))' % module])
+    return out.decode('utf-8').split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='import time of dpark modules')
+    parser.add_argument('-m', '--module', action='append',
+                        help='module to import, default %s' % ' '.join(DEFAULT_MODULES))
+    parser.add_argument('--repeat', type=int, default=5, help='keep the fastest of REPEAT runs')
+    parser.add_argument('--top', type=int, default=15, help='modules with the most self time')
+    parser.add_argument('-o', '--output', help='JSON output file, default stdout')
+    args = parser.parse_args(argv)
+
+    results = []
+    for module in args.module or DEFAULT_MODULES:
+        t, times = import_time(module, args.repeat)
+        top = sorted(times.items(), key=lambda kv: -kv[1][0])[:args.top]
+        eager = [m for m in LAZY_MODULES if m in times]
+        print('%-20s %8.1f ms  eager: %s' % (module, t * 1e3, ' '.join(eager) or '-'),
+              file=sys.stderr)
+        for name, (self_us, cumulative_us) in top:
+            print('    %-40s %8.1f ms' % (name, self_us / 1e3), file=sys.stderr)
+        results.append({
+            'module': module,
+            'seconds': t,
+            'eager_lazy_modules': eager,
+            'top_self_us': [[name, s] for name, (s, _) in top],
+        })
+
+    report = {'python': sys.version.split()[0], 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Throughput of iterators deeper than the recursion limit
+
+    python bench_lineage.py
+    python bench_lineage.py --depth 5000 --items 200000 --rdd -o result.json
+    python bench_lineage.py --depth 1000 --recursion-limit 200
+
+Iterates a chain of DEPTH generators, each calling the next one through
+dpark.util.recurion_limit_breaker, the way RDD.iterator recurses along a
+long lineage. The chain is deeper than the recursion limit, so parts of
+it run on breaker threads. Reports items/s of the current breaker, of
+the former one which handed over single items under a Condition, and
+of a plain chain run with a raised recursion limit. With --rdd it also
+collects a local RDD with DEPTH maps, as test_long_lineage does.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys
+import json
+import time
+import threading
+import argparse
+
+from six.moves import range
+
+from dpark.util import recurion_limit_breaker, spawn, MIN_REMAIN_RECURSION_LIMIT
+
+
+def condition_breaker(f):
+    "the former breaker, one item per hand-over, as a baseline"
+    def _(*a, **kw):
+        try:
+            sys._getframe(sys.getrecursionlimit() - MIN_REMAIN_RECURSION_LIMIT)
+        except ValueError:
+            return f(*a, **kw)
+
+        def __():
+            result = []
+            finished = []
+            cond = threading.Condition(threading.Lock())
+
+            def _run():
+                it = iter(f(*a, **kw))
+                with cond:
+                    while True:
+                        while result:
+                            cond.wait()
+                        try:
+                            result.append(next(it))
+                            cond.notify()
+                        except StopIteration:
+                            break
+                    finished.append(1)
+                    cond.notify()
+
+            t = spawn(_run)
+            with cond:
+                while True:
+                    while not finished and not result:
+                        cond.wait()
+                    if result:
+                        yield result.pop()
+                        cond.notify()
+                    if finished:
+                        break
+            t.join()
+
+        return __()
+
+    return _
+
+
+def deep_chain(breaker, depth, items):
+    "items 0..items-1, each plus depth, through depth generators"
+    @breaker
+    def layer(d):
+        if d == 0:
+            return iter(range(items))
+        return (x + 1 for x in layer(d - 1))
+    return layer(depth)
+
+
+def run_with_stack(func, recursion_limit, stack_size=512 << 20):
+    "func() on a thread with a big stack and a raised recursion limit"
+    result = []
+    old_limit = sys.getrecursionlimit()
+    old_size = threading.stack_size(stack_size)
+    sys.setrecursionlimit(recursion_limit)
+    try:
+        t = threading.Thread(target=lambda: result.append(func()))
+        t.start()
+        t.join()
+    finally:
+        sys.setrecursionlimit(old_limit)
+        threading.stack_size(old_size)
+    return result[0]
+
+
+def bench(name, func, items, repeat):
+    "best items/s of repeat runs of func, which iterates the chain"
+    seconds = None
+    for _ in range(repeat):
+        t = time.time()
+        func()
+        t = time.time() - t
+        if seconds is None or t < seconds:
+            seconds = t
+    r = {'name': name, 'seconds': seconds, 'items_per_sec': items / seconds}
+    print('%-12s %10.3f s %12.0f items/s' % (name, seconds, r['items_per_sec']), file=sys.stderr)
+    return r
+
+
+def bench_rdd(depth, items, repeat):
+    from dpark import DparkContext
+    ctx = DparkContext('local')
+
+    def collect():
+        rdd = ctx.makeRDD(list(range(items)), 4)
+        for _ in range(depth):
+            rdd = rdd.map(lambda x: x + 1)
+        return rdd.collect()
+
+    return bench('rdd', collect, items, repeat)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='throughput of deep lineage iteration')
+    parser.add_argument('--depth', type=int, default=3000, help='generators in the chain')
+    parser.add_argument('--items', type=int, default=100000, help='items to iterate')
+    parser.add_argument('--repeat', type=int, default=3, help='keep the fastest of REPEAT runs')
+    parser.add_argument('--recursion-limit', type=int,
+                        help='lower it to cross more breakers, default %d' % sys.getrecursionlimit())
+    parser.add_argument('--skip-baseline', action='store_true',
+                        help='do not run the former breaker, which is slow')
+    parser.add_argument('--rdd', action='store_true', help='also collect a local RDD of DEPTH maps')
+    parser.add_argument('-o', '--output', help='JSON output file, default stdout')
+    args = parser.parse_args(argv)
+
+    depth, items = args.depth, args.items
+    if args.recursion_limit:
+        sys.setrecursionlimit(args.recursion_limit)
+    expected = sum(range(items)) + depth * items
+    results = []
+
+    def check(breaker):
+        def _():
+            assert sum(deep_chain(breaker, depth, items)) == expected
+        return _
+
+    results.append(bench('breaker', check(recurion_limit_breaker), items, args.repeat))
+    if not args.skip_baseline:
+        results.append(bench('condition', check(condition_breaker), items, args.repeat))
+    plain = check(lambda f: f)
+    results.append(bench('plain', lambda: run_with_stack(plain, depth * 3 + 1000),
+                         items, args.repeat))
+    if args.rdd:
+        results.append(bench_rdd(depth, items, args.repeat))
+
+    report = {'python': sys.version.split()[0], 'depth': depth, 'items': items,
+              'recursion_limit': sys.getrecursionlimit(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
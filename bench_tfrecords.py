@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""TFRecord I/O benchmarks
+
+    python bench_tfrecords.py -o result.json
+    python bench_tfrecords.py --sizes 32,1024 --total-mb 16 --split-sizes 1,16
+
+Measures records/s, MB/s and CPU seconds per GB of payload for simpleio,
+TfrecordsRDD (plain and .gz, several splitSize) and OutputTfrecordstFileRDD
+(compress on and off), and for tf_record_iterator / TFRecordWriter when
+TensorFlow is installed. Results are written as JSON, so runs of different
+releases can be compared.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+from contextlib import contextmanager
+
+DEFAULT_SIZES = [32, 1 << 10, 32 << 10, 1 << 20, 8 << 20]
+DEFAULT_SPLIT_SIZES = [1, 16, 64]   # MB
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+@contextmanager
+def measure(result, records, nbytes):
+    wall, cpu = time.time(), cpu_time()
+    yield
+    wall, cpu = time.time() - wall, cpu_time() - cpu
+    result.update({
+        'records': records,
+        'bytes': nbytes,
+        'seconds': wall,
+        'records_per_sec': records / wall if wall else None,
+        'mb_per_sec': nbytes / wall / (1 << 20) if wall else None,
+        'cpu_sec_per_gb': cpu / (nbytes / float(1 << 30)) if nbytes else None,
+    })
+
+
+WORDS = ['user', 'item', 'click', 'view', 'label', 'score', 'feature', 'id',
+         'true', 'false', 'null', 'image', 'text', 'en', 'zh', '0', '1', '42']
+
+
+def make_records(size, total, seed=0):
+    """ distinct records of size chars, words and numbers picked by a
+        seeded random, so codecs see data as compressible as real records
+        and every run gets the same ones """
+    rd = random.Random(seed)
+    n = max(total // size, 1)
+    records = []
+    for i in range(n):
+        parts, m = [str(i)], len(str(i))
+        while m < size:
+            w = WORDS[int(rd.random() * len(WORDS))] if rd.random() < 0.7 \
+                else str(rd.randint(0, 10 ** 6))
+            parts.append(w)
+            m += len(w) + 1
+        records.append(' '.join(parts)[:size])
+    return records
+
+
+class Bench(object):
+
+    def __init__(self, workdir, repeat):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.results = []
+        self._ctx = None
+
+    @property
+    def ctx(self):
+        if self._ctx is None:
+            from dpark import DparkContext
+            self._ctx = DparkContext('local')
+            self._ctx.init()
+        return self._ctx
+
+    def run(self, name, size, fn, **params):
+        best = None
+        for _ in range(self.repeat):
+            result = dict(name=name, record_size=size, **params)
+            fn(result)
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        self.results.append(best)
+        print('%-32s %8d B %-18s %10.0f rec/s %8.1f MB/s %6.2f cpu-s/GB' % (
+            name, size, ' '.join('%s=%s' % kv for kv in sorted(params.items())),
+            best['records_per_sec'] or 0, best['mb_per_sec'] or 0,
+            best['cpu_sec_per_gb'] or 0), file=sys.stderr)
+
+    def path(self, *names):
+        return os.path.join(self.workdir, *names)
+
+    # dpark
+
+    def dpark_write(self, records, compress):
+        path = self.path('dpark_%s' % ('gz' if compress else 'plain'))
+        nbytes = sum(len(r) for r in records)
+        rdd = self.ctx.makeRDD(records, 1)
+
+        def _(result):
+            with measure(result, len(records), nbytes):
+                files = rdd.saveAsTFRecordsFile(path, compress=compress)
+            result['file_size'] = sum(os.path.getsize(f) for f in files)
+        return _
+
+    def dpark_read(self, path, split_size, nrecords, nbytes):
+        from dpark.rdd import TfrecordsRDD
+
+        def _(result):
+            with measure(result, nrecords, nbytes):
+                rdd = TfrecordsRDD(self.ctx, path, splitSize=split_size << 20)
+                n = rdd.map(len).reduce(lambda x, y: x + y)
+            assert n == nbytes, (n, nbytes)
+        return _
+
+    # simpleio
+
+    def simpleio_write(self, records, path):
+        from dpark.simpleio import TFRecordWriter
+        data = [r.encode() for r in records]
+        nbytes = sum(len(r) for r in data)
+
+        def _(result):
+            with measure(result, len(data), nbytes):
+                with TFRecordWriter(path) as writer:
+                    for d in data:
+                        writer.write(d)
+        return _
+
+    def simpleio_read(self, path, nrecords, nbytes):
+        from dpark.simpleio import TFRecordReader
+
+        def _(result):
+            with measure(result, nrecords, nbytes):
+                with TFRecordReader(path) as reader:
+                    n = sum(len(d) for d in reader)
+            assert n == nbytes, (n, nbytes)
+        return _
+
+    # tensorflow
+
+    def tf_write(self, records, path, tf_io):
+        data = [r.encode() for r in records]
+        nbytes = sum(len(r) for r in data)
+
+        def _(result):
+            with measure(result, len(data), nbytes):
+                writer = tf_io.TFRecordWriter(path)
+                for d in data:
+                    writer.write(d)
+                writer.close()
+        return _
+
+    def tf_read(self, path, nrecords, nbytes, tf_io):
+        def _(result):
+            with measure(result, nrecords, nbytes):
+                n = sum(len(d) for d in tf_io.tf_record_iterator(path))
+            assert n == nbytes, (n, nbytes)
+        return _
+
+    def bench_size(self, size, total, split_sizes, tf_io):
+        records = make_records(size, total)
+        nrecords = len(records)
+        nbytes = sum(len(r) for r in records)
+
+        for compress in (False, True):
+            self.run('OutputTfrecordstFileRDD', size, self.dpark_write(records, compress),
+                     compress=compress)
+
+        for compress in (False, True):
+            ext = '.tfrecords.gz' if compress else '.tfrecords'
+            path = self.path('dpark_%s' % ('gz' if compress else 'plain'), '0000' + ext)
+            for split_size in split_sizes:
+                self.run('TfrecordsRDD', size, self.dpark_read(path, split_size, nrecords, nbytes),
+                         compress=compress, splitSize='%dM' % split_size)
+
+        path = self.path('simpleio.tfrecords')
+        self.run('simpleio.write', size, self.simpleio_write(records, path))
+        self.run('simpleio.read', size, self.simpleio_read(path, nrecords, nbytes))
+
+        if tf_io is not None:
+            path = self.path('tf.tfrecords')
+            self.run('tf.TFRecordWriter', size, self.tf_write(records, path, tf_io))
+            self.run('tf.tf_record_iterator', size, self.tf_read(path, nrecords, nbytes, tf_io))
+
+
+def import_tf():
+    try:
+        from tensorflow.python.lib.io import tf_record
+        return tf_record
+    except ImportError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='TFRecord I/O benchmarks')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='record sizes in bytes, comma separated')
+    parser.add_argument('--split-sizes', default=','.join(map(str, DEFAULT_SPLIT_SIZES)),
+                        help='TfrecordsRDD splitSize in MB, comma separated')
+    parser.add_argument('--total-mb', type=int, default=64,
+                        help='payload MB per record size')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='keep the fastest of REPEAT runs')
+    parser.add_argument('--no-tf', action='store_true', help='skip TensorFlow even if installed')
+    parser.add_argument('-o', '--output', help='JSON output file, default stdout')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    split_sizes = [int(s) for s in args.split_sizes.split(',')]
+    tf_io = None if args.no_tf else import_tf()
+
+    workdir = tempfile.mkdtemp(prefix='bench_tfrecords_')
+    bench = Bench(workdir, args.repeat)
+    try:
+        for size in sizes:
+            bench.bench_size(size, args.total_mb << 20, split_sizes, tf_io)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'tensorflow': tf_io is not None,
+        'total_mb': args.total_mb,
+        'results': bench.results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# Out-of-band buffers of pickled data
+#
+# With pickle protocol 5 (Python 3.8+) NumPy arrays, bytearrays and
+# PickleBuffers are pickled as a small header plus their raw memory,
+# which travels next to it instead of being copied into the pickle, and
+# loads() builds the arrays as views of the buffers it is given.
+#
+# SharedBuffers puts the buffers into a shared memory segment, so
+# processes on the same host (local and process masters) load the data
+# from it without a copy per task. attach() maps the segment copy on
+# write: arrays are writable, and pages written to become private to
+# the task. Segments are unlinked when the SharedBuffers object is
+# collected or at exit.
+from __future__ import absolute_import
+import os
+import sys
+import mmap
+import hashlib
+import weakref
+
+import six.moves.cPickle
+
+try:
+    from pickle import PickleBuffer
+except ImportError:
+    PickleBuffer = None
+
+OOB = PickleBuffer is not None
+SHM_DIR = '/dev/shm'
+_attached = {}  # segment name -> SharedMemory, mapped once per process
+_in_use = []    # unlinked segments still mapped by arrays
+
+
+def is_buffer(data):
+    "bytes like objects and NumPy arrays, sliced into views by ParallelCollection"
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return True
+    return hasattr(data, '__array_interface__') and getattr(data, 'ndim', 0) > 0
+
+
+def dumps(obj):
+    """ (pickle, [out-of-band buffers]) of obj, the buffers are
+        contiguous byte memoryviews; a memoryview is pickled as a buffer """
+    if not OOB:
+        if isinstance(obj, memoryview):
+            obj = obj.tobytes()
+        return six.moves.cPickle.dumps(obj, -1), []
+    if isinstance(obj, memoryview):
+        obj = PickleBuffer(obj)
+    buffers = []
+    data = six.moves.cPickle.dumps(obj, 5, buffer_callback=buffers.append)
+    return data, [b.raw() for b in buffers]
+
+
+def loads(data, buffers=()):
+    if not buffers:
+        return six.moves.cPickle.loads(data)
+    return six.moves.cPickle.loads(data, buffers=buffers)
+
+
+def digest(buffers):
+    "sha1 of the buffers, without copying them"
+    h = hashlib.sha1()
+    for b in buffers:
+        h.update(b)
+    return h.hexdigest()
+
+
+def shared_memory_available():
+    if not OOB:
+        return False
+    try:
+        from multiprocessing import shared_memory  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class SharedBuffers(object):
+    """ Owner of shared memory segments holding buffers
+
+        add(buffers) copies them to a new segment and returns its
+        (name, [(offset, size)]), which attach() maps back to
+        memoryviews in any process on the host.
+    """
+
+    def __init__(self):
+        self.segments = []
+        weakref.finalize(self, _unlink, self.segments)
+
+    def add(self, buffers):
+        from multiprocessing import shared_memory
+        size = sum(b.nbytes for b in buffers)
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.segments.append(shm)
+        _attached[shm.name] = shm
+        spans = []
+        offset = 0
+        for b in buffers:
+            shm.buf[offset:offset + b.nbytes] = b
+            spans.append((offset, b.nbytes))
+            offset += b.nbytes
+        return shm.name, spans
+
+
+def _unlink(segments):
+    for shm in segments:
+        _attached.pop(shm.name, None)
+        try:
+            shm.unlink()
+        except OSError:
+            pass
+    mapped = _in_use + segments
+    del _in_use[:]
+    for shm in mapped:
+        try:
+            shm.close()
+        except BufferError:
+            _in_use.append(shm)
+
+
+def attach(name, spans):
+    """ writable views of the buffers at spans of the segment name,
+        writes stay private to the caller """
+    try:
+        f = open(os.path.join(SHM_DIR, name.lstrip('/')), 'rb')
+    except (IOError, OSError):
+        # no shared memory files to map, copy the buffers
+        return [bytearray(b) for b in _attach_shared(name, spans)]
+    with f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    buf = memoryview(m)
+    return [buf[offset:offset + size] for offset, size in spans]
+
+
+def _attach_shared(name, spans):
+    "read-only views of the buffers at spans of the segment name"
+    shm = _attached.get(name)
+    if shm is None:
+        from multiprocessing import shared_memory
+        if sys.version_info >= (3, 13):
+            # the owner unlinks it, not the tracker of this process
+            shm = shared_memory.SharedMemory(name, track=False)
+        else:
+            # forked workers share the tracker of the owner
+            shm = shared_memory.SharedMemory(name)
+        _attached[name] = shm
+    buf = shm.buf.toreadonly()
+    return [buf[offset:offset + size] for offset, size in spans]
@@ -0,0 +1,75 @@
+# Checkpoint files
+#
+# A checkpoint of a partition is a stream of TFRecord frames: the first
+# holds MAGIC and the name of the codec, every following one a chunk of
+# items pickled at once and compressed by that codec
+#
+#   frame(MAGIC + b':' + codec name), frame(codec.compress(dumps([item, ...]))), ...
+#
+# so neither writing nor reading a checkpoint keeps more than a chunk of
+# the partition in memory. Files written before this format are a single
+# pickle of the list of items, they are still read.
+from __future__ import absolute_import
+import six.moves.cPickle
+
+from dpark.util import _compress_codec
+from dpark.codec import get_codec
+from dpark.tfrecord import encode_frame, iter_frames, parse_header, HEADER_SIZE
+
+MAGIC = b'DPCKPT1'
+CHUNK_SIZE = 1 << 20    # pickled bytes per chunk
+MAX_CHUNK_ITEMS = 1 << 16
+
+
+class CheckpointWriter(object):
+    """ Writes items to the checkpoint file f in chunks of about
+        CHUNK_SIZE pickled bytes, the number of items per chunk follows
+        the size of the items written so far. The first chunk holds a
+        single item, so big items are never held many at a time. codec
+        is that of util.compress if None. """
+
+    def __init__(self, f, codec=None, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.codec = get_codec(codec if codec is not None else _compress_codec())
+        self.chunk_size = chunk_size
+        self.batch = 1
+        self.items = []
+        f.write(encode_frame(MAGIC + b':' + self.codec.name.encode('ascii')))
+
+    def write(self, item):
+        self.items.append(item)
+        if len(self.items) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.items:
+            return
+        d = six.moves.cPickle.dumps(self.items, -1)
+        self.f.write(encode_frame(self.codec.compress(d)))
+        n = len(self.items)
+        self.batch = max(min(n * self.chunk_size // max(len(d), 1), n * 2, MAX_CHUNK_ITEMS), 1)
+        self.items = []
+
+    def close(self):
+        self.flush()
+
+
+def read_checkpoint(f):
+    """ the items of the checkpoint file f, chunk by chunk """
+    head = f.read(HEADER_SIZE)
+    length = parse_header(head) if len(head) == HEADER_SIZE else None
+    if length is None or length > 64:
+        for item in six.moves.cPickle.loads(head + f.read()):
+            yield item
+        return
+
+    f.seek(0)
+    frames = iter_frames(f, read_size=CHUNK_SIZE)
+    _, header = next(frames)
+    magic, _, name = header.partition(b':')
+    if magic != MAGIC:
+        raise ValueError('Not a checkpoint file: %r' % header)
+    codec = get_codec(name.decode('ascii'))
+    for _, data in frames:
+        for item in six.moves.cPickle.loads(codec.decompress(data)):
+            yield item
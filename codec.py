@@ -0,0 +1,396 @@
+# Compression codecs of output files and the readers of them
+#
+#   rdd.saveAsTextFile(path, codec='zstd')
+#   rdd.saveAsTableFile(path, codec=get_codec('zlib', level=6))
+#   get_codec('gzip').text_rdd(ctx, path)
+#
+# A codec compresses data in independent blocks of block_size bytes,
+# blocks end where a write() ends, so they hold whole lines or records.
+# Codecs with a stream format (ext) write files which the matching
+# reader splits at block boundaries; every codec with a table_flag can
+# compress the blocks of table files. Libraries are only imported when
+# a codec is used.
+#
+# Writers can compress blocks on `threads` threads (zlib, bz2 and zstd
+# all release the GIL) while the task thread encodes the next rows,
+# blocks are still written in order. A task is scheduled with one cpu
+# by default, so codecs use DEFAULT_THREADS unless threads is given;
+# the output RDDs use the cpus of the task.
+from __future__ import absolute_import
+import time
+import zlib
+import struct
+import collections
+from copy import copy
+
+DEFAULT_CODEC = 'gzip'
+DEFAULT_THREADS = 1
+
+CODECS = {}
+
+
+def register(cls):
+    "class decorator, adds a Codec class to the registry"
+    CODECS[cls.name] = cls
+    return cls
+
+
+def get_codec(codec, **options):
+    """ the Codec of codec, which is a registered name, a Codec, or
+        None/False for no compression; True means DEFAULT_CODEC.
+        options are level, block_size and threads """
+    if codec is None or codec is False:
+        return None
+    if isinstance(codec, Codec):
+        return codec.with_options(**options) if options else codec
+    if codec is True:
+        codec = DEFAULT_CODEC
+    cls = CODECS.get(codec)
+    if cls is None:
+        raise ValueError('unknown codec: %r, choose from %s' % (codec, ', '.join(sorted(CODECS))))
+    return cls(**options)
+
+
+def codec_of_path(path):
+    "the codec of a file by its extension, None if it is not compressed"
+    for cls in CODECS.values():
+        if cls.ext and path.endswith(cls.ext):
+            return cls()
+
+
+def codec_of_table_flag(flag):
+    for cls in CODECS.values():
+        if cls.table_flag == flag:
+            return cls()
+    raise ValueError('unknown compressed flag of table block: %d' % flag)
+
+
+def available_codecs():
+    "names of the codecs whose libraries can be imported"
+    return sorted(name for name, cls in CODECS.items() if cls().available())
+
+
+class Codec(object):
+    """ A compression codec
+
+        name: key in the registry
+        level: compression level, the default of the codec if None
+        block_size: uncompressed bytes per independent block, readers of
+            a stream can only start at block boundaries
+        threads: compressing blocks of the stream writer, None for
+            DEFAULT_THREADS or the cpus of the writing task
+        ext: file extension of the stream format, '' if there is none
+        splittable: one stream can be read by many splits
+        table_flag: compressed flag of the table file blocks, None if the
+            codec can not compress them
+        tfrecords: TfrecordsRDD can read the stream of TFRecords
+    """
+    name = None
+    ext = ''
+    splittable = False
+    table_flag = None
+    tfrecords = False
+    default_level = None
+    default_block_size = 256 << 10
+
+    def __init__(self, level=None, block_size=None, threads=None):
+        self.level = self.default_level if level is None else level
+        self.block_size = block_size or self.default_block_size
+        self.threads = threads
+
+    def __repr__(self):
+        return '<Codec %s level=%s block_size=%d threads=%s>' % (
+            self.name, self.level, self.block_size, self.threads)
+
+    def with_options(self, level=None, block_size=None, threads=None):
+        c = copy(self)
+        if level is not None:
+            c.level = level
+        if block_size:
+            c.block_size = block_size
+        if threads is not None:
+            c.threads = threads
+        return c
+
+    def available(self):
+        try:
+            self.decompress(self.compress(b'dpark'))
+        except ImportError:
+            return False
+        return True
+
+    def compress(self, data):
+        "one independent block"
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+    def writer(self, f):
+        """ file-like writer of the stream format on top of f, close()
+            ends the stream but keeps f open """
+        raise ValueError('codec %s has no file format' % self.name)
+
+    def text_rdd(self, ctx, path, splitSize=None, raw=False):
+        "the RDD of the lines of a stream written by writer()"
+        raise ValueError('codec %s has no file format' % self.name)
+
+    def tfrecords_rdd(self, ctx, path, splitSize=None, raw=False):
+        if not self.tfrecords:
+            raise ValueError('TFRecords can not be read from %s files' % self.name)
+        from dpark.rdd import TfrecordsRDD
+        return TfrecordsRDD(ctx, path, splitSize=splitSize, raw=raw)
+
+
+class BlockWriter(object):
+    """ Buffers writes and compresses a block after the write() which
+        fills block_size, text is written as utf-8.
+
+        compress_block(data) runs on a pool of threads when threads > 1,
+        with at most 2 * threads blocks in flight; emit(data, out) writes
+        the compressed blocks in order on the calling thread.
+    """
+
+    def __init__(self, f, block_size, threads=1):
+        self.f = f
+        self.block_size = block_size
+        self.threads = threads
+        self.closed = False
+        self._buf = []
+        self._buffered = 0
+        self._pool = None
+        self._pending = collections.deque()
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self._buf.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self.end_block()
+
+    def end_block(self, last=False):
+        if not self._buf:
+            return
+        data = b''.join(self._buf)
+        self._buf = []
+        self._buffered = 0
+        if self.threads <= 1 or last and self._pool is None:
+            self.emit(data, self.compress_block(data))
+            return
+
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(self.threads)
+        self._pending.append((data, self._pool.apply_async(self.compress_block, (data,))))
+        if len(self._pending) >= self.threads * 2:
+            self._emit_next()
+
+    def _emit_next(self):
+        data, r = self._pending.popleft()
+        self.emit(data, r.get())
+
+    def compress_block(self, data):
+        raise NotImplementedError
+
+    def emit(self, data, out):
+        self.f.write(out)
+
+    def finish(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.end_block(last=True)
+            while self._pending:
+                self._emit_next()
+            self.finish()
+        finally:
+            self.abort()
+
+    def abort(self):
+        "drop the data not written yet, the stream is left unfinished"
+        self.closed = True
+        self._buf = []
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.abort()    # keep the error, do not write a partial block
+
+
+class GzipWriter(BlockWriter):
+    """ One gzip member, every block is sync flushed by a new compressor,
+        so it starts an access point. points are the gzindex access
+        points, windows only hold the last byte before them. """
+
+    def __init__(self, f, level, block_size, threads=1):
+        BlockWriter.__init__(self, f, block_size, threads)
+        self.level = level
+        xfl = 2 if level == 9 else 4 if level == 1 else 0
+        header = b'\x1f\x8b\x08\x00' + struct.pack('<IBB', int(time.time()), xfl, 255)
+        f.write(header)
+        self.offset = len(header)
+        self.size = 0
+        self.crc = 0
+        self.last = b''
+        self.points = [(0, 0, 0, b'', True)]
+
+    def _compressobj(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                zlib.DEF_MEM_LEVEL, 0)
+
+    def compress_block(self, data):
+        c = self._compressobj()
+        return c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+
+    def emit(self, data, out):
+        if self.size:
+            self.points.append((self.offset, self.size, 0, self.last, False))
+        self.f.write(out)
+        self.offset += len(out)
+        self.size += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.last = data[-1:]
+
+    def finish(self):
+        self.f.write(self._compressobj().flush())
+        self.f.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+
+
+class Bz2Writer(BlockWriter):
+    "every block is a bzip2 stream, as written by pbzip2"
+
+    def __init__(self, f, level, block_size, threads=1):
+        BlockWriter.__init__(self, f, block_size, threads)
+        self.level = level
+
+    def compress_block(self, data):
+        import bz2
+        return bz2.compress(data, self.level)
+
+
+@register
+class GzipCodec(Codec):
+    name = 'gzip'
+    ext = '.gz'
+    splittable = True
+    tfrecords = True
+    default_level = 9
+
+    def compress(self, data):
+        c = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    def writer(self, f):
+        return GzipWriter(f, self.level, self.block_size, self.threads or DEFAULT_THREADS)
+
+    def text_rdd(self, ctx, path, splitSize=None, raw=False):
+        from dpark.rdd import GZipFileRDD
+        return GZipFileRDD(ctx, path, splitSize, raw)
+
+
+@register
+class ZlibCodec(Codec):
+    name = 'zlib'
+    table_flag = 1
+    default_level = 1
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+@register
+class ZstdCodec(Codec):
+    name = 'zstd'
+    ext = '.zst'
+    splittable = True
+    table_flag = 2
+    tfrecords = True
+    default_level = 3
+    default_block_size = 1 << 20
+
+    def compress(self, data):
+        import zstandard
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    def writer(self, f):
+        from dpark.zstdfile import ZstdWriter
+        return ZstdWriter(f, self.level, self.block_size, self.threads or DEFAULT_THREADS)
+
+    def text_rdd(self, ctx, path, splitSize=None, raw=False):
+        from dpark.rdd import ZstdFileRDD
+        return ZstdFileRDD(ctx, path, splitSize, raw)
+
+
+@register
+class Bz2Codec(Codec):
+    name = 'bz2'
+    ext = '.bz2'
+    splittable = True
+    table_flag = 5
+    default_level = 9
+    default_block_size = 900 << 10
+
+    def compress(self, data):
+        import bz2
+        return bz2.compress(data, self.level)
+
+    def decompress(self, data):
+        import bz2
+        return bz2.decompress(data)
+
+    def writer(self, f):
+        return Bz2Writer(f, self.level, self.block_size, self.threads or DEFAULT_THREADS)
+
+    def text_rdd(self, ctx, path, splitSize=None, raw=False):
+        from dpark.rdd import BZip2FileRDD
+        return BZip2FileRDD(ctx, path, None, splitSize, raw)
+
+
+@register
+class Lz4Codec(Codec):
+    name = 'lz4'
+    table_flag = 3
+
+    def compress(self, data):
+        from dpark.lz4wrapper import compress
+        return compress(data)
+
+    def decompress(self, data):
+        from dpark.lz4wrapper import decompress
+        return decompress(data)
+
+
+@register
+class SnappyCodec(Codec):
+    name = 'snappy'
+    table_flag = 4
+
+    def compress(self, data):
+        from snappy import compress
+        return compress(data)
+
+    def decompress(self, data):
+        from snappy import decompress
+        return decompress(data)
@@ -0,0 +1,267 @@
+# Access point index of gzip files
+#
+# An access point is a compressed offset where decompression can start,
+# with the uncompressed offset it maps to and the (up to) 32K of data
+# before it, which the deflate stream may refer back to. It is like the
+# index of zlib's examples/zran.c, but Python's zlib can neither stop at
+# every deflate block (Z_BLOCK) nor feed a partial byte (inflatePrime),
+# so access points are only put where a block starts on a byte boundary:
+# after a sync flush (00 00 ff ff, as written by pigz -i, `gzip --rsyncable`
+# and saveAsTextFile(compress=True)) and at the start of a gzip member.
+# The bit offset is kept in the file format and is always 0.
+#
+# The sidecar index of `path` is `.<name>.gzindex` in the same directory:
+#
+#   MAGIC, uint64 size of the gzip file, uint32 count,
+#   count * (uint64 offset, uint64 uoffset, uint64 window pos, uint32 window len,
+#            uint8 bits, uint8 header, 2 pad)
+#   zlib compressed windows
+#
+# so a task only reads the table and the window of its first point.
+from __future__ import absolute_import
+import os
+import sys
+import zlib
+import bisect
+import struct
+
+from dpark.util import atomic_file, pread, get_logger
+
+logger = get_logger(__name__)
+
+MAGIC = b'DPGZIDX1'
+HEADER = struct.Struct('<8sQI')
+ENTRY = struct.Struct('<QQQIBB2x')
+INDEX_SUFFIX = '.gzindex'
+WINDOW_SIZE = 32 << 10
+DEFAULT_SPAN = 4 << 20      # uncompressed bytes between access points
+READ_SIZE = 1 << 20
+SYNC_MARK = b'\x00\x00\xff\xff'
+
+
+def index_path(path):
+    dirname, name = os.path.split(path)
+    return os.path.join(dirname, '.%s%s' % (name, INDEX_SUFFIX))
+
+
+def _stored_block(window):
+    "a non-final stored deflate block holding window, to prime a raw inflater"
+    return b'\x00' + struct.pack('<HH', len(window), len(window) ^ 0xffff) + window
+
+
+def _inflater(window=None, header=False):
+    if header:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    dz = zlib.decompressobj(-zlib.MAX_WBITS)
+    if window:
+        dz.decompress(_stored_block(window))
+    return dz
+
+
+class _Builder(object):
+
+    def __init__(self, span):
+        self.span = span
+        self.points = []
+        self.window = b''
+        self.uoffset = 0
+        self.last = None
+
+    def output(self, out):
+        if out:
+            self.uoffset += len(out)
+            self.window = (self.window + out)[-WINDOW_SIZE:]
+
+    def due(self):
+        return self.last is None or self.uoffset - self.last >= self.span
+
+    def add(self, offset, header):
+        self.points.append((offset, self.uoffset, 0, self.window, header))
+        self.last = self.uoffset
+
+
+def _check_point(dz, window, ahead):
+    "whether inflating ahead from scratch with window gives what dz gives"
+    if not ahead:
+        return False
+    try:
+        expected = dz.copy().decompress(ahead)
+        got = _inflater(window).decompress(ahead)
+    except zlib.error:
+        return False
+    n = min(len(expected), len(got))
+    return n > 0 and expected[:n] == got[:n]
+
+
+def build_index(f, span=DEFAULT_SPAN):
+    """ (access points, uncompressed size) of the gzip file f,
+        points are about span uncompressed bytes apart """
+    b = _Builder(span)
+    f.seek(0)
+    dz = None
+    buf = b''       # buf[:fed] was fed to dz
+    fed = 0
+    base = 0        # compressed offset of buf[0]
+    while True:
+        if fed >= len(buf):
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            # keep a few fed bytes, a sync mark may cross reads
+            keep = min(len(buf), len(SYNC_MARK) - 1)
+            base += len(buf) - keep
+            buf = buf[len(buf) - keep:] + data
+            fed = keep
+
+        if dz is None:
+            if not buf[fed:].strip(b'\x00'):
+                fed = len(buf)  # zero padding after a member
+                continue
+            b.add(base + fed, True)
+            dz = _inflater(header=True)
+
+        p = buf.find(SYNC_MARK, max(fed - len(SYNC_MARK) + 1, 0))
+        q = p + len(SYNC_MARK) if p >= 0 else len(buf)
+        b.output(dz.decompress(buf[fed:q]))
+        if dz.unused_data:
+            # the member ended, the next one starts right after it
+            fed = q - len(dz.unused_data)
+            dz = None
+            continue
+        fed = q
+        if p >= 0 and b.due() and _check_point(dz, b.window, buf[q:q + WINDOW_SIZE]):
+            b.add(base + q, False)
+
+    if dz is not None:
+        b.output(dz.flush())
+    return b.points, b.uoffset
+
+
+def write_index(path, size, points):
+    """ write the sidecar index of the gzip file path of size bytes """
+    windows = [zlib.compress(p[3]) for p in points]
+    pos = HEADER.size + ENTRY.size * len(points)
+    entries = []
+    for (offset, uoffset, bits, _, header), w in zip(points, windows):
+        entries.append(ENTRY.pack(offset, uoffset, pos, len(w), bits, 1 if header else 0))
+        pos += len(w)
+    with atomic_file(index_path(path)) as f:
+        f.write(HEADER.pack(MAGIC, size, len(points)))
+        f.write(b''.join(entries))
+        f.write(b''.join(windows))
+
+
+class GzipIndex(object):
+    """ The table of a sidecar index, windows are read on demand """
+
+    def __init__(self, f, entries):
+        self.f = f
+        self.entries = entries
+        self.offsets = [e[0] for e in entries]
+
+    @classmethod
+    def load(cls, path, size, open_file=None):
+        """ None if there is no index for path or it is stale """
+        try:
+            f = open_file(index_path(path)) if open_file else open(index_path(path), 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            magic, indexed_size, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or indexed_size != size:
+                if magic == MAGIC:
+                    logger.warning('stale index %s, ignored', index_path(path))
+                f.close()
+                return None
+            d = f.read(ENTRY.size * count)
+            entries = [ENTRY.unpack_from(d, i * ENTRY.size) for i in range(count)]
+        except (struct.error, ValueError):
+            f.close()
+            return None
+        return cls(f, entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        self.f.close()
+
+    def window(self, i):
+        _, _, pos, length, _, _ = self.entries[i]
+        return zlib.decompress(pread(self.f, length, pos))
+
+    def points_in(self, begin, end):
+        """ indices of the access points with offset in [begin, end) """
+        return (bisect.bisect_left(self.offsets, begin),
+                bisect.bisect_left(self.offsets, end))
+
+    def uoffset(self, i):
+        return self.entries[i][1]
+
+
+class IndexedGzipReader(object):
+    """ file-like reader of the uncompressed data of the gzip file f,
+        starting at an access point, through following members """
+
+    def __init__(self, f, offset, window, header, read_size=READ_SIZE):
+        self.f = f
+        self.read_size = read_size
+        f.seek(offset)
+        self._raw = not header
+        self._dz = _inflater(window, header)
+        self._skip = 0          # bytes of a gzip trailer to drop
+        self._buf = b''
+        self._eof = False
+
+    def _fill(self):
+        data = self.f.read(self.read_size)
+        if not data:
+            self._buf += self._dz.flush() if self._dz is not None else b''
+            self._eof = True
+            return
+        while data:
+            if self._dz is None:
+                if self._skip:
+                    n = min(self._skip, len(data))
+                    self._skip -= n
+                    data = data[n:]
+                    continue
+                if not data.strip(b'\x00'):
+                    return
+                self._dz = _inflater(header=True)
+                self._raw = False
+            self._buf += self._dz.decompress(data)
+            data = self._dz.unused_data
+            if data or getattr(self._dz, 'eof', False):
+                if self._raw:
+                    self._skip = 8
+                self._dz = None
+
+    def read(self, size):
+        while len(self._buf) < size and not self._eof:
+            self._fill()
+        d, self._buf = self._buf[:size], self._buf[size:]
+        return d
+
+    def unread(self, d):
+        self._buf = d + self._buf
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='write .gzindex access point sidecars')
+    parser.add_argument('paths', nargs='+', metavar='FILE')
+    parser.add_argument('--span', type=int, default=DEFAULT_SPAN,
+                        help='uncompressed bytes between access points')
+    args = parser.parse_args(argv)
+    for path in args.paths:
+        with open(path, 'rb') as f:
+            points, usize = build_index(f, args.span)
+            f.seek(0, 2)
+            size = f.tell()
+        write_index(path, size, points)
+        print('%d\t%d\t%s' % (len(points), usize, path))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+# Lineage fingerprints
+#
+# fingerprint(rdd) digests what the data of an RDD depends on, so an
+# RDD built the same way by another run (or again in the same one) gets
+# the same fingerprint and can reuse its checkpoint, which
+# RDD.checkpoint(reuse=True) asks for:
+#
+#   - the class and the number of splits of every RDD of the lineage
+#   - their attributes, except the run specific ones (ids, context,
+#     splits, locations, resources), see RDD.LINEAGE_IGNORED
+#   - functions by their code, defaults, closures and the globals they
+#     use, not by their identity
+#   - paths, sizes and mtimes of input files, RDD._lineage_files()
+#   - data of parallelized collections, RDD._lineage_data(), by the
+#     digest of their pickled splits
+#   - broadcast variables by the digest of their pickled value
+#
+# Modules and classes are digested by their names only, not by their
+# code, so a changed library or class does not change the fingerprint.
+# That is why reuse is not the default.
+#
+# Values which can not be digested stably (open files, sockets, objects
+# without state) make the fingerprint None.
+from __future__ import absolute_import
+import io
+import os
+import sys
+import types
+import struct
+import hashlib
+import functools
+
+import six
+import six.moves.cPickle
+
+VERSION = b'1'
+BASIC_TYPES = (type(None), bool, float, complex) + six.integer_types
+
+
+class Unstable(Exception):
+    "the value can not be fingerprinted"
+
+
+class _Digest(object):
+
+    def __init__(self, rdd_class, known):
+        self.rdd_class = rdd_class
+        self.known = known  # id -> fingerprint of the RDDs done
+        self.h = hashlib.sha1(VERSION)
+        self.h.update(('%d.%d' % sys.version_info[:2]).encode('ascii'))
+        self.seen = {}      # id -> order of the objects visited, for cycles
+        self.keep = []      # the visited objects stay alive, ids stay unique
+
+    def tag(self, t, data=b''):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.h.update(struct.pack('<1sQ', t, len(data)))
+        self.h.update(data)
+
+    def add(self, v):
+        if isinstance(v, BASIC_TYPES):
+            self.tag(b'b', '%s:%r' % (type(v).__name__, v))
+            return
+        if isinstance(v, six.text_type):
+            self.tag(b's', v)
+            return
+        if isinstance(v, bytes):
+            self.tag(b'y', v)
+            return
+
+        i = self.seen.get(id(v))
+        if i is not None:
+            self.tag(b'r', str(i))
+            return
+        self.seen[id(v)] = len(self.seen)
+        self.keep.append(v)
+
+        if isinstance(v, (list, tuple)):
+            self.tag(b'l' if isinstance(v, list) else b't', str(len(v)))
+            for x in v:
+                self.add(x)
+        elif isinstance(v, (set, frozenset)):
+            self.tag(b'S', str(len(v)))
+            for d in sorted(self.sub(x) for x in v):
+                self.tag(b'e', d)
+        elif isinstance(v, dict):
+            self.tag(b'd', str(len(v)))
+            for dk, dv in sorted((self.sub(k), self.sub(x)) for k, x in v.items()):
+                self.tag(b'k', dk)
+                self.tag(b'v', dv)
+        elif isinstance(v, self.rdd_class):
+            fp = self.known.get(id(v)) or fingerprint(v)
+            if fp is None:
+                raise Unstable('can not fingerprint %r' % (v,))
+            self.tag(b'R', fp)
+        elif isinstance(v, types.CodeType):
+            self.add_code(v)
+        elif isinstance(v, types.FunctionType):
+            self.add_function(v)
+        elif isinstance(v, functools.partial):
+            self.tag(b'p')
+            self.add(v.func)
+            self.add(v.args)
+            self.add(v.keywords or {})
+        elif isinstance(v, types.MethodType):
+            self.tag(b'm', v.__func__.__name__)
+            self.add(v.__self__)
+            self.add(v.__func__)
+        elif isinstance(v, (types.BuiltinFunctionType, type)) or type(v).__name__ in (
+                'method_descriptor', 'wrapper_descriptor', 'builtin_function_or_method'):
+            self.tag(b'n', _qualname(v))
+        elif isinstance(v, types.ModuleType):
+            self.tag(b'M', v.__name__)
+        elif isinstance(v, io.IOBase):
+            raise Unstable('can not fingerprint %r' % (v,))
+        elif _is_broadcast(v):
+            # by the value, the uuid is new in every run
+            try:
+                self.tag(b'B', hashlib.sha1(six.moves.cPickle.dumps(v.value, -1)).digest())
+            except Exception:
+                raise Unstable('can not fingerprint %r' % (v,))
+        elif hasattr(v, '__dict__') or hasattr(v, '__slots__'):
+            self.tag(b'o', _qualname(type(v)))
+            self.add_state(v)
+        else:
+            try:
+                self.tag(b'P', six.moves.cPickle.dumps(v, 2))
+            except Exception:
+                raise Unstable('can not fingerprint %r' % (v,))
+
+    def sub(self, v):
+        "fingerprint of v, for the entries of unordered containers"
+        d = _Digest(self.rdd_class, self.known)
+        d.seen, d.keep = self.seen, self.keep
+        d.add(v)
+        return d.h.digest()
+
+    def add_state(self, obj, ignored=('shuffleId',)):
+        state = getattr(obj, '__dict__', None)
+        if state is None:
+            state = dict((k, getattr(obj, k)) for k in obj.__slots__ if hasattr(obj, k))
+        self.add(dict((k, v) for k, v in state.items() if k not in ignored))
+
+    def add_rdd(self, rdd):
+        self.tag(b'R', _qualname(type(rdd)))
+        self.add(len(rdd.splits))
+        for path in rdd._lineage_files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                raise Unstable('can not stat %s' % path)
+            self.add((path, st.st_size, st.st_mtime))
+        self.add(rdd._lineage_data())
+        self.add_state(rdd, rdd.LINEAGE_IGNORED)
+        self.add(rdd.dependencies)
+
+    def add_code(self, code):
+        self.tag(b'c', code.co_code)
+        self.add(code.co_consts)
+        self.add(code.co_names)
+        self.add(code.co_varnames)
+        self.add(code.co_freevars)
+
+    def add_function(self, func):
+        self.tag(b'f', _qualname(func))
+        code = func.__code__
+        self.add(code)
+        self.add(func.__defaults__)
+        self.add(getattr(func, '__kwdefaults__', None))
+        cells = []
+        for cell in func.__closure__ or ():
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:  # not assigned yet
+                cells.append(Unassigned)
+        self.add(cells)
+        g = func.__globals__
+        self.add(dict((name, g[name]) for name in _global_names(code) if name in g))
+
+
+class Unassigned(object):
+    pass
+
+
+def _is_broadcast(v):
+    try:
+        from dpark.broadcast import Broadcast
+    except ImportError:
+        return False
+    return isinstance(v, Broadcast)
+
+
+def _qualname(v):
+    return '%s.%s' % (getattr(v, '__module__', None),
+                      getattr(v, '__qualname__', getattr(v, '__name__', '?')))
+
+
+def _global_names(code):
+    "names code and the code objects in it may look up in globals"
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names.update(_global_names(c))
+    return names
+
+
+def _lineage(rdd):
+    """ the RDDs rdd depends on and rdd, parents first; the lineage of
+        a checkpointed RDD ends at it """
+    done = set()
+    stack = [(rdd, False)]
+    while stack:
+        r, expanded = stack.pop()
+        if id(r) in done:
+            continue
+        if expanded or r._lineage:
+            done.add(id(r))
+            yield r
+            continue
+        stack.append((r, True))
+        for dep in r.dependencies:
+            if id(dep.rdd) not in done:
+                stack.append((dep.rdd, False))
+
+
+def fingerprint(rdd):
+    """ hex digest of the lineage of rdd, None if some part of it can
+        not be fingerprinted """
+    from dpark.rdd import RDD
+    known = {}
+    try:
+        for r in _lineage(rdd):
+            if r._lineage:
+                known[id(r)] = r._lineage
+                continue
+            d = _Digest(RDD, known)
+            d.seen[id(r)] = 0
+            d.keep.append(r)
+            d.add_rdd(r)
+            known[id(r)] = d.h.hexdigest()
+    except (Unstable, RuntimeError):  # RecursionError of a deep closure
+        return None
+    return known[id(rdd)]
@@ -3,22 +3,17 @@ from __future__ import print_function
 import sys
 import os, os.path
 import time
-import socket
-import csv
 import itertools
 import collections
 import math
 import six.moves.cPickle
 import random
-import bz2
-import gzip
+import bisect
 import zlib
 from copy import copy
-import shutil
 import heapq
 import struct
 import traceback
-import tempfile
 
 try:
     from cStringIO import StringIO
@@ -35,16 +30,12 @@ from dpark.dependency import *
 from dpark.util import (
     spawn, chain, mkdir_p, recurion_limit_breaker, atomic_file,
     AbortFileReplacement, get_logger, portable_hash, Scope, masked_crc32c,
-    gzip_decompressed_fh, gzip_decompressed_fh_2, gzip_find_block
-)
-from dpark.shuffle import (
-    Merger, CoGroupMerger, SortedShuffleFetcher, SortedMerger, CoGroupSortedMerger,
-    OrderedMerger, OrderedCoGroupMerger,
-    SortedGroupMerger, StreamCoGroupSortedMerger,
+    gzip_decompressed_fh, gzip_decompressed_fh_2, gzip_find_block, pread,
+    IOMetrics, MeteredFile, resolve_hostnames
 )
 from dpark.env import env
+from dpark.accumulator import listAcc
 from dpark.file_manager import open_file, CHUNKSIZE
-from dpark.beansdb import BeansdbReader, BeansdbWriter
 from contextlib import closing
 import six
 from six.moves import filter
@@ -95,6 +86,14 @@ class RDD(object):
 
     nextId = 0
 
+    # attributes which do not change the data, left out of the lineage fingerprint
+    LINEAGE_IGNORED = (
+        'ctx', 'id', '_splits', '_dependencies', '_preferred_locs', 'checkpoint_path',
+        '_checkpoint_rdd', '_lineage', '_pickle_cache', '_split_size', 'repr_name', 'scope',
+        'shouldCache', 'mem', 'cpus', 'gpus', 'metrics_acc', 'shuffleId',
+    )
+    _lineage = None     # fingerprint of a checkpointed RDD
+
     @classmethod
     def newId(cls):
         cls.nextId += 1
@@ -166,11 +165,31 @@ class RDD(object):
                 return locs
         return self._preferred_locs.get(split, [])
 
-    def checkpoint(self, path=None):
+    def checkpoint(self, path=None, reuse=False):
+        """ save the partitions of the RDD under path (checkpoint_dir by
+            default) when it is computed, and read them from there after.
+
+            The directory is named by the id of the RDD. With reuse=True
+            it is named by the lineage fingerprint instead, so another
+            run building the RDD the same way reuses the partitions found
+            in it. Functions are digested by their code, but modules and
+            classes only by name: after the code of a class or library
+            they use changes, stale partitions are still reused, so only
+            pass reuse=True when that code is fixed, and remove the
+            directory when it changes. """
+        from dpark.lineage import fingerprint
         if path is None:
             path = self.ctx.options.checkpoint_dir
         if path:
-            ident = '%d_%x' % (self.id, hash(str(self)))
+            fp = fingerprint(self) if reuse else None
+            if fp is None:
+                if reuse:
+                    logger.info('lineage of %s can not be fingerprinted, '
+                                'its checkpoint will not be reused by other runs', self)
+                ident = '%d_%x' % (self.id, hash(str(self)))
+            else:
+                self._lineage = fp
+                ident = 'lineage_%s' % fp
             path = os.path.join(path, ident)
             mkdir_p(path)
             self.checkpoint_path = path
@@ -179,6 +198,14 @@ class RDD(object):
                            'please re-run with --checkpoint-dir to enable checkpoint')
         return self
 
+    def _lineage_files(self):
+        "input files, their sizes and mtimes are part of the lineage fingerprint"
+        return []
+
+    def _lineage_data(self):
+        "data of the RDD which is not in its attributes"
+        return None
+
     def _clear_dependencies(self):
         self._dependencies = []
         self._splits = []
@@ -207,16 +234,29 @@ class RDD(object):
 
         if self.checkpoint_path:
             if self._checkpoint_rdd is None:
-                p = os.path.join(self.checkpoint_path, str(split.index))
-                v = list(self.compute(split))
-                with atomic_file(p) as f:
-                    f.write(six.moves.cPickle.dumps(v, -1))
-
-                return v
+                return self._write_checkpoint(split)
             else:
                 return _compute(self._checkpoint_rdd, split)
         return _compute(self, split)
 
+    def _write_checkpoint(self, split):
+        "items of split, written to the checkpoint while they pass"
+        from dpark.checkpoint import CheckpointWriter, read_checkpoint
+        p = os.path.join(self.checkpoint_path, str(split.index))
+        if os.path.exists(p):
+            # written by an earlier job or run of the same lineage
+            with open(p, 'rb') as f:
+                for item in read_checkpoint(f):
+                    yield item
+            return
+
+        with atomic_file(p) as f:
+            w = CheckpointWriter(f)
+            for item in self.compute(split):
+                w.write(item)
+                yield item
+            w.close()
+
     def map(self, f):
         return MappedRDD(self, f)
 
@@ -406,23 +446,42 @@ class RDD(object):
         r = self.take(1)
         if r: return r[0]
 
-    def saveAsTextFile(self, path, ext='', overwrite=True, compress=False):
-        return OutputTextFileRDD(self, path, ext, overwrite, compress=compress).collect()
-
-    def saveAsTFRecordsFile(self, path, ext='', overwrite=True, compress=False):
-        return OutputTfrecordstFileRDD(self, path, ext, overwrite, compress=compress).collect()
-
-    def saveAsTextFileByKey(self, path, ext='', overwrite=True, compress=False):
-        return MultiOutputTextFileRDD(self, path, ext, overwrite, compress=compress).collect()
-
-    def saveAsCSVFile(self, path, dialect='excel', overwrite=True, compress=False):
-        return OutputCSVFileRDD(self, path, dialect, overwrite, compress).collect()
-
-    def saveAsBinaryFile(self, path, fmt, overwrite=True):
-        return OutputBinaryFileRDD(self, path, fmt, overwrite).collect()
-
-    def saveAsTableFile(self, path, overwrite=True):
-        return OutputTableFileRDD(self, path, overwrite).collect()
+    def saveAsTextFile(self, path, ext='', overwrite=True, compress=False, index=False,
+                       codec=None):
+        """ codec: name or Codec of dpark.codec, such as 'gzip', 'zstd' or 'bz2';
+                compress=True is codec='gzip'
+            index: with gzip, also write the .gzindex access points
+            for GZipFileRDD """
+        return OutputTextFileRDD(self, path, ext, overwrite, compress=compress,
+                                 index=index, codec=codec).collect()
+
+    def saveAsTFRecordsFile(self, path, ext='', overwrite=True, compress=False, index=False, raw=False,
+                            codec=None):
+        """ codec: 'gzip' (compress=True) or 'zstd'
+            raw: the records are whole frames, as read by TfrecordsRDD(raw=True),
+            and are written as they are """
+        return OutputTfrecordstFileRDD(self, path, ext, overwrite, compress=compress,
+                                       index=index, raw=raw, codec=codec).collect()
+
+    def saveAsTextFileByKey(self, path, ext='', overwrite=True, compress=False, codec=None):
+        """ codec: only 'gzip' (compress=True), written at its level """
+        return MultiOutputTextFileRDD(self, path, ext, overwrite, compress=compress,
+                                      codec=codec).collect()
+
+    def saveAsCSVFile(self, path, dialect='excel', overwrite=True, compress=False, codec=None):
+        return OutputCSVFileRDD(self, path, dialect, overwrite, compress, codec).collect()
+
+    def saveAsBinaryFile(self, path, fmt=None, overwrite=True, dtype=None):
+        """ fmt: struct format of a row
+            dtype: numpy dtype of a record, rows are arrays of records
+                (as read by BinaryFileRDD(dtype=)) or single records """
+        return OutputBinaryFileRDD(self, path, fmt, overwrite, dtype).collect()
+
+    def saveAsTableFile(self, path, overwrite=True, compress=True, codec=None, stats=False):
+        """ codec: of the blocks, 'zlib' (compress=True), 'zstd', 'lz4', ...
+            stats: keep min/max of every column (True) or of the listed
+                column indices in the footer, for TableFileRDD(predicate=) """
+        return OutputTableFileRDD(self, path, overwrite, compress, codec, stats).collect()
 
     def saveAsBeansdb(self, path, depth=0, overwrite=True, compress=True,
                       raw=False, valueWithMeta=False):
@@ -1044,6 +1103,9 @@ class ShuffledRDD(RDD):
         return d
 
     def compute(self, split):
+        from dpark.shuffle import (
+            Merger, OrderedMerger, SortedGroupMerger, SortedMerger, SortedShuffleFetcher
+        )
         if not self.sort_shuffle:
             if isinstance(self.aggregator, GroupByAggregator):
                 merger = OrderedMerger(self.aggregator)
@@ -1113,6 +1175,8 @@ class CartesianRDD(RDD):
         self.rdd1 = self.rdd2 = None
 
     def compute(self, split):
+        import gzip
+        import tempfile
         saved = False
         _cached = None
         basedir = os.path.join(env.workdir[-1], 'temp')
@@ -1198,6 +1262,7 @@ class CoGroupedRDD(RDD):
                                                if isinstance(dep, NarrowCoGroupSplitDep)], [])
 
     def _compute_hash_merge(self, split):
+        from dpark.shuffle import OrderedCoGroupMerger
         m = OrderedCoGroupMerger(self.size)
         for i, dep in enumerate(split.deps):
             if isinstance(dep, NarrowCoGroupSplitDep):
@@ -1209,6 +1274,7 @@ class CoGroupedRDD(RDD):
         return m
 
     def _compute_sort_merge(self, split):
+        from dpark.shuffle import CoGroupSortedMerger, SortedShuffleFetcher
 
         def _enum_value(items, n):
             for k, v in items:
@@ -1230,6 +1296,9 @@ class CoGroupedRDD(RDD):
         return merger
 
     def _compute_sort_merge_iter(self, split):
+        from dpark.shuffle import (
+            SortedGroupMerger, SortedShuffleFetcher, StreamCoGroupSortedMerger
+        )
         iters = []
         fetcher = SortedShuffleFetcher()
         for i, dep in enumerate(split.deps):
@@ -1401,45 +1470,100 @@ class CSVReaderRDD(DerivedRDD):
         self.repr_name = '<CSVReaderRDD %s of %s>' % (dialect, prev)
 
     def compute(self, split):
+        import csv
         return csv.reader(self.prev.iterator(split), self.dialect)
 
 
 class ParallelCollectionSplit:
-    def __init__(self, ctx, index, values):
+    def __init__(self, ctx, index, values, shared=None):
+        """ arrays and bytes in values are pickled out of band, their
+            buffers go to shared memory when shared is a SharedBuffers.
+            Every load() gets writable buffers of its own. """
+        from dpark.buffers import dumps as buffers_dumps
         self.index = index
-        _values = six.moves.cPickle.dumps(values, -1)
-        length = len(_values)
+        _values, buffers = buffers_dumps(values)
+        self.buffers = None
+        self._digest = None
+        self.shared = None  # (segment name, spans of the buffers)
+        self.is_broadcast = False
+        if buffers and shared is not None:
+            self.values = _values
+            self.shared = shared.add(buffers)
+            return
+
+        buffers = [b.tobytes() for b in buffers]
+        length = len(_values) + sum(len(b) for b in buffers)
         data_limit = ctx.data_limit
         if data_limit is None or length < data_limit:
             self.values = _values
-            self.is_broadcast = False
+            self.buffers = buffers
         else:
-            self.values = ctx.broadcast(_values)
+            self.values = ctx.broadcast((_values, buffers))
             self.is_broadcast = True
 
+    def digest(self):
+        "sha1 of the pickled values, for the lineage fingerprint"
+        from dpark.buffers import attach as attach_buffers, digest as buffers_digest
+        if self._digest is None:
+            if self.is_broadcast:
+                _values, buffers = self.values.value
+            elif self.shared is not None:
+                _values, buffers = self.values, attach_buffers(*self.shared)
+            else:
+                _values, buffers = self.values, self.buffers
+            self._digest = buffers_digest([_values] + list(buffers))
+        return self._digest
+
+    def load(self):
+        from dpark.buffers import attach as attach_buffers
+        if self.is_broadcast:
+            _values, buffers = self.values.value
+        elif self.shared is not None:
+            return self.values, attach_buffers(*self.shared)
+        else:
+            _values, buffers = self.values, self.buffers
+        # arrays may be changed in place, as when they were unpickled in band
+        return _values, [bytearray(b) for b in buffers]
+
 
 class ParallelCollection(RDD):
+    LINEAGE_IGNORED = RDD.LINEAGE_IGNORED + ('_shared',)
+
     def __init__(self, ctx, data, numSlices, taskMemory=None):
+        from dpark.buffers import SharedBuffers, shared_memory_available
         RDD.__init__(self, ctx)
         self.size = len(data)
         if taskMemory:
             self.mem = taskMemory
         slices = self.slice(data, max(1, min(self.size, numSlices)))
-        self._splits = [ParallelCollectionSplit(ctx, i, slices[i])
+        # workers on this host read buffers from shared memory, which
+        # is released with the RDD
+        self._shared = None
+        master = getattr(ctx, 'master', None) or ''
+        if master.startswith(('local', 'process')) and shared_memory_available():
+            self._shared = SharedBuffers()
+        self._splits = [ParallelCollectionSplit(ctx, i, slices[i], self._shared)
                 for i in range(len(slices))]
         self._dependencies = []
         self.repr_name = '<ParallelCollection %d>' % self.size
 
-    def compute(self, split):
-        if split.is_broadcast:
-            _values = split.values.value
-        else:
-            _values =split.values
+    @cached
+    def __getstate__(self):
+        d = dict(RDD.__getstate__(self))
+        d.pop('_shared', None)
+        return d
 
-        return six.moves.cPickle.loads(_values)
+    def _lineage_data(self):
+        return [split.digest() for split in self._splits]
+
+    def compute(self, split):
+        from dpark.buffers import loads as buffers_loads
+        _values, buffers = split.load()
+        return buffers_loads(_values, buffers)
 
     @classmethod
     def slice(cls, data, numSlices):
+        from dpark.buffers import OOB as BUFFERS_OOB, is_buffer
         if numSlices <= 0:
             raise ValueError("invalid numSlices %d" % numSlices)
         m = len(data)
@@ -1458,6 +1582,11 @@ class ParallelCollection(RDD):
             slices.append(range(first+(numSlices-1)*nstep,
                 min(last+step, first+numSlices*nstep), step))
             return slices
+        if is_buffer(data):
+            # views of arrays and bytes, pickled out of band
+            if BUFFERS_OOB and not hasattr(data, '__array_interface__'):
+                data = memoryview(data)
+            return [data[i*n : i*n+n] for i in range(numSlices)]
         if not isinstance(data, list):
             data = list(data)
         return [data[i*n : i*n+n] for i in range(numSlices)]
@@ -1479,13 +1608,16 @@ class CheckpointRDD(RDD):
         return sorted(filter(str.isdigit, os.listdir(path)), key=int)
 
     def compute(self, split):
+        from dpark.checkpoint import read_checkpoint
+        path = os.path.join(self.path, self.files[split.index])
         try:
-            with open(os.path.join(self.path, self.files[split.index]), 'rb') as f:
-                return six.moves.cPickle.loads(f.read())
+            f = open(path, 'rb')
         except IOError:
             time.sleep(1)
-            with open(os.path.join(self.path, self.files[split.index]), 'rb') as f:
-                return six.moves.cPickle.loads(f.read())
+            f = open(path, 'rb')
+        with f:
+            for item in read_checkpoint(f):
+                yield item
 
 
 class PartialSplit(Split):
@@ -1495,13 +1627,30 @@ class PartialSplit(Split):
         self.end = end
 
 
+def metered(compute):
+    "collect IOMetrics of compute(split, metrics) when metrics are enabled"
+    def _(self, split):
+        if self.metrics_acc is None:
+            return compute(self, split)
+        return self._metered(split, compute)
+    _.__name__ = compute.__name__
+    _.__doc__ = compute.__doc__
+    _.metered = True
+    return _
+
+
 class TextFileRDD(RDD):
 
     DEFAULT_SPLIT_SIZE = 64*1024*1024
+    READ_BLOCK_SIZE = 4 << 20
+    metrics_acc = None
+    raw = False
 
-    def __init__(self, ctx, path, numSplits=None, splitSize=None):
+    def __init__(self, ctx, path, numSplits=None, splitSize=None, raw=False):
+        """ raw: yield lines as bytes, without decoding them """
         RDD.__init__(self, ctx)
         self.path = path
+        self.raw = raw
         with closing(open_file(path)) as file_:
             self.size = size = file_.length
 
@@ -1517,70 +1666,180 @@ class TextFileRDD(RDD):
             self._splits = [PartialSplit(i, i*splitSize, min(size, (i+1) * splitSize))
                         for i in range(numSplits)]
 
-            self._preferred_locs = {}
+            locs = {}
             for split in self._splits:
                 if self.splitSize != CHUNKSIZE:
                     start = split.begin // CHUNKSIZE
                     end = (split.end + CHUNKSIZE - 1) // CHUNKSIZE
-                    self._preferred_locs[split] = sum((file_.locs(i) for i in range(start, end)), [])
+                    locs[split] = sum((file_.locs(i) for i in range(start, end)), [])
                 else:
-                    self._preferred_locs[split] = file_.locs(split.begin // self.splitSize)
-                hostnames = []
-                for loc in self._preferred_locs[split]:
-                    host = loc
-                    try:
-                        host = socket.gethostbyaddr(loc)[0]
-                    except IOError as e:
-                        logger.warning('get hostname exec %s for loc %s', e.message, loc)
-                    hostnames.append(host)
-                self._preferred_locs[split] = hostnames
+                    locs[split] = file_.locs(split.begin // self.splitSize)
+
+            # resolve every address once, splits on the same servers share the list
+            hosts = resolve_hostnames(set(chain(locs.values())))
+            shared = {}
+            self._preferred_locs = {}
+            for split, addrs in locs.items():
+                key = tuple(addrs)
+                if key not in shared:
+                    shared[key] = [hosts[a] for a in addrs]
+                self._preferred_locs[split] = shared[key]
         self.repr_name = '<%s %s>' % (self.__class__.__name__, path)
 
-    def open_file(self):
-        return open_file(self.path)
+    def _lineage_files(self):
+        return [self.path]
 
-    def compute(self, split):
-        with closing(self.open_file()) as f:
+    def with_metrics(self):
+        """ collect I/O metrics of every split, read them by metrics() after a job """
+        if not getattr(self.compute, 'metered', False):
+            raise ValueError('%s does not collect I/O metrics' % self.__class__.__name__)
+        self.metrics_acc = self.ctx.accumulator([], listAcc)
+        self._pickle_cache = None
+        return self
+
+    def metrics(self):
+        """ {split index: IOMetrics.as_dict()} of the latest run of each split """
+        if self.metrics_acc is None:
+            return {}
+        return dict(self.metrics_acc.value)
+
+    def _metered(self, split, compute):
+        m = IOMetrics()
+        try:
+            for r in compute(self, split, m):
+                m.records += 1
+                yield r
+        finally:
+            self.metrics_acc.add([(split.index, m.as_dict())])
+
+    def open_file(self, metrics=None):
+        f = open_file(self.path)
+        if metrics is not None:
+            f = MeteredFile(f, metrics)
+        return f
+
+    @metered
+    def compute(self, split, metrics=None):
+        with closing(self.open_file(metrics)) as f:
             start = split.begin
             end = split.end
             if start > 0:
-                f.seek(start-1)
-                byte = f.read(1)
-                while byte != b'\n':
-                    byte = f.read(1)
-                    if not byte:
-                        return
-                    start += 1
+                start = self.find_line_start(f, start, end)
+                if start is None:
+                    return
 
+            if metrics is not None:
+                metrics.bytes_skipped += start - split.begin
             if start >= end:
                 return
 
-            for l in self.read(f, start, end):
+            f.seek(start)
+            for l in self.read(f, start, end, metrics):
                 yield l
 
-    def read(self, f, start, end):
-        for line in f:
-            size = len(line)
-            if not six.PY2:
-                line = line.decode('utf-8')
+    def find_line_start(self, f, start, end):
+        "offset of the first line starting at or after start, None if there is none"
+        pos = start - 1
+        f.seek(pos)
+        while pos < end:
+            block = f.read(64 << 10)
+            if not block:
+                return None
+            p = block.find(b'\n')
+            if p >= 0:
+                return pos + p + 1
+            pos += len(block)
+        return end
+
+    def read(self, f, start, end, metrics=None):
+        """ lines starting in [start, end), f is at start.
+
+            The file is read in blocks, each block is decoded at once and
+            split into lines; the line crossing end is completed by reading on.
+        """
+        rest = []       # blocks of a line not ended yet, joined at its end
+        rest_size = 0
+        pos = start     # offset of rest
+        while True:
+            want = end - pos - rest_size
+            size = want + 4096 if want > 0 else 64 << 10
+            block = f.read(min(size, self.READ_BLOCK_SIZE))
+            if not block:
+                if rest:
+                    for line in self._split_lines(b''.join(rest), metrics):
+                        yield line
+                return
 
-            if line.endswith('\n'):
-                yield line[:-1]
-            else:
+            rest.append(block)
+            rest_size += len(block)
+            if b'\n' not in block:
+                continue
+
+            buf = b''.join(rest) if len(rest) > 1 else block
+            k = end - pos   # lines starting before buf[k] are ours
+            cut = buf.find(b'\n', k - 1) if k <= len(buf) else -1
+            if cut >= 0:
+                for line in self._split_lines(buf[:cut], metrics):
+                    yield line
+                return
+
+            cut = buf.rfind(b'\n')
+            tail = buf[cut + 1:]
+            rest = [tail] if tail else []
+            rest_size = len(tail)
+            for line in self._split_lines(buf[:cut], metrics):
                 yield line
-            start += size
-            if start >= end: break
+            pos += cut + 1
+
+    def skip_partial_line(self, r, start):
+        """ skip the rest of the line the reader r is in, r is at start
+            and supports unread(); the new start, None at the end """
+        while True:
+            d = r.read(64 << 10)
+            if not d:
+                return None
+            p = d.find(b'\n')
+            if p >= 0:
+                r.unread(d[p + 1:])
+                return start + p + 1
+            start += len(d)
+
+    def _split_lines(self, data, metrics=None):
+        "lines of data, which holds whole lines without the last newline"
+        if not six.PY2 and not self.raw:
+            if metrics is None:
+                data = data.decode('utf-8')
+            else:
+                t = time.time()
+                data = data.decode('utf-8')
+                metrics.decode_time += time.time() - t
+            return data.split('\n')
+        return data.split(b'\n')
 
 class TfrecordsRDD(TextFileRDD):
 
     DEFAULT_READ_SIZE = 1 << 10
     BLOCK_SIZE = 64 << 10
 
-    def __init__(self, ctx, path, numSplits=None, splitSize=None):
-        TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
-
-    def compute(self, split):
-        with closing(self.open_file()) as f:
+    def __init__(self, ctx, path, numSplits=None, splitSize=None, raw=False):
+        """ raw: yield every checked frame as bytes, header and crcs included,
+            for saveAsTFRecordsFile(raw=True) to copy without re-encoding """
+        TextFileRDD.__init__(self, ctx, path, numSplits, splitSize, raw)
+
+    @metered
+    def compute(self, split, metrics=None):
+        return self._compute(split, self.compute_with_fh, metrics)
+
+    @metered
+    def compute_headers(self, split, metrics=None):
+        """ (offset, length) of the records in split, payloads are skipped.
+            For .gz files offsets are relative to the decompressed block. """
+        return self._compute(split, self.headers_with_fh, metrics)
+
+    def _compute(self, split, with_fh, metrics=None):
+        from dpark.zstdfile import SeekTable, ZstdFrameReader
+        import gzip
+        with closing(self.open_file(metrics)) as f:
             if self.path.endswith('.gz'):
                 # compute the start & end boundary of gzip file (cut block)
                 if split.index == 0:
@@ -1599,8 +1858,14 @@ class TfrecordsRDD(TextFileRDD):
 
                 f.seek(start)
                 f.length = end
+                blocks = gzip_decompressed_fh_2(f, self.path)
+                if metrics is not None:
+                    metrics.bytes_skipped += start - split.begin
+                    blocks = metrics.timed(blocks, 'decompress_time')
                 cross_record = BytesIO()
-                for fh in gzip_decompressed_fh_2(f, self.path):
+                for fh in blocks:
+                    if metrics is not None:
+                        metrics.bytes_decompressed += len(fh.getvalue())
                     point = self.check_block_split_point(fh)
                     fh.seek(0)      # speed up
                     if point is None:
@@ -1608,42 +1873,137 @@ class TfrecordsRDD(TextFileRDD):
                     else:
                         cross_record.write(fh.read(point))
                         cross_record.seek(0)
-                        for rcd in self.compute_with_fh(cross_record, 0, float('inf')):
+                        for rcd in with_fh(cross_record, 0, float('inf'), metrics):
                             yield rcd
                         cross_record.seek(0)    # speed up
                         cross_record.truncate()     # clear the buffer
                         cross_record.write(fh.read())   # write next record head
                         if f.tell() > end:
                             break
+            elif self.path.endswith('.zst'):
+                # frames hold whole records, as written by saveAsTFRecordsFile
+                table = SeekTable.load(f, self.size)
+                if table is None:
+                    raise IOError('%s is not a seekable zstd file' % self.path)
+                i, j = table.frames_in(split.begin, split.end)
+                r = ZstdFrameReader(f, table, i, j, metrics)
+                for k in range(i, j):
+                    for rcd in with_fh(BytesIO(r.read_frame(k)), 0, float('inf'), metrics):
+                        yield rcd
             else:
                 start = split.begin
                 end = split.end
-                for rcd in self.compute_with_fh(f, start, end):
+                for rcd in with_fh(f, start, end, metrics):
                     yield rcd
 
-    def compute_with_fh(self, f, start, end):
+    def find_split_point(self, f, start, end):
+        """ offset of the first header starting in [start, end), or end """
+        f.seek(start)
+        limit = end + 11    # a header starting before end may run past it
+        buffer = f.read(min(self.DEFAULT_READ_SIZE, limit - start))
+        while True:
+            cursor = 0
+            while cursor < len(buffer) - 11:
+                if self.check_split_point(buffer[cursor:cursor + 12]):
+                    return start + cursor
+                cursor += 1
+            data = f.read(min(self.DEFAULT_READ_SIZE, limit - f.tell()))
+            if not data:
+                return end
+            start += cursor
+            buffer = buffer[cursor:] + data
+
+    def compute_with_fh(self, f, start, end, metrics=None):
+        from dpark.tfrecord import FRAME_OVERHEAD
         if start >= 0:
-            f.seek(start)
-            buffer = f.read(min(self.DEFAULT_READ_SIZE, end - f.tell()))
-            while start < end:
-                cursor = 0
-                while cursor < len(buffer) - 11 and not self.check_split_point(buffer[cursor:cursor + 12]):
-                    cursor += 1
-                start += cursor
-                if cursor == len(buffer) - 11:
-                    start += 11
-                    buffer = buffer[-11:] + f.read(min(self.DEFAULT_READ_SIZE, end - f.tell()))
-                else:
-                    break
+            sync = self.find_split_point(f, start, end)
+            if metrics is not None:
+                metrics.bytes_skipped += sync - start
+            start = sync
         if start >= end:
             return
         f.seek(start)
+        overhead = 0 if self.raw else FRAME_OVERHEAD
         while start < end:
-            record = self.get_single_record(f)
+            record = self.get_single_record(f, metrics, self.raw)
             if record is None:
                 return
             yield record
-            start += len(record) + 16
+            start += len(record) + overhead
+
+    def headers_with_fh(self, f, start, end, metrics=None):
+        from dpark.tfrecord import walk_headers
+        start = self.find_split_point(f, start, end)
+        if start >= end:
+            return
+        for offset, length in walk_headers(f, start, end):
+            yield offset, length
+
+    def record_file(self):
+        """ TFRecordFile over this file, for random access on the driver,
+            to be closed by the caller """
+        from dpark.tfrecord import TFRecordFile
+        return TFRecordFile(self.path, lambda p: self.open_file())
+
+    def getRecord(self, i):
+        return self.getRecords([i])[0]
+
+    def getRecords(self, indices):
+        with self.record_file() as rf:
+            records = rf.get_records(indices, self.raw)
+        if self.raw:
+            return records
+        return [r.decode() for r in records]
+
+    def sample(self, faction, withReplacement=False, seed=12345):
+        return TfrecordsSampleRDD(self, faction, withReplacement, seed)
+
+    def shuffled(self, seed=0, epoch=0, numSplits=None, window=0):
+        return ShuffledTfrecordsRDD(self.ctx, [self.path], seed, epoch,
+                                    numSplits or len(self), window)
+
+    def shard(self, num_workers, worker_index, by='record', numSplits=None, blockSize=None):
+        if by == 'file':
+            # a single file can not be shared out by file
+            by = 'record'
+        return ShardedTfrecordsRDD(self.ctx, [self.path], num_workers, worker_index, by,
+                                   numSplits or max(len(self) // num_workers, 1), blockSize)
+
+    def headers(self):
+        return TfrecordsHeaderRDD(self)
+
+    def count(self):
+        if self.shouldCache or self.checkpoint_path:
+            return TextFileRDD.count(self)
+        return self.headers().count()
+
+    def stat(self):
+        """ record count and payload size statistics, only headers are read """
+        from dpark.tfrecord import FRAME_OVERHEAD
+        def _stat(it):
+            records, size, min_size, max_size = 0, 0, None, 0
+            for _, length in it:
+                records += 1
+                size += length
+                max_size = max(max_size, length)
+                if min_size is None or length < min_size:
+                    min_size = length
+            return records, size, min_size, max_size
+
+        records, size, min_size, max_size = 0, 0, None, 0
+        for r, s, lo, hi in self.ctx.runJob(self.headers(), _stat):
+            records += r
+            size += s
+            max_size = max(max_size, hi)
+            if lo is not None and (min_size is None or lo < min_size):
+                min_size = lo
+        return {
+            'records': records,
+            'bytes': size,
+            'frame_bytes': size + records * FRAME_OVERHEAD,
+            'min_size': min_size,
+            'max_size': max_size,
+        }
 
     def check_block_split_point(self, f):
         buffer = f.read()   # speed up
@@ -1665,15 +2025,18 @@ class TfrecordsRDD(TextFileRDD):
         length_mask_actual = masked_crc32c(buf[:8])
         return length_mask_actual == length_mask_expected
 
-    def get_single_record(self, f):
+    def get_single_record(self, f, metrics=None, raw=False):
+        crc32c = masked_crc32c
+        if metrics is not None:
+            crc32c = metrics.wrap(masked_crc32c, 'crc_time')
         buf_length_expected = 12
-        buf = f.read(buf_length_expected)
+        header = buf = f.read(buf_length_expected)
         if not buf:
             return None
         if len(buf) != buf_length_expected:
             raise ValueError('Not a valid TFRecord. Fewer than %d bytes: %s' % (buf_length_expected, buf))
         length, length_mask_expected = struct.unpack('<QI', buf)
-        length_mask_actual = masked_crc32c(buf[:8])
+        length_mask_actual = crc32c(buf[:8])
         if length_mask_actual == length_mask_expected:
             # data verification
             buf_length_expected = length + 4
@@ -1681,18 +2044,340 @@ class TfrecordsRDD(TextFileRDD):
             if len(buf) != buf_length_expected:
                 raise ValueError('Not a valid TFRecord. Fewer than %d bytes: %s' % (buf_length_expected, buf))
             data, data_mask_expected = struct.unpack('<%dsI' % length, buf)
-            data_mask_actual = masked_crc32c(data)
+            data_mask_actual = crc32c(data)
             if data_mask_actual == data_mask_expected:
-                return data.decode()
+                if raw:
+                    return header + buf
+                if metrics is None:
+                    return data.decode()
+                t = time.time()
+                data = data.decode()
+                metrics.decode_time += time.time() - t
+                return data
             else:
+                if metrics is not None:
+                    metrics.corrupt_frames += 1
                 logger.error("data loss!!!")  # Note: Pending
         else:
             return None
 
+class TfrecordsHeaderRDD(DerivedRDD):
+    "(offset, length) of every record in a TfrecordsRDD, without reading payloads"
+
+    def compute(self, split):
+        return self.prev.compute_headers(split)
+
+
+class TfrecordsSampleRDD(SampleRDD):
+    """ sampling without replacement pushed down to TFRecord frames
+
+        Records are chosen from the offset index, or from the frame headers
+        when there is none, and only the frames of kept records are read.
+        Keeps the same records as SampleRDD with the same seed.
+    """
+
+    BATCH_SIZE = 4096
+
+    def compute(self, split):
+        from dpark.codec import codec_of_path
+        prev = self.prev
+        if (self.withReplacement or codec_of_path(prev.path) is not None or prev.raw
+                or prev.shouldCache or prev.checkpoint_path):
+            return SampleRDD.compute(self, split)
+        def compute(rdd, split, metrics=None):
+            return self._compute_frames(split, metrics)
+        if prev.metrics_acc is not None:
+            # the frames are read here rather than by prev.compute
+            return prev._metered(split, compute)
+        return compute(prev, split)
+
+    def _compute_frames(self, split, metrics=None):
+        from dpark.tfrecord import OffsetIndex
+        offsets = OffsetIndex.open(self.prev.path, self.prev.size)
+        if offsets is None:
+            records = self._compute_with_headers(split, metrics)
+        else:
+            records = self._compute_with_index(split, offsets, metrics)
+        try:
+            for r in records:
+                yield r
+        finally:
+            if offsets is not None:
+                offsets.close()
+
+    def _compute_with_index(self, split, offsets, metrics=None):
+        """ offsets is the OffsetIndex of the file, the bounds of the split
+            are bisected with preads and only the entries of kept records
+            are read, so the cost follows the split size """
+        from dpark.tfrecord import TFRecordFile
+        rd = random.Random(self.seed + split.index)
+        frac = self.frac
+        n = len(offsets) - 1
+        first = bisect.bisect_left(offsets, split.begin, 0, n)
+        last = bisect.bisect_left(offsets, split.end, first, n)
+        with TFRecordFile(self.prev.path, lambda p: self.prev.open_file(metrics), offsets) as rf:
+            for begin in range(first, last, self.BATCH_SIZE):
+                kept = [i for i in range(begin, min(begin + self.BATCH_SIZE, last))
+                        if rd.random() <= frac]
+                try:
+                    records = rf.get_records(kept)
+                except ValueError:
+                    records = self._until_corrupt(rf, kept, metrics)
+                for r in records:
+                    yield r.decode()
+                if len(records) < len(kept):
+                    return
+
+    def _until_corrupt(self, rf, indices, metrics=None):
+        "the records of indices before the first corrupt one"
+        records = []
+        for i in indices:
+            try:
+                records.extend(rf.get_records([i]))
+            except ValueError:
+                self._data_loss(metrics)
+                break
+        return records
+
+    def _compute_with_headers(self, split, metrics=None):
+        from dpark.tfrecord import walk_headers, decode_frame, FRAME_OVERHEAD
+        rd = random.Random(self.seed + split.index)
+        frac = self.frac
+        with closing(self.prev.open_file(metrics)) as f:
+            start = self.prev.find_split_point(f, split.begin, split.end)
+            for offset, length in walk_headers(f, start, split.end):
+                if rd.random() <= frac:
+                    try:
+                        data = decode_frame(pread(f, length + FRAME_OVERHEAD, offset))
+                    except ValueError:
+                        self._data_loss(metrics)
+                        return
+                    yield data.decode()
+
+    def _data_loss(self, metrics=None):
+        # stop at a corrupt frame, as TfrecordsRDD.compute does
+        if metrics is not None:
+            metrics.corrupt_frames += 1
+        logger.error("data loss!!!")
+
+
+class TfrecordsBlocksSplit(Split):
+    "blocks are (file index, first record, end record) ranges"
+    def __init__(self, index, blocks):
+        self.index = index
+        self.blocks = blocks
+
+
+class IndexedTfrecordsRDD(RDD):
+    """ base of RDDs reading TFRecord files by record number through the offset index
+
+        Only the record counts are kept here, every task reads the
+        index entries of the records it fetches.
+    """
+
+    def __init__(self, ctx, paths):
+        from dpark.tfrecord import count_records
+        RDD.__init__(self, ctx)
+        self.paths = paths
+        self.counts = [count_records(path, open_file) for path in paths]
+        self.starts = [0]
+        for n in self.counts:
+            self.starts.append(self.starts[-1] + n)
+        self.size = self.starts[-1]
+
+    def _lineage_files(self):
+        return list(self.paths)
+
+    def compute(self, split):
+        files = {}
+        try:
+            for r in self._compute(split, files):
+                yield r.decode()
+        finally:
+            for rf in files.values():
+                rf.close()
+
+    def _compute(self, split, files):
+        return self._read_blocks(split.blocks, files)
+
+    def _record_file(self, files, i):
+        from dpark.tfrecord import TFRecordFile
+        rf = files.get(i)
+        if rf is None:
+            rf = files[i] = TFRecordFile(self.paths[i], open_file)
+        return rf
+
+    def _read_blocks(self, blocks, files):
+        for i, first, last in blocks:
+            for r in self._record_file(files, i).iter_records(first, last):
+                yield r
+
+
+class ShuffledTfrecordsRDD(IndexedTfrecordsRDD):
+    """ records of TFRecord files in a random order per (seed, epoch)
+
+        The order is a pseudo random permutation of all records across
+        the files, every split fetches its share of positions through the
+        record offset index, so no shuffle stage is needed. With window > 0,
+        blocks of `window` contiguous records are permuted instead and mixed
+        by a shuffle buffer of the same size, cheaper but approximate.
+    """
+
+    BATCH_SIZE = 4096
+
+    def __init__(self, ctx, paths, seed=0, epoch=0, numSplits=None, window=0):
+        IndexedTfrecordsRDD.__init__(self, ctx, paths)
+        self.seed = seed
+        self.epoch = epoch
+        self.window = window
+        self.key = '%s-%s' % (seed, epoch)
+
+        n = self.size
+        if numSplits is None:
+            numSplits = len(paths)
+        if window > 0:
+            blocks = [(i, b, min(b + window, c))
+                      for i, c in enumerate(self.counts)
+                      for b in range(0, c, window)]
+            random.Random(self.key).shuffle(blocks)
+            m = len(blocks)
+            numSplits = max(1, min(numSplits, m))
+            self._splits = [TfrecordsBlocksSplit(i, blocks[m * i // numSplits:m * (i + 1) // numSplits])
+                            for i in range(numSplits)]
+        else:
+            numSplits = max(1, min(numSplits, n))
+            self._splits = [PartialSplit(i, n * i // numSplits, n * (i + 1) // numSplits)
+                            for i in range(numSplits)]
+        self.repr_name = '<%s %d files, seed=%s epoch=%s>' % (
+            self.__class__.__name__, len(paths), seed, epoch)
+
+    def _compute(self, split, files):
+        if self.window > 0:
+            return self._compute_window(split, files)
+        return self._compute_exact(split, files)
+
+    def _compute_exact(self, split, files):
+        from dpark.tfrecord import Permutation
+        perm = Permutation(self.size, self.key)
+        starts = self.starts
+        for begin in range(split.begin, split.end, self.BATCH_SIZE):
+            wanted = collections.defaultdict(list)
+            order = []
+            for pos in range(begin, min(begin + self.BATCH_SIZE, split.end)):
+                g = perm[pos]
+                i = bisect.bisect_right(starts, g) - 1
+                order.append((i, len(wanted[i])))
+                wanted[i].append(g - starts[i])
+            fetched = dict((i, self._record_file(files, i).get_records(idx))
+                           for i, idx in wanted.items())
+            for i, k in order:
+                yield fetched[i][k]
+
+    def _compute_window(self, split, files):
+        rd = random.Random('%s-%d' % (self.key, split.index))
+        window = self.window
+        buf = []
+        for r in self._read_blocks(split.blocks, files):
+            if len(buf) < window:
+                buf.append(r)
+                continue
+            k = rd.randrange(window)
+            yield buf[k]
+            buf[k] = r
+        rd.shuffle(buf)
+        for r in buf:
+            yield r
+
+
+class ShardedTfrecordsRDD(IndexedTfrecordsRDD):
+    """ the share of worker `worker_index` out of `num_workers` training workers
+
+        by='record': a contiguous run of records, equal counts within one record
+        by='file': whole files, balanced by record count
+        by='block': every num_workers-th block of `blockSize` records, blocks are
+            made smaller when there are fewer of them than workers
+
+        Shares are disjoint and computed from the offset index, so a worker
+        never reads records of other workers.
+    """
+
+    DEFAULT_BLOCK_SIZE = 1024
+
+    def __init__(self, ctx, paths, num_workers, worker_index, by='record',
+                 numSplits=None, blockSize=None):
+        if not 0 <= worker_index < num_workers:
+            raise ValueError('invalid worker_index %d for %d workers' % (worker_index, num_workers))
+        IndexedTfrecordsRDD.__init__(self, ctx, paths)
+        self.num_workers = num_workers
+        self.worker_index = worker_index
+        self.by = by
+
+        if by == 'record':
+            blocks = self._record_share(num_workers, worker_index)
+        elif by == 'file':
+            blocks = self._file_share(num_workers, worker_index)
+        elif by == 'block':
+            blockSize = min(blockSize or self.DEFAULT_BLOCK_SIZE,
+                            max(self.size // num_workers, 1))
+            blocks = [(i, b, min(b + blockSize, c))
+                      for i, c in enumerate(self.counts)
+                      for b in range(0, c, blockSize)][worker_index::num_workers]
+        else:
+            raise ValueError('invalid shard mode: %s' % by)
+
+        if numSplits is None:
+            numSplits = len(paths)
+        self._splits = [TfrecordsBlocksSplit(i, bs)
+                        for i, bs in enumerate(self._cut_blocks(blocks, numSplits))]
+        self.repr_name = '<%s %d/%d by %s, %d files>' % (
+            self.__class__.__name__, worker_index, num_workers, by, len(paths))
+
+    def _record_share(self, num_workers, worker_index):
+        n = self.size
+        begin = n * worker_index // num_workers
+        end = n * (worker_index + 1) // num_workers
+        blocks = []
+        for i, c in enumerate(self.counts):
+            s = self.starts[i]
+            first, last = max(begin, s), min(end, s + c)
+            if first < last:
+                blocks.append((i, first - s, last - s))
+        return blocks
+
+    def _file_share(self, num_workers, worker_index):
+        loads = [0] * num_workers
+        owned = []
+        for i in sorted(range(len(self.counts)), key=lambda i: (-self.counts[i], i)):
+            w = loads.index(min(loads))
+            loads[w] += self.counts[i]
+            if w == worker_index:
+                owned.append(i)
+        return [(i, 0, self.counts[i]) for i in sorted(owned)]
+
+    @classmethod
+    def _cut_blocks(cls, blocks, numSplits):
+        """ cut blocks into numSplits runs of about the same number of records """
+        total = sum(last - first for _, first, last in blocks)
+        numSplits = max(1, min(numSplits, total))
+        bounds = [total * k // numSplits for k in range(numSplits + 1)]
+        splits = [[] for _ in range(numSplits)]
+        pos = k = 0
+        for i, first, last in blocks:
+            while first < last:
+                while pos >= bounds[k + 1]:
+                    k += 1
+                end = min(last, first + bounds[k + 1] - pos)
+                splits[k].append((i, first, end))
+                pos += end - first
+                first = end
+        return splits
+
+
 class PartialTextFileRDD(TextFileRDD):
-    def __init__(self, ctx, path, firstPos, lastPos, splitSize=None, numSplits=None):
+    def __init__(self, ctx, path, firstPos, lastPos, splitSize=None, numSplits=None, raw=False):
         RDD.__init__(self, ctx)
         self.path = path
+        self.raw = raw
         self.firstPos = firstPos
         self.lastPos = lastPos
         self.size = size = lastPos - firstPos
@@ -1717,12 +2402,27 @@ class PartialTextFileRDD(TextFileRDD):
 
 
 class GZipFileRDD(TextFileRDD):
-    "the gziped file must be seekable, compressed by pigz -i"
+    """ the gziped file must be seekable, compressed by pigz -i
+
+        With a .gzindex sidecar (python -m dpark.gzindex FILE) splits
+        start at its access points. They can only be put after a sync
+        flush or at the start of a gzip member, so a plain gzip file,
+        not compressed by pigz -i or gzip --rsyncable, gets one access
+        point and is read by a single task. """
     BLOCK_SIZE = 64 << 10
     DEFAULT_SPLIT_SIZE = 32 << 20
 
-    def __init__(self, ctx, path, splitSize=None):
-        TextFileRDD.__init__(self, ctx, path, None, splitSize)
+    def __init__(self, ctx, path, splitSize=None, raw=False):
+        TextFileRDD.__init__(self, ctx, path, None, splitSize, raw)
+        index = self.gz_index()
+        self.indexed = index is not None
+        if index is not None:
+            index.close()
+
+    def gz_index(self):
+        """ the .gzindex sidecar, None if there is none or it is stale """
+        from dpark.gzindex import GzipIndex
+        return GzipIndex.load(self.path, self.size, open_file)
 
     def find_block(self, f, pos):
         f.seek(pos)
@@ -1752,8 +2452,39 @@ class GZipFileRDD(TextFileRDD):
             except Exception as e:
                 pass
 
-    def compute(self, split):
-        with closing(self.open_file()) as f:
+    @metered
+    def compute(self, split, metrics=None):
+        if self.indexed:
+            index = self.gz_index()
+            if index is not None:
+                return self._compute_with_index(split, index, metrics)
+        return self._compute_by_probing(split, metrics)
+
+    def _compute_with_index(self, split, index, metrics=None):
+        """ lines starting between the first access point in split and
+            the first one after it, no probing or backward scan needed """
+        from dpark.gzindex import IndexedGzipReader
+        with closing(index):
+            i, j = index.points_in(split.begin, split.end)
+            if i == j:
+                return
+            offset, start, _, _, _, header = index.entries[i]
+            window = index.window(i)
+            end = index.uoffset(j) if j < len(index) else sys.maxsize
+
+        with closing(self.open_file(metrics)) as f:
+            r = IndexedGzipReader(f, offset, window, header)
+            if start > 0 and not window.endswith(b'\n'):
+                start = self.skip_partial_line(r, start)
+            if start is None or start >= end:
+                return
+            for line in self.read(r, start, end, metrics):
+                yield line
+
+    def _compute_by_probing(self, split, metrics=None):
+        import gzip
+        decode = not six.PY2 and not self.raw
+        with closing(self.open_file(metrics)) as f:
             last_line = b''
             if split.index == 0:
                 zf = gzip.GzipFile(mode='r', fileobj=f)
@@ -1782,6 +2513,8 @@ class GZipFileRDD(TextFileRDD):
                             break
 
             end = self.find_block(f, split.index * self.splitSize + self.splitSize)
+            if metrics is not None:
+                metrics.bytes_skipped += max(start - split.begin, 0)
             # TODO: speed up
             f.seek(start)
             f.length = end
@@ -1793,7 +2526,13 @@ class GZipFileRDD(TextFileRDD):
                 if not d: break
 
                 try:
-                    io = BytesIO(dz.decompress(d))
+                    if metrics is None:
+                        io = BytesIO(dz.decompress(d))
+                    else:
+                        t = time.time()
+                        io = BytesIO(dz.decompress(d))
+                        metrics.decompress_time += time.time() - t
+                        metrics.bytes_decompressed += len(io.getvalue())
                 except Exception as e:
                     if self.err < 1e-6:
                         logger.error("failed to decompress file: %s", self.path)
@@ -1803,6 +2542,9 @@ class GZipFileRDD(TextFileRDD):
                     f.seek(start)
                     logger.error("drop corrupted block (%d bytes) in %s",
                             start - old + len(d), self.path)
+                    if metrics is not None:
+                        metrics.corrupt_frames += 1
+                        metrics.bytes_skipped += start - old + len(d)
                     skip_first = True
                     continue
 
@@ -1822,7 +2564,7 @@ class GZipFileRDD(TextFileRDD):
                     skip_first = False
                 elif last_line.endswith(b'\n'):
                     line = last_line[:-1]
-                    if not six.PY2:
+                    if decode:
                         line = line.decode('utf-8')
                     yield line
                 last_line = b''
@@ -1833,23 +2575,92 @@ class GZipFileRDD(TextFileRDD):
                 last_line = ll.pop()
                 for line in ll:
                     line = line[:-1]
-                    if not six.PY2:
+                    if decode:
                         line = line.decode('utf-8')
                     yield line
                 if last_line.endswith(b'\n'):
                     line = last_line[:-1]
-                    if not six.PY2:
+                    if decode:
                         line = line.decode('utf-8')
                     yield line
                     last_line = b''
 
 
+class ZstdFileRDD(TextFileRDD):
+    "the zstd file must be in the seekable format, as written by compress='zstd'"
+    DEFAULT_SPLIT_SIZE = 32 << 20
+
+    def __init__(self, ctx, path, splitSize=None, raw=False):
+        TextFileRDD.__init__(self, ctx, path, None, splitSize, raw)
+
+    @metered
+    def compute(self, split, metrics=None):
+        from dpark.zstdfile import SeekTable, ZstdFrameReader
+        with closing(self.open_file(metrics)) as f:
+            table = SeekTable.load(f, self.size)
+            if table is None:
+                raise IOError('%s is not a seekable zstd file' % self.path)
+            i, j = table.frames_in(split.begin, split.end)
+            if i == j:
+                return
+            start = table.uoffset(i)
+            end = table.uoffset(j) if j < len(table) else sys.maxsize
+
+            r = ZstdFrameReader(f, table, i, metrics=metrics)
+            if i > 0:
+                last = table.last_byte(i - 1)
+                if last is None:    # not written by ZstdWriter
+                    last = r.read_frame(i - 1)[-1:]
+                if last != b'\n':
+                    start = self.skip_partial_line(r, start)
+            if start is None or start >= end:
+                return
+            for line in self.read(r, start, end, metrics):
+                yield line
+
+
+class TableBlocksSplit(PartialSplit):
+    "blocks are the (offset, rows, size, stats) in the footer to read"
+    def __init__(self, index, begin, end, blocks):
+        PartialSplit.__init__(self, index, begin, end)
+        self.blocks = blocks
+
+
 class TableFileRDD(TextFileRDD):
 
     DEFAULT_SPLIT_SIZE = 32 << 20
 
-    def __init__(self, ctx, path, splitSize=None):
+    def __init__(self, ctx, path, splitSize=None, predicate=None, columns=None):
+        """ predicate: (column, op, value) or a list of them which all must
+                hold, blocks whose footer stats rule it out are not read
+            columns: indices of the columns to keep, rows become tuples """
+        from dpark.tablefooter import read_footer, parse_predicate
         TextFileRDD.__init__(self, ctx, path, None, splitSize)
+        self.predicate = parse_predicate(predicate)
+        self.columns = columns
+        with closing(open_file(path)) as f:
+            blocks = read_footer(f, self.size)
+        self.indexed = blocks is not None
+        if blocks is not None:
+            self._plan(blocks)
+
+    def _plan(self, blocks):
+        "splits of the blocks which may match, a block belongs to the split it starts in"
+        from dpark.tablefooter import block_may_match
+        if self.predicate:
+            blocks = [b for b in blocks if block_may_match(b[3], self.predicate)]
+        offsets = [b[0] for b in blocks]
+        splits = []
+        for split in self._splits:
+            i = bisect.bisect_left(offsets, split.begin)
+            j = bisect.bisect_left(offsets, split.end)
+            if i == j:
+                self._preferred_locs.pop(split, None)
+                continue
+            s = TableBlocksSplit(len(splits), split.begin, split.end, blocks[i:j])
+            self._preferred_locs[s] = self._preferred_locs.pop(split, [])
+            splits.append(s)
+        self._splits = splits
 
     def find_magic(self, f, pos, magic):
         f.seek(pos)
@@ -1865,9 +2676,50 @@ class TableFileRDD(TextFileRDD):
             p = block.find(magic)
         return pos + p
 
-    def compute(self, split):
+    @metered
+    def compute(self, split, metrics=None):
+        from dpark.tablefooter import row_matches
+        if isinstance(split, TableBlocksSplit):
+            rows = self._read_blocks(split.blocks, metrics)
+        else:
+            rows = self._scan(split, metrics)
+        if self.predicate:
+            predicate = self.predicate
+            rows = (r for r in rows if row_matches(r, predicate))
+        if self.columns is not None:
+            columns = self.columns
+            rows = (tuple(r[i] for i in columns) for r in rows)
+        return rows
+
+    def _decompress(self, flag, d, metrics=None):
+        "the data of a block compressed with flag"
+        from dpark.codec import codec_of_table_flag
+        if not flag:
+            return d
+        decompress = codec_of_table_flag(flag).decompress
+        if metrics is None:
+            return decompress(d)
+        d = metrics.wrap(decompress, 'decompress_time')(d)
+        metrics.bytes_decompressed += len(d)
+        return d
+
+    def _read_blocks(self, blocks, metrics=None):
+        import msgpack
+        hdr_size = 12
+        with closing(self.open_file(metrics)) as f:
+            for offset, _, size, _ in blocks:
+                if f.tell() != offset:
+                    f.seek(offset)
+                d = f.read(size)
+                assert len(d) == size, 'unexpected end'
+                compressed, _, _ = struct.unpack_from("III", d, 8)
+                d = self._decompress(compressed, d[8 + hdr_size:], metrics)
+                for r in msgpack.Unpacker(BytesIO(d)):
+                    yield r
+
+    def _scan(self, split, metrics=None):
         import msgpack
-        with closing(self.open_file()) as f:
+        with closing(self.open_file(metrics)) as f:
             magic = f.read(8)
             start = split.index * self.splitSize
             end = (split.index + 1) * self.splitSize
@@ -1883,8 +2735,7 @@ class TableFileRDD(TextFileRDD):
                 compressed, count, size = struct.unpack("III", f.read(hdr_size))
                 d = f.read(size)
                 assert len(d) == size, 'unexpected end'
-                if compressed:
-                    d = zlib.decompress(d)
+                d = self._decompress(compressed, d, metrics)
                 for r in msgpack.Unpacker(BytesIO(d)):
                     yield r
                 start += len(magic) + hdr_size + size
@@ -1895,118 +2746,240 @@ class BZip2FileRDD(TextFileRDD):
 
     DEFAULT_SPLIT_SIZE = 32*1024*1024
     BLOCK_SIZE = 9000
+    READ_SIZE = 1 << 20
+    MAX_BACKWARD = 100 * BLOCK_SIZE   # to find the stream before a split
+    DECOMPRESS_THREADS = 1   # unless the task was given more cpus
 
-    def __init__(self, ctx, path, numSplits=None, splitSize=None):
-        TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
+    def __init__(self, ctx, path, numSplits=None, splitSize=None, raw=False):
+        TextFileRDD.__init__(self, ctx, path, numSplits, splitSize, raw)
 
-    def compute(self, split):
-        with closing(self.open_file()) as f:
+    @metered
+    def compute(self, split, metrics=None):
+        with closing(self.open_file(metrics)) as f:
             magic = f.read(10)
-            f.seek(split.index * self.splitSize)
-            d = f.read(self.splitSize)
-            fp = d.find(magic)
-            if fp > 0:
-                d = d[fp:] # drop end of last block
-
-            # real all the block
-            nd = f.read(self.BLOCK_SIZE)
-            np = nd.find(magic)
-            while nd and np < 0:
-                t = f.read(len(nd))
-                if not t: break
-                nd += t
-                np = nd.find(magic)
-            d += nd[:np] if np >= 0 else nd
+            start = split.index * self.splitSize
+            streams = self._streams(f, start, start + self.splitSize, magic, metrics)
+            first = next(streams, None)
+            if first is None:
+                return
 
             last_line = b''
-            if split.index > 0:
-                cur = split.index * self.splitSize
-                skip = fp if fp >= 0 else d.find(magic)
-                if skip >= 0:
-                    cur += skip
-                else:
-                    cur += len(d)
-
-                for i in range(1, 100):
-                    pos = cur - i * self.BLOCK_SIZE
-                    if pos < 0:
-                        break
+            if first[0] > 0:
+                pos = f.tell()
+                last_line = self._last_line(f, first[0], magic)
+                f.seek(pos)
+
+            end = 0
+            streams = itertools.chain([first], streams)
+            for offset, size, data in self._decompressed(streams, metrics):
+                end = offset + size
+                if data is None:
+                    continue
+                cut = data.rfind(b'\n')
+                if cut < 0:
+                    last_line += data
+                    continue
+                for line in self._split_lines(last_line + data[:cut], metrics):
+                    yield line
+                last_line = data[cut + 1:]
 
-                    f.seek(pos)
-                    nd = f.read(cur - pos)
-                    np = nd.find(magic)
-                    if np >= 0:
-                        nd = nd[np:]
-                        last_line = bz2.decompress(nd).split(b'\n')[-1]
-                        break
+            if last_line and end >= self.size:
+                for line in self._split_lines(last_line, metrics):
+                    yield line
 
+    def _streams(self, f, start, end, magic, metrics=None):
+        """ (offset, data) of the pbzip2 streams starting in [start, end),
+            read in READ_SIZE chunks, so only about one stream is kept """
+        f.seek(start)
+        buf = b''
+        pos = start     # offset of buf
+        begin = -1      # start of the current stream in buf
+        scan = 0        # where to look for the next magic in buf
+        eof = False
+        while True:
+            p = buf.find(magic, scan)
+            if p >= 0 and begin < 0:
+                if metrics is not None:
+                    metrics.bytes_skipped += p
+                if pos + p >= end:
+                    return
+                begin = p
+                scan = p + 1
+                continue
+            if p >= 0:
+                yield pos + begin, buf[begin:p]
+                buf = buf[p:]
+                pos += p
+                if pos >= end:
+                    return
+                begin, scan = 0, 1
+                continue
 
-        while d:
-            np = d.find(magic, len(magic))
-            if np <=0:
-                data = d
+            if eof:
+                if begin >= 0:
+                    yield pos + begin, buf[begin:]
+                return
+            if begin < 0:
+                # no stream yet, keep the bytes a magic may start in
+                drop = max(len(buf) - len(magic) + 1, 0)
+                if metrics is not None:
+                    metrics.bytes_skipped += drop
+                buf = buf[drop:]
+                pos += drop
+                if pos >= end:
+                    return
+            scan = max(len(buf) - len(magic) + 1, scan)
+            d = f.read(self.READ_SIZE)
+            if d:
+                buf += d
             else:
-                data = d[:np]
+                eof = True
+
+    def _last_line(self, f, cur, magic):
+        "the unfinished last line of the stream ending at cur"
+        import bz2
+        data = b''
+        pos = cur
+        while pos > 0 and cur - pos < self.MAX_BACKWARD:
+            step = min(pos, self.BLOCK_SIZE << 4)
+            pos -= step
+            data = pread(f, step, pos) + data
+            p = data.rfind(magic, 0, step + len(magic) - 1)
+            if p >= 0:
+                try:
+                    return bz2.decompress(data[p:]).rsplit(b'\n', 1)[-1]
+                except (IOError, EOFError, ValueError):
+                    return b''
+        return b''
+
+    def _decompressed(self, streams, metrics=None):
+        """ (offset, compressed size, data or None if corrupt) of streams,
+            in order, decompressed on as many threads as the task has cpus,
+            with a bounded number of streams in flight """
+        import bz2
+
+        def decompress(data):
+            t = time.time()
             try:
-                io = BytesIO(bz2.decompress(data))
-            except IOError as e:
-                #bad position, skip it
-                pass
-            else:
-                last_line += io.readline()
-                if last_line.endswith(b'\n'):
-                    line = last_line[:-1]
-                    if not six.PY2:
-                        line = line.decode('utf-8')
-                    yield line
-                    last_line = b''
+                out = bz2.decompress(data)
+            except (IOError, EOFError, ValueError):
+                out = None
+            return out, len(data), time.time() - t
+
+        def done(offset, result):
+            out, size, seconds = result
+            if metrics is not None:
+                metrics.decompress_time += seconds
+                if out is None:
+                    metrics.corrupt_frames += 1
+                    metrics.bytes_skipped += size
+                else:
+                    metrics.bytes_decompressed += len(out)
+            return offset, size, out
 
-                for line in io:
-                    if line.endswith(b'\n'): # drop last line
-                        line = line[:-1]
-                        if not six.PY2:
-                            line = line.decode('utf-8')
-                        yield line
-                    else:
-                        last_line = line
+        threads = max(int(self.cpus), self.DECOMPRESS_THREADS, 1)
+        if threads <= 1:
+            for offset, data in streams:
+                yield done(offset, decompress(data))
+            return
 
-            if np <= 0:
-                break
-            d = d[np:]
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            pending = collections.deque()
+            for offset, data in streams:
+                pending.append((offset, pool.apply_async(decompress, (data,))))
+                if len(pending) >= threads * 2:
+                    offset, r = pending.popleft()
+                    yield done(offset, r.get())
+            while pending:
+                offset, r = pending.popleft()
+                yield done(offset, r.get())
+        finally:
+            pool.terminate()
 
 
 class BinaryFileRDD(TextFileRDD):
-    def __init__(self, ctx, path, fmt=None, length=None, numSplits=None, splitSize=None):
+    def __init__(self, ctx, path, fmt=None, length=None, numSplits=None, splitSize=None,
+                 dtype=None, batch=None):
+        """ dtype: numpy dtype of a record, yields read-only arrays of up to
+                batch records, READ_BLOCK_SIZE bytes by default, instead of
+                tuples of fmt or strings of length """
+        assert not (fmt and dtype), "fmt and dtype are exclusive"
         self.fmt = fmt
         if fmt:
             length = struct.calcsize(fmt)
+        self.dtype = None
+        if dtype is not None:
+            import numpy
+            self.dtype = numpy.dtype(dtype)
+            length = self.dtype.itemsize
         self.length = length
-        assert length, "fmt or length must been provided"
+        assert length, "fmt, dtype or length must been provided"
+        self.batch = batch or max(self.READ_BLOCK_SIZE // length, 1)
         if splitSize is None:
             splitSize = self.DEFAULT_SPLIT_SIZE
 
         splitSize = max(splitSize // length, 1) * length
         TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
-        self.repr_name = '<BinaryFileRDD(%s) %s>' % (fmt, path)
+        self.repr_name = '<BinaryFileRDD(%s) %s>' % (fmt or self.dtype, path)
 
-    def compute(self, split):
+    @metered
+    def compute(self, split, metrics=None):
         start = split.index * self.splitSize
         end = min(start + self.splitSize, self.size)
-
-        with closing(self.open_file()) as f:
+        if self.dtype is not None:
+            return self._compute_arrays(start, end, metrics)
+        return self._compute_records(start, end, metrics)
+
+    def _chunks(self, start, end, rlen, metrics=None):
+        "whole records of [start, end) in chunks of up to batch records"
+        size = self.batch * rlen
+        with closing(self.open_file(metrics)) as f:
             f.seek(start)
-            rlen = self.length
-            fmt = self.fmt
-            for i in range((end - start) // rlen):
-                d = f.read(rlen)
-                if len(d) < rlen: break
-                if fmt:
-                    d = struct.unpack(fmt, d)
-                yield d
+            left = (end - start) // rlen * rlen
+            rest = b''  # a record cut by a short read
+            while left > 0:
+                d = f.read(min(size - len(rest), left))
+                if not d:
+                    break
+                left -= len(d)
+                d = rest + d if rest else d
+                n = len(d) // rlen * rlen
+                rest = d[n:]
+                if n:
+                    yield d[:n] if rest else d
+
+    def _compute_records(self, start, end, metrics=None):
+        rlen = self.length
+        if not self.fmt:
+            for d in self._chunks(start, end, rlen, metrics):
+                for i in range(0, len(d), rlen):
+                    yield d[i:i + rlen]
+            return
+
+        st = struct.Struct(self.fmt)
+        for d in self._chunks(start, end, rlen, metrics):
+            if six.PY2:
+                for i in range(0, len(d), rlen):
+                    yield st.unpack_from(d, i)
+            else:
+                for r in st.iter_unpack(d):
+                    yield r
+
+    def _compute_arrays(self, start, end, metrics=None):
+        import numpy
+        dtype = self.dtype
+        for d in self._chunks(start, end, self.length, metrics):
+            yield numpy.frombuffer(d, dtype)
 
 
 class OutputTextFileRDD(DerivedRDD):
-    def __init__(self, rdd, path, ext='', overwrite=False, compress=False):
+    CODECS = None   # names of the supported codecs, None for any with a file format
+
+    def __init__(self, rdd, path, ext='', overwrite=False, compress=False, index=False,
+                 codec=None):
+        from dpark.codec import get_codec
         if os.path.exists(path):
             if not os.path.isdir(path):
                 raise Exception("output must be dir")
@@ -2014,6 +2987,7 @@ class OutputTextFileRDD(DerivedRDD):
                 for n in os.listdir(path):
                     p = os.path.join(path, n)
                     if os.path.isdir(p):
+                        import shutil
                         shutil.rmtree(p)
                     else:
                         os.remove(p)
@@ -2024,11 +2998,20 @@ class OutputTextFileRDD(DerivedRDD):
         self.path = os.path.abspath(path)
         if ext and not ext.startswith('.'):
             ext = '.' + ext
-        if compress and not ext.endswith('gz'):
-            ext += '.gz'
+        self.codec = codec = get_codec(codec if codec is not None else compress)
+        if codec is not None:
+            if not codec.ext or self.CODECS is not None and codec.name not in self.CODECS:
+                raise ValueError('can not write %s files with codec %s'
+                                 % (self.__class__.__name__, codec.name))
+            if not ext.endswith(codec.ext):
+                ext += codec.ext
+            if codec.threads is None and self.cpus > 1:
+                # compress on the cpus the task was given, not more
+                codec = self.codec = codec.with_options(threads=int(self.cpus))
         self.ext = ext
         self.overwrite = overwrite
-        self.compress = compress
+        self.compress = codec is not None
+        self.index = index and self.compress   # access points of compressed blocks
         self.repr_name = '<%s %s %s>' % (self.__class__.__name__, path, rdd)
 
     def compute(self, split):
@@ -2037,18 +3020,29 @@ class OutputTextFileRDD(DerivedRDD):
         if os.path.exists(path) and not self.overwrite:
             return
 
+        # writers of indexed files take the index as a third argument and
+        # put the sidecar index of the file into it, it is written by write_index
+        index = [] if self.index else None
+        args = () if index is None else (index,)
         with atomic_file(path, mode='wb', bufsize=4096 * 1024 * 16) as f:
             if self.compress:
-                have_data = self.write_compress_data(f, self.prev.iterator(split))
+                have_data = self.write_compress_data(f, self.prev.iterator(split), *args)
             else:
-                have_data = self.writedata(f, self.prev.iterator(split))
+                have_data = self.writedata(f, self.prev.iterator(split), *args)
 
             if not have_data:
                 raise AbortFileReplacement
 
         if os.path.exists(path):
+            if index:
+                self.write_index(path, index)
             yield path
 
+    def write_index(self, path, points):
+        "the .gzindex sidecar of the access points of a compressed file"
+        from dpark.gzindex import write_index as write_gz_index
+        write_gz_index(path, os.path.getsize(path), points)
+
     def writedata(self, f, lines):
         if not six.PY2:
             f = TextIOWrapper(f)
@@ -2071,71 +3065,84 @@ class OutputTextFileRDD(DerivedRDD):
             f.close()
         return True
 
-    def write_compress_data(self, f, lines):
+    def write_compress_data(self, f, lines, index=None):
+        # lines are joined and encoded in chunks of a block, the writer
+        # compresses the blocks on its threads meanwhile
         empty = True
-        with gzip.GzipFile(filename='', mode='w', fileobj=f) as f:
-            if not six.PY2:
-                f = TextIOWrapper(f)
-            size = 0
+        size = self.codec.block_size
+        with self.codec.writer(f) as w:
+            buf, n = [], 0
             for line in lines:
-                f.write(line)
                 if not line.endswith('\n'):
-                    f.write('\n')
-                size += len(line) + 1
-                if size >= 256 << 10:
-                    f.flush()
-                    f.compress = zlib.compressobj(9, zlib.DEFLATED,
-                        -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
-                    size = 0
+                    line += '\n'
+                buf.append(line)
+                n += len(line)
+                if n >= size:
+                    w.write(''.join(buf))
+                    buf, n = [], 0
                 empty = False
-            if not empty:
-                f.flush()
-            if not six.PY2:
-                f.close()
-
+            if buf:
+                w.write(''.join(buf))
+        if index is not None:
+            # every block of the gzip writer starts an access point
+            index.extend(getattr(w, 'points', ()))
         return not empty
 
 class OutputTfrecordstFileRDD(OutputTextFileRDD):
-    def __init__(self, rdd, path, ext, overwrite=True, compress=False):
-        OutputTextFileRDD.__init__(self, rdd=rdd, path=path, ext='.tfrecords', overwrite=overwrite, compress=compress)
-
-    def writedata(self, f, strings):
+    def __init__(self, rdd, path, ext, overwrite=True, compress=False, index=False, raw=False,
+                 codec=None):
+        OutputTextFileRDD.__init__(self, rdd=rdd, path=path, ext='.tfrecords', overwrite=overwrite,
+                                   compress=compress, codec=codec)
+        if self.codec is not None and not self.codec.tfrecords:
+            raise ValueError('TFRecords can not be written as %s files' % self.codec.name)
+        self.index = index and not self.compress
+        self.raw = raw
+
+    def encoder(self):
+        "the function from a record to its frame"
+        if self.raw:
+            return lambda string: string
+        from dpark.tfrecord import encode_frame
+        return lambda string: encode_frame(
+            string if isinstance(string, bytes) else str(string).encode())
+
+    def write_index(self, path, offsets):
+        "the .tfindex sidecar of the frame offsets"
+        from dpark.tfrecord import write_index
+        write_index(path, offsets)
+
+    def writedata(self, f, strings, index=None):
         empty = True
+        offsets = index
+        encode = self.encoder()
+        pos = 0
         for string in strings:
-            string_bytes = str(string).encode()
-            encoded_length = struct.pack('<Q', len(string_bytes))
-            f.write(encoded_length + struct.pack('<I', masked_crc32c(encoded_length)) +
-                       string_bytes + struct.pack('<I', masked_crc32c(string_bytes)))
+            frame = encode(string)
+            f.write(frame)
+            if offsets is not None:
+                offsets.append(pos)
+            pos += len(frame)
             empty = False
+        if offsets is not None:
+            offsets.append(pos)
         return not empty
 
     def write_compress_data(self, f, strings):
         empty = True
-        with gzip.GzipFile(filename='', mode='wb', fileobj=f) as f:
-            size = 0
+        encode = self.encoder()
+        with self.codec.writer(f) as w:
             for string in strings:
-                string_bytes = str(string).encode()
-                encoded_length = struct.pack('<Q', len(string_bytes))
-                f.write(encoded_length + struct.pack('<I', masked_crc32c(encoded_length)) +
-                        string_bytes + struct.pack('<I', masked_crc32c(string_bytes)))
-                size += len(str(string)) + 16
-                if size >= 256 << 10:
-                    f.flush()
-                    f.compress = zlib.compressobj(9, zlib.DEFLATED,
-                                                  -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
-                    size = 0
+                w.write(encode(string))
                 empty = False
-            if not empty:
-                f.flush()
-            if not six.PY2:
-                f.close()
         return not empty
 
 class MultiOutputTextFileRDD(OutputTextFileRDD):
     MAX_OPEN_FILES = 512
     BLOCK_SIZE = 256 << 10
+    CODECS = ('gzip',)  # appends gzip members
 
     def get_tpath(self, key):
+        import socket
         tpath = self.paths.get(key)
         if not tpath:
             dpath = os.path.join(self.path, str(key))
@@ -2147,6 +3154,7 @@ class MultiOutputTextFileRDD(OutputTextFileRDD):
         return tpath
 
     def get_file(self, key):
+        import gzip
         f = self.files.get(key)
         fileobj = getattr(f, 'fileobj', None)
         if hasattr(f, 'buffer'):
@@ -2163,7 +3171,8 @@ class MultiOutputTextFileRDD(OutputTextFileRDD):
                 if f:
                     f.fileobj = nf
                 else:
-                    f = gzip.GzipFile(filename='', mode='a+', fileobj=nf)
+                    f = gzip.GzipFile(filename='', mode='a+', fileobj=nf,
+                                      compresslevel=self.codec.level)
 
                 f.myfileobj = nf # force f.myfileobj.close() in f.close()
             else:
@@ -2178,7 +3187,7 @@ class MultiOutputTextFileRDD(OutputTextFileRDD):
     def flush_file(self, key, f):
         f.flush()
         if self.compress:
-            f.compress = zlib.compressobj(9, zlib.DEFLATED,
+            f.compress = zlib.compressobj(self.codec.level, zlib.DEFLATED,
                 -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
 
         if len(self.files) > self.MAX_OPEN_FILES:
@@ -2239,11 +3248,12 @@ class MultiOutputTextFileRDD(OutputTextFileRDD):
 
 
 class OutputCSVFileRDD(OutputTextFileRDD):
-    def __init__(self, rdd, path, dialect, overwrite, compress):
-        OutputTextFileRDD.__init__(self, rdd, path, '.csv', overwrite, compress)
+    def __init__(self, rdd, path, dialect, overwrite, compress, codec=None):
+        OutputTextFileRDD.__init__(self, rdd, path, '.csv', overwrite, compress, codec=codec)
         self.dialect = dialect
 
     def writedata(self, f, rows):
+        import csv
         if not six.PY2:
             f = TextIOWrapper(f)
 
@@ -2259,71 +3269,134 @@ class OutputCSVFileRDD(OutputTextFileRDD):
         return not empty
 
     def write_compress_data(self, f, rows):
+        import csv
         empty = True
-        with gzip.GzipFile(filename='', mode='w', fileobj=f) as f:
-            if not six.PY2:
-                f = TextIOWrapper(f)
-            writer = csv.writer(f, self.dialect)
-            last_flush = 0
+        size = self.codec.block_size
+        with self.codec.writer(f) as w:
+            buf = StringIO()
+            writer = csv.writer(buf, self.dialect)
             for row in rows:
                 if not isinstance(row, (tuple, list)):
                     row = (row,)
                 writer.writerow(row)
                 empty = False
-                if f.tell() - last_flush >= 256 << 10:
-                    f.flush()
-                    f.compress = zlib.compressobj(9, zlib.DEFLATED,
-                        -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
-                    last_flush = f.tell()
-            if not empty:
-                f.flush()
-            if not six.PY2:
-                f.close()
+                if buf.tell() >= size:
+                    w.write(buf.getvalue())
+                    buf.seek(0)
+                    buf.truncate()
+            if buf.tell():
+                w.write(buf.getvalue())
         return not empty
 
 class OutputBinaryFileRDD(OutputTextFileRDD):
-    def __init__(self, rdd, path, fmt, overwrite):
+    BATCH_ROWS = 64 << 10
+
+    def __init__(self, rdd, path, fmt, overwrite, dtype=None):
         OutputTextFileRDD.__init__(self, rdd, path, '.bin', overwrite)
+        assert bool(fmt) != (dtype is not None), "one of fmt and dtype must be provided"
         self.fmt = fmt
+        self.dtype = None
+        if dtype is not None:
+            import numpy
+            self.dtype = numpy.dtype(dtype)
 
     def writedata(self, f, rows):
+        if self.dtype is not None:
+            return self.write_arrays(f, rows)
         empty = True
+        pack = struct.Struct(self.fmt).pack
+        buf = []
         for row in rows:
             if isinstance(row, (tuple, list)):
-                f.write(struct.pack(self.fmt, *row))
+                buf.append(pack(*row))
             else:
-                f.write(struct.pack(self.fmt, row))
+                buf.append(pack(row))
+            if len(buf) >= self.BATCH_ROWS:
+                f.write(b''.join(buf))
+                buf = []
             empty = False
+        if buf:
+            f.write(b''.join(buf))
+        return not empty
+
+    def write_arrays(self, f, rows):
+        "arrays are written at once, single records in batches of BATCH_ROWS"
+        import numpy
+        dtype = self.dtype
+
+        def write(a):
+            # the buffer of the array is written as is, without a bytes copy
+            a = numpy.ascontiguousarray(a, dtype=dtype)
+            f.write(memoryview(a.reshape(-1).view(numpy.uint8)))
+
+        empty = True
+        records = []
+        for row in rows:
+            empty = False
+            if isinstance(row, numpy.ndarray) and row.ndim > 0:
+                if records:
+                    write(numpy.array(records, dtype))
+                    records = []
+                write(row)
+                continue
+            records.append(tuple(row) if isinstance(row, list) else row)
+            if len(records) >= self.BATCH_ROWS:
+                write(numpy.array(records, dtype))
+                records = []
+        if records:
+            write(numpy.array(records, dtype))
         return not empty
 
 class OutputTableFileRDD(OutputTextFileRDD):
     MAGIC = b'\x00\xDE\x00\xAD\xFF\xBE\xFF\xEF'
     BLOCK_SIZE = 256 << 10 # 256K
 
-    def __init__(self, rdd, path, overwrite=True, compress=True):
+    def __init__(self, rdd, path, overwrite=True, compress=True, codec=None, stats=False):
+        from dpark.codec import get_codec
         OutputTextFileRDD.__init__(self, rdd, path, ext='.tab', overwrite=overwrite, compress=False)
-        self.compress = compress
+        if codec is None:
+            codec = 'zlib' if compress is True else compress
+        self.block_codec = codec = get_codec(codec)
+        if codec is not None and codec.table_flag is None:
+            raise ValueError('table blocks can not be compressed by %s' % codec.name)
+        self.stats = stats
 
     def writedata(self, f, rows):
+        from dpark.tablefooter import ColumnStats, write_footer
         import msgpack
-        def flush(buf):
+        codec = self.block_codec
+        flag = codec.table_flag if codec is not None else 0
+        blocks = []
+        stats_columns = None if self.stats is True else self.stats
+
+        def flush(buf, stats):
             d = buf.getvalue()
-            if self.compress:
-                d = zlib.compress(d, 1)
+            if codec is not None:
+                d = codec.compress(d)
+            offset = f.tell()
             f.write(self.MAGIC)
-            f.write(struct.pack("III", self.compress, count, len(d)))
+            f.write(struct.pack("III", flag, count, len(d)))
             f.write(d)
+            blocks.append((offset, count, f.tell() - offset,
+                           stats.dump() if stats is not None else None))
+
+        def new_stats():
+            return ColumnStats(stats_columns) if self.stats else None
 
-        count, buf = 0, BytesIO()
+        count, buf, stats = 0, BytesIO(), new_stats()
         for row in rows:
             msgpack.pack(row, buf)
+            if stats is not None:
+                stats.add(row)
             count += 1
             if buf.tell() > self.BLOCK_SIZE:
-                flush(buf)
-                count, buf = 0, BytesIO()
+                flush(buf, stats)
+                count, buf, stats = 0, BytesIO(), new_stats()
 
         if count > 0:
-            flush(buf)
+            flush(buf, stats)
+        if blocks:
+            write_footer(f, blocks)
 
         return f.tell() > 0
 
@@ -2333,6 +3406,7 @@ class OutputTableFileRDD(OutputTextFileRDD):
 class BeansdbFileRDD(TextFileRDD):
 
     def __init__(self, ctx, path, filter=None, fullscan=False, raw=False):
+        from dpark.beansdb import BeansdbReader
         key_filter = filter
         if key_filter is None:
             fullscan = True
@@ -2348,6 +3422,7 @@ class OutputBeansdbRDD(DerivedRDD):
 
     def __init__(self, rdd, path, depth, overwrite, compress=False,
                  raw=False, value_with_meta=False):
+        from dpark.beansdb import BeansdbWriter
         DerivedRDD.__init__(self, rdd)
         self.writer = BeansdbWriter(path, depth, overwrite, compress,
                                     raw, value_with_meta)
@@ -1,78 +1,331 @@
+# -*- coding: utf-8 -*-
+"""Standalone TFRecord reader and writer
+
+    with TFRecordWriter('out.tfrecords') as w:
+        w.write(b'record')
+
+    for record in TFRecordReader('out.tfrecords'):
+        ...
+
+Only needs `crc32c` or `crcmod` for the checksums, neither dpark,
+pyximport nor TensorFlow is imported. Files are read and written in
+large buffers, records are framed as
+
+    uint64 length, uint32 masked_crc32c(length), byte data[length], uint32 masked_crc32c(data)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import gzip
+import zlib
 import struct
-import crcmod
-# import codecs
+
+HEADER_SIZE = 12
+FOOTER_SIZE = 4
+FRAME_OVERHEAD = HEADER_SIZE + FOOTER_SIZE
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+COMPRESSIONS = (None, 'gzip', 'zlib')
+
 
 def _default_crc32c_fn(value):
     if not _default_crc32c_fn.fn:
-        _default_crc32c_fn.fn = crcmod.predefined.mkPredefinedCrcFun('crc-32c')
+        try:
+            from crc32c import crc32c
+            _default_crc32c_fn.fn = crc32c
+        except ImportError:
+            import crcmod.predefined
+            _default_crc32c_fn.fn = crcmod.predefined.mkPredefinedCrcFun('crc-32c')
     return _default_crc32c_fn.fn(value)
 
+_default_crc32c_fn.fn = None
+
+
 def _masked_crc32c(value, crc32c_fn=_default_crc32c_fn):
     crc = crc32c_fn(value)
-    """ Some alternative methods """
-    # crc = zlib.crc32(value)
-    # crc = binascii.crc32(value)
     return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
 
+
 def encoded_num_bytes(record):
     """Return the number of bytes consumed by a record in its encoded form."""
-    # 16 = 8 (Length) + 4 (crc of length) + 4 (crc of data)
-    return len(record) + 16
+    return len(record) + FRAME_OVERHEAD
+
+
+def encode_record(record):
+    length = struct.pack('<Q', len(record))
+    return b''.join([length, struct.pack('<I', _masked_crc32c(length)),
+                     record, struct.pack('<I', _masked_crc32c(record))])
+
+
+def _compression_of(path, compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError('unknown compression: %r' % (compression,))
+    if compression is None and isinstance(path, str) and path.endswith('.gz'):
+        return 'gzip'
+    return compression
+
+
+def _read_at_least(read, need, size):
+    """Call read(size) until at least need bytes are read or the stream
+    ends, as pipes, sockets and some network files return short reads."""
+    data = read(size)
+    if len(data) >= need or not data:
+        return data
+    chunks = [data]
+    n = len(data)
+    while n < need:
+        data = read(max(size, need) - n)
+        if not data:
+            break
+        chunks.append(data)
+        n += len(data)
+    return b''.join(chunks)
+
+
+class _ZlibWriter(object):
+    "file-like zlib stream on top of f, close() ends the stream but keeps f open"
+    def __init__(self, f, level):
+        self.f = f
+        self.z = zlib.compressobj(level)
+
+    def write(self, d):
+        self.f.write(self.z.compress(d))
+
+    def flush(self):
+        self.f.write(self.z.flush(zlib.Z_SYNC_FLUSH))
+        self.f.flush()
+
+    def close(self):
+        self.f.write(self.z.flush())
+
+
+class _ZlibReader(object):
+    "file-like reader of a zlib stream in f"
+    def __init__(self, f, buffer_size):
+        self.f = f
+        self.z = zlib.decompressobj()
+        self.buffer_size = buffer_size
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            if self.z.unconsumed_tail:
+                d = self.z.decompress(self.z.unconsumed_tail, size)
+            else:
+                c = self.f.read(self.buffer_size)
+                if not c:
+                    d = self.z.flush()
+                    if not d:
+                        break
+                else:
+                    d = self.z.decompress(c, size)
+            chunks.append(d)
+            size -= len(d)
+        return b''.join(chunks)
+
+    def close(self):
+        pass
+
+
+class TFRecordWriter(object):
+    """ Write records to a TFRecord file
+
+        path: file name, or a binary file object opened for writing
+        compression: None, 'gzip' or 'zlib', gzip by default for '*.gz'
+        buffer_size: frames are written in batches of about this size
+
+        write() returns the offset of the record in the uncompressed
+        stream, all of them are kept in `offsets` when track_offsets is set.
+    """
+
+    def __init__(self, path, compression=None, buffer_size=DEFAULT_BUFFER_SIZE,
+                 compresslevel=6, track_offsets=False):
+        compression = _compression_of(path, compression)
+        self._own = not hasattr(path, 'write')
+        self._file = f = open(path, 'wb') if self._own else path
+        if compression == 'gzip':
+            f = gzip.GzipFile(mode='wb', fileobj=f, compresslevel=compresslevel)
+        elif compression == 'zlib':
+            f = _ZlibWriter(f, compresslevel)
+        self.f = f
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.offsets = [] if track_offsets else None
+        self._buf = []
+        self._buffered = 0
+        self._pos = 0
+
+    def write(self, record):
+        frame = encode_record(record)
+        offset = self._pos
+        self._pos += len(frame)
+        if self.offsets is not None:
+            self.offsets.append(offset)
+        self._buf.append(frame)
+        self._buffered += len(frame)
+        if self._buffered >= self.buffer_size:
+            self._write_buffer()
+        return offset
+
+    def tell(self):
+        """ size of the uncompressed stream written so far """
+        return self._pos
+
+    def _write_buffer(self):
+        if self._buf:
+            self.f.write(b''.join(self._buf))
+            self._buf = []
+            self._buffered = 0
+
+    def flush(self):
+        self._write_buffer()
+        self.f.flush()
+
+    def close(self):
+        if self.f is None:
+            return
+        self._write_buffer()
+        if self.f is not self._file:
+            self.f.close()  # ends the compressed stream, the file stays open
+        if self._own:
+            self._file.close()
+        else:
+            self._file.flush()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TFRecordReader(object):
+    """ Iterate the records of a TFRecord file
+
+        path: file name, or a binary file object opened for reading
+        compression: None, 'gzip' or 'zlib', gzip by default for '*.gz'
+        with_offsets: yield (offset, record), offset is in the uncompressed stream
+        check_crc: verify the crc of payloads, the length crc is always checked
+
+        Raises ValueError on a corrupted or truncated frame.
+    """
+
+    def __init__(self, path, compression=None, buffer_size=DEFAULT_BUFFER_SIZE,
+                 with_offsets=False, check_crc=True):
+        compression = _compression_of(path, compression)
+        self._own = not hasattr(path, 'read')
+        self._file = f = open(path, 'rb') if self._own else path
+        if compression == 'gzip':
+            f = gzip.GzipFile(mode='rb', fileobj=f)
+        elif compression == 'zlib':
+            f = _ZlibReader(f, buffer_size)
+        self.f = f
+        self.buffer_size = buffer_size
+        self.with_offsets = with_offsets
+        self.check_crc = check_crc
+
+    def __iter__(self):
+        read = self.f.read
+        unpack_from = struct.unpack_from
+        crc = _masked_crc32c
+        check_crc = self.check_crc
+        with_offsets = self.with_offsets
+        buf = b''
+        pos = offset = 0
+        while True:
+            if len(buf) - pos < HEADER_SIZE:
+                buf = buf[pos:] + _read_at_least(read, HEADER_SIZE - len(buf) + pos,
+                                                 self.buffer_size)
+                pos = 0
+                if len(buf) < HEADER_SIZE:
+                    if buf:
+                        raise ValueError('Not a valid TFRecord. Fewer than %d bytes at %d'
+                                         % (HEADER_SIZE, offset))
+                    return
+
+            length, length_mask_expected = unpack_from('<QI', buf, pos)
+            if crc(buf[pos:pos + 8]) != length_mask_expected:
+                raise ValueError('Not a valid TFRecord. Mismatch of length mask at %d' % offset)
+
+            end = pos + length + FRAME_OVERHEAD
+            if end > len(buf):
+                buf = buf[pos:]
+                buf += _read_at_least(read, end - pos - len(buf), self.buffer_size)
+                pos, end = 0, length + FRAME_OVERHEAD
+                if end > len(buf):
+                    raise ValueError('Not a valid TFRecord. Fewer than %d bytes at %d'
+                                     % (end, offset))
+
+            data = buf[pos + HEADER_SIZE:end - FOOTER_SIZE]
+            if check_crc:
+                data_mask_expected, = unpack_from('<I', buf, end - FOOTER_SIZE)
+                if crc(data) != data_mask_expected:
+                    raise ValueError('Not a valid TFRecord. Mismatch of data mask at %d' % offset)
+
+            yield (offset, data) if with_offsets else data
+            offset += end - pos
+            pos = end
+
+    def close(self):
+        if self.f is not self._file:
+            self.f.close()
+        if self._own:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-def write2tfrcd(filename):
-    print("Start!")
-    string_value1 = b"this is a test string"
-    string_value2 = b"the second string"
-    encoded_length1 = struct.pack('<Q', len(string_value1))
-    encoded_length2 = struct.pack('<Q', len(string_value2))
-    file_handle = open(filename, 'wb')
-    file_handle.write(encoded_length1 + struct.pack('<I', _masked_crc32c(encoded_length1))
-                          + string_value1 + struct.pack('<I', _masked_crc32c(string_value1)))
-    file_handle.write(
-        encoded_length2 + struct.pack('<I', _masked_crc32c(encoded_length2)) +
-        string_value2 + struct.pack('<I', _masked_crc32c(string_value2)))
-    file_handle.close()
 
 def read_single_rcd(file_handle):
-    # file_handle=open(filename,'rb')
-    buf_length_expected = 12
-    buf = file_handle.read(buf_length_expected)
+    """Read and check one record at the current position, None at EOF."""
+    buf_length_expected = HEADER_SIZE
+    buf = _read_at_least(file_handle.read, buf_length_expected, buf_length_expected)
     if not buf:
         return None  # EOF Reached.
     # Validate all length related payloads.
     if len(buf) != buf_length_expected:
         raise ValueError('Not a valid TFRecord. Fewer than %d bytes: %s' %
-                             (buf_length_expected, buf))
+                         (buf_length_expected, buf))
     length, length_mask_expected = struct.unpack('<QI', buf)
     length_mask_actual = _masked_crc32c(buf[:8])
     if length_mask_actual != length_mask_expected:
         raise ValueError('Not a valid TFRecord. Mismatch of length mask: %s' % buf)
     # Validate all data related payloads.
-    buf_length_expected = length + 4
-    buf = file_handle.read(buf_length_expected)
+    buf_length_expected = length + FOOTER_SIZE
+    buf = _read_at_least(file_handle.read, buf_length_expected, buf_length_expected)
     if len(buf) != buf_length_expected:
         raise ValueError('Not a valid TFRecord. Fewer than %d bytes: %s' %
-                             (buf_length_expected, buf))
+                         (buf_length_expected, buf))
     data, data_mask_expected = struct.unpack('<%dsI' % length, buf)
     data_mask_actual = _masked_crc32c(data)
     if data_mask_actual != data_mask_expected:
-            raise ValueError('Not a valid TFRecord. Mismatch of data mask: %s' % buf)  # codecs.encode(buf, 'hex')
-    print(data)
+        raise ValueError('Not a valid TFRecord. Mismatch of data mask')
     # All validation checks passed.
     return data
 
-def read_records(file_name):
-    current_offset = 0
-    with open(file_name, 'rb') as file_handle:
-        while True:
-            file_handle.seek(current_offset)
-            record = read_single_rcd(file_handle)
-            if record is None:
-                return  # Reached EOF
-            else:
-                current_offset += encoded_num_bytes(record)
 
-if __name__=='__main__':
-    _default_crc32c_fn.fn = None
-    # write2tfrcd("2str_test.tfrecords")
-    read_records("2str_test.tfrecords")
\ No newline at end of file
+def read_records(file_name, **kw):
+    """Yield the records of file_name, see TFRecordReader for kw."""
+    with TFRecordReader(file_name, **kw) as reader:
+        for record in reader:
+            yield record
+
+
+def write_records(file_name, records, **kw):
+    """Write records to file_name, see TFRecordWriter for kw."""
+    with TFRecordWriter(file_name, **kw) as writer:
+        for record in records:
+            writer.write(record)
+
+
+def write2tfrcd(filename):
+    write_records(filename, [b"this is a test string", b"the second string"])
+
+
+if __name__ == '__main__':
+    import sys
+    for record in read_records(sys.argv[1] if len(sys.argv) > 1 else "2str_test.tfrecords"):
+        print(record)
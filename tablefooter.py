@@ -0,0 +1,159 @@
+# Footer index of table files
+#
+# OutputTableFileRDD ends a .tab file with
+#
+#   msgpack [VERSION, [[offset, rows, size, stats], ...]], uint64 its length, FOOTER_MAGIC
+#
+# one entry per block, size includes the block header. stats is None or
+# a list with [min, max] (or None) of every row column, they are kept
+# for columns of numbers, strings and bytes; None and NaN values are
+# left out.
+# Readers without footer support stop at it, it does not start with the
+# block magic.
+#
+# A predicate is a list of (column, op, value) conditions which all must
+# hold, op is one of OPS. A block is skipped when its stats show that no
+# row of it can match.
+from __future__ import absolute_import
+import struct
+import operator
+
+import six
+
+VERSION = 1
+FOOTER_MAGIC = b'DPTABFT1'
+TRAILER = struct.Struct('<Q8s')
+STAT_TYPES = six.integer_types + (float, six.text_type, bytes)
+
+OPS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda v, values: v in values,
+}
+
+
+class ColumnStats(object):
+    """ min and max of the columns of the rows of a block
+
+        columns: indices to keep stats of, None for all
+    """
+
+    def __init__(self, columns=None):
+        self.columns = columns
+        self.bounds = {}    # column: [min, max], or None if not comparable
+
+    def add(self, row):
+        if not isinstance(row, (tuple, list)):
+            return
+        bounds = self.bounds
+        n = len(row)
+        for i in (self.columns if self.columns is not None else range(n)):
+            if i >= n:
+                continue
+            v = row[i]
+            if v is None or isinstance(v, float) and v != v:
+                continue    # NaN compares False to everything
+            b = bounds.get(i, False)
+            if b is False:
+                bounds[i] = [v, v] if isinstance(v, STAT_TYPES) else None
+            elif b is not None:
+                try:
+                    if v < b[0]:
+                        b[0] = v
+                    elif v > b[1]:
+                        b[1] = v
+                except TypeError:
+                    bounds[i] = None
+
+    def dump(self):
+        "stats of the block, as stored in the footer"
+        if not self.bounds:
+            return None
+        return [self.bounds.get(i) for i in range(max(self.bounds) + 1)]
+
+
+def write_footer(f, blocks):
+    """ blocks are (offset, rows, size, stats) """
+    import msgpack
+    d = msgpack.packb([VERSION, [list(b) for b in blocks]])
+    f.write(d)
+    f.write(TRAILER.pack(len(d), FOOTER_MAGIC))
+
+
+def read_footer(f, size):
+    """ [(offset, rows, size, stats)] of the blocks of a table file of
+        size bytes, None if it has no footer """
+    import msgpack
+    if size < TRAILER.size:
+        return None
+    f.seek(size - TRAILER.size)
+    length, magic = TRAILER.unpack(f.read(TRAILER.size))
+    if magic != FOOTER_MAGIC or length > size - TRAILER.size:
+        return None
+    f.seek(size - TRAILER.size - length)
+    version, blocks = msgpack.unpackb(f.read(length))
+    if version != VERSION:
+        return None
+    return [tuple(b) for b in blocks]
+
+
+def parse_predicate(predicate):
+    " a list of (column, op, value), a single condition is accepted too "
+    if not predicate:
+        return []
+    if isinstance(predicate, tuple) and len(predicate) == 3 and predicate[1] in OPS:
+        predicate = [predicate]
+    conditions = []
+    for column, op, value in predicate:
+        if op not in OPS:
+            raise ValueError('unknown operator %r, choose from %s' % (op, ' '.join(sorted(OPS))))
+        if op == 'in':
+            value = list(value)
+        conditions.append((column, op, value))
+    return conditions
+
+
+def _may_match(lo, hi, op, value):
+    if op == '==':
+        return lo <= value <= hi
+    if op == '<':
+        return lo < value
+    if op == '<=':
+        return lo <= value
+    if op == '>':
+        return hi > value
+    if op == '>=':
+        return hi >= value
+    if op == 'in':
+        return any(lo <= v <= hi for v in value)
+    return True
+
+
+def block_may_match(stats, predicate):
+    "whether some row of a block with stats may match predicate"
+    if not stats:
+        return True
+    for column, op, value in predicate:
+        if column >= len(stats) or stats[column] is None:
+            continue
+        lo, hi = stats[column]
+        try:
+            if not _may_match(lo, hi, op, value):
+                return False
+        except TypeError:
+            pass
+    return True
+
+
+def row_matches(row, predicate):
+    for column, op, value in predicate:
+        try:
+            if not OPS[op](row[column], value):
+                return False
+        except (TypeError, IndexError):
+            return False
+    return True
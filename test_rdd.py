@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 import os
 import sys
+import six
 from six.moves import map
 from six.moves import range
 from six.moves import zip
@@ -18,12 +19,24 @@ import tempfile
 import contextlib
 from dpark.context import *
 from dpark.rdd import *
+from dpark.tfrecord import (TFRecordFile, index_path, load_index, count_records,
+                            compactTFRecords)
 from dpark.beansdb import is_valid_key, restore_value
 from dpark.accumulator import *
 from tempfile import mkdtemp
 from dpark.serialize import loads, dumps
 from dpark.nested_groupby import GroupByNestedIter, list_values, list_value
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # to see task fail reason, have to set logging level
 # logging.getLogger('dpark').setLevel(logging.INFO)
 logging.getLogger('dpark').setLevel(logging.ERROR)
@@ -101,6 +114,48 @@ class TestRDD(unittest.TestCase):
         self.assertEqual(list(slices[1]), list(range(2, 4)))
         self.assertEqual(list(slices[2]), list(range(4, 5)))
 
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_parallel_collection_buffers(self):
+        a = numpy.arange(100000, dtype='f8').reshape(-1, 2)
+        slices = ParallelCollection.slice(a, 3)
+        self.assertTrue(all(s.base is a for s in slices))
+        rdd = self.sc.makeRDD(a, 3)
+        self.assertEqual(rdd.mapPartitions(lambda it: [type(it).__name__]).collect(),
+                         ['ndarray'] * 3)
+        self.assertEqual(rdd.map(lambda r: r[1]).reduce(operator.add), a[:, 1].sum())
+        self.assertEqual(rdd.count(), len(a))
+
+        d = b'dpark' * 1000
+        self.assertEqual(self.sc.makeRDD(d, 4).collect(), list(d))
+
+        # rows may be changed in place, without changing the next task's
+        def inc(r):
+            r += 1
+            return r[0]
+        for _ in range(2):
+            self.assertEqual(rdd.map(inc).reduce(operator.add), a[:, 0].sum() + len(a))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_parallel_collection_shared(self):
+        from dpark.context import _shutdown
+        from dpark.buffers import shared_memory_available
+        _shutdown()
+        sc = DparkContext('process')
+        try:
+            a = numpy.arange(100000, dtype='i8')
+            rdd = sc.makeRDD(a, 4)
+            if shared_memory_available():
+                self.assertTrue(all(s.shared is not None for s in rdd.splits))
+            self.assertEqual(rdd.reduce(operator.add), a.sum())
+
+            def inc(it):
+                it += 1
+                return [int(it.sum())]
+            for _ in range(2):
+                self.assertEqual(sum(rdd.mapPartitions(inc).collect()), a.sum() + len(a))
+        finally:
+            _shutdown()
+
     def test_basic_operation(self):
         d = list(range(4))
         nums = self.sc.makeRDD(d, 2)
@@ -375,6 +430,373 @@ class TestRDD(unittest.TestCase):
             self.assertEqual(rd.count(), N)
             self.assertEqual(rd.map(lambda x: int(x)).reduce(lambda x, y: x + y), sum(range(N)))
 
+    def test_tfrecord_headers(self):
+        N = 1000
+        d = self.sc.makeRDD(list(("the %d string" % i) for i in range(N)), 1)
+        with temppath("tfout") as path:
+            d.saveAsTFRecordsFile(path)
+            rd = TfrecordsRDD(self.sc, os.path.join(path, '0000.tfrecords'), splitSize=1<<10)
+            self.assertEqual(rd.count(), N)
+            st = rd.stat()
+            self.assertEqual(st['records'], N)
+            self.assertEqual(st['bytes'], sum(len("the %d string" % i) for i in range(N)))
+            self.assertEqual(st['frame_bytes'], os.path.getsize(os.path.join(path, '0000.tfrecords')))
+            self.assertEqual(st['min_size'], len("the 0 string"))
+            self.assertEqual(st['max_size'], len("the 999 string"))
+
+    def test_tfrecord_large_records(self):
+        # records larger than DEFAULT_READ_SIZE, so split points sit past the first read
+        N = 300
+        records = ['%d:' % i + 'x' * (2000 + i * 7) for i in range(N)]
+        d = self.sc.makeRDD(records, 1)
+        with temppath("tfout") as path:
+            d.saveAsTFRecordsFile(path)
+            p = os.path.join(path, '0000.tfrecords')
+            for splitSize in (5 << 10, 100 << 10):
+                rd = TfrecordsRDD(self.sc, p, splitSize=splitSize)
+                self.assertTrue(len(rd) > 1)
+                self.assertEqual(rd.count(), N)
+                self.assertEqual(rd.collect(), records)
+                self.assertEqual([n for _, n in rd.headers().collect()],
+                                 [len(r) for r in records])
+
+    def test_tfrecord_random_access(self):
+        N = 1000
+        d = self.sc.makeRDD(list(("the %d string" % i) for i in range(N)), 1)
+        with temppath("tfout") as path:
+            d.saveAsTFRecordsFile(path, index=True)
+            p = os.path.join(path, '0000.tfrecords')
+            self.assertTrue(os.path.exists(index_path(p)))
+            rd = TfrecordsRDD(self.sc, p)
+            self.assertEqual(rd.getRecord(10), "the 10 string")
+            self.assertEqual(rd.getRecord(-1), "the 999 string")
+            self.assertEqual(rd.getRecords([3, 1, 4, 1, 500]),
+                             ["the %d string" % i for i in [3, 1, 4, 1, 500]])
+            with TFRecordFile(p) as tf:
+                self.assertEqual(len(tf), N)
+                self.assertEqual(tf[7], b"the 7 string")
+                self.assertEqual(tf[998:], [b"the 998 string", b"the 999 string"])
+                self.assertRaises(IndexError, lambda: tf[N])
+
+        # every split writes the index of its own file
+        d = self.sc.makeRDD(list(("the %d string" % i) for i in range(N)), 3)
+        with temppath("tfout") as path:
+            files = d.saveAsTFRecordsFile(path, index=True)
+            records = []
+            for p in files:
+                offsets = load_index(p, os.path.getsize(p))
+                self.assertEqual(offsets[-1], os.path.getsize(p))
+                with TFRecordFile(p) as tf:
+                    self.assertEqual(tf.offsets[:], offsets)
+                    records.extend(tf[:])
+                self.assertEqual(count_records(p), len(offsets) - 1)
+            self.assertEqual(records, [b"the %d string" % i for i in range(N)])
+
+            # counted from the headers without an index, which is written back
+            os.remove(index_path(files[0]))
+            with TFRecordFile(files[0]) as tf:
+                self.assertEqual(count_records(files[0]), len(tf))
+            self.assertEqual(load_index(files[0], os.path.getsize(files[0])), tf.offsets)
+            self.assertRaises(ValueError, TFRecordFile, files[1], offsets=[])
+
+    def test_tfrecord_shuffled(self):
+        N = 1000
+        expected = ["the %d string" % i for i in range(N)]
+        d = self.sc.makeRDD(expected, 1)
+        with temppath("tfout") as path:
+            d.saveAsTFRecordsFile(path, index=True)
+            rd = TfrecordsRDD(self.sc, os.path.join(path, '0000.tfrecords'), splitSize=1<<10)
+            r1 = rd.shuffled(seed=1, epoch=0).collect()
+            self.assertNotEqual(r1, expected)
+            self.assertEqual(sorted(r1), sorted(expected))
+            self.assertEqual(rd.shuffled(seed=1, epoch=0, numSplits=3).collect(), r1)
+            r2 = rd.shuffled(seed=1, epoch=1).collect()
+            self.assertNotEqual(r2, r1)
+            self.assertEqual(sorted(r2), sorted(expected))
+            r3 = rd.shuffled(seed=1, epoch=0, window=100).collect()
+            self.assertNotEqual(r3, expected)
+            self.assertEqual(sorted(r3), sorted(expected))
+
+    def test_tfrecord_sample(self):
+        N = 1000
+        d = self.sc.makeRDD(list(("the %d string" % i) for i in range(N)), 1)
+        with temppath("tfout") as path:
+            for index in (False, True):
+                d.saveAsTFRecordsFile(path, index=index)
+                rd = TfrecordsRDD(self.sc, os.path.join(path, '0000.tfrecords'), splitSize=1<<10)
+                expected = SampleRDD(rd, 0.1, False, 12345).collect()
+                self.assertTrue(0 < len(expected) < N)
+                self.assertEqual(rd.sample(0.1).collect(), expected)
+
+                # a corrupt payload ends the split, as it does without sampling
+                p = os.path.join(path, '0000.tfrecords')
+                with open(p, 'rb') as f:
+                    data = f.read()
+                with open(p, 'wb') as f:
+                    f.write(data.replace(b'the 500 string', b'the 500 strong'))
+                rd = TfrecordsRDD(self.sc, p).with_metrics()
+                before = ["the %d string" % i for i in range(500)]
+                self.assertEqual(rd.collect(), before)
+                self.assertEqual(rd.sample(1.0).collect(), before)
+                self.assertEqual(sum(v['corrupt_frames'] for v in rd.metrics().values()), 1)
+
+    def test_tfrecord_shard(self):
+        N = 1000
+        expected = ["the %d string" % i for i in range(N)]
+        d = self.sc.makeRDD(expected, 3)
+        with temppath("tfout") as path:
+            d.saveAsTFRecordsFile(path, index=True)
+            paths = [os.path.join(path, '%04d.tfrecords' % i) for i in range(3)]
+            rd = TfrecordsRDD(self.sc, paths[0])
+            shares = [rd.shard(3, w).collect() for w in range(3)]
+            self.assertEqual([len(s) for s in shares], [111, 111, 112])
+            self.assertEqual(sum(shares, []), expected[:334])
+            # every worker gets a share of a single file, whatever the mode
+            for by in ('record', 'file', 'block'):
+                shares = [rd.shard(3, w, by=by).collect() for w in range(3)]
+                self.assertTrue(all(shares))
+                self.assertEqual(sorted(sum(shares, [])), sorted(expected[:334]))
+
+            for by in ('record', 'file', 'block'):
+                shares = [ShardedTfrecordsRDD(self.sc, paths, 4, w, by=by, blockSize=10).collect()
+                          for w in range(4)]
+                self.assertEqual(sorted(sum(shares, [])), sorted(expected))
+                spread = max(map(len, shares)) - min(map(len, shares))
+                if by == 'record':
+                    self.assertTrue(spread <= 1)
+                elif by == 'block':
+                    self.assertTrue(spread <= 2 * 10)
+            self.assertRaises(ValueError, lambda: rd.shard(3, 3))
+
+    def test_io_metrics(self):
+        N = 1000
+        d = self.sc.makeRDD(list(("the %d string" % i) for i in range(N)), 1)
+        with temppath("tfout") as path:
+            d.saveAsTFRecordsFile(path)
+            p = os.path.join(path, '0000.tfrecords')
+            rd = TfrecordsRDD(self.sc, p, splitSize=1<<10).with_metrics()
+            self.assertEqual(rd.count(), N)
+            m = rd.metrics()
+            self.assertEqual(sorted(m), list(range(len(rd))))
+            self.assertEqual(sum(v['records'] for v in m.values()), N)
+            self.assertTrue(sum(v['bytes_read'] for v in m.values()) > 0)
+            self.assertEqual(sum(v['corrupt_frames'] for v in m.values()), 0)
+
+            # sampled frames are read by the sample, and counted all the same
+            rd = TfrecordsRDD(self.sc, p, splitSize=1<<10).with_metrics()
+            n = rd.sample(0.5, seed=1).count()
+            m = rd.metrics()
+            self.assertEqual(sum(v['records'] for v in m.values()), n)
+            self.assertTrue(sum(v['bytes_read'] for v in m.values()) > 0)
+
+        with temppath('tout') as path:
+            d.saveAsTextFile(path)
+            rd = TextFileRDD(self.sc, os.path.join(path, '0000'), splitSize=1<<10)
+            self.assertEqual(rd.metrics(), {})
+            rd.with_metrics()
+            self.assertEqual(rd.count(), N)
+            self.assertEqual(sum(v['records'] for v in rd.metrics().values()), N)
+
+        with temppath('tabout') as path:
+            d.map(lambda x: (x,)).saveAsTableFile(path)
+            rd = self.sc.tableFile(path, splitSize=1<<10).with_metrics()
+            self.assertEqual(rd.count(), N)
+            m = rd.metrics()
+            self.assertEqual(sum(v['records'] for v in m.values()), N)
+            self.assertTrue(sum(v['bytes_read'] for v in m.values()) > 0)
+
+        with temppath('bout') as path:
+            self.sc.makeRDD(list(range(N)), 1).saveAsBinaryFile(path, fmt='I')
+            rd = BinaryFileRDD(self.sc, os.path.join(path, '0000.bin'), fmt='I',
+                               splitSize=1<<10).with_metrics()
+            self.assertEqual(rd.count(), N)
+            m = rd.metrics()
+            self.assertEqual(sum(v['records'] for v in m.values()), N)
+            self.assertEqual(sum(v['bytes_read'] for v in m.values()), N * 4)
+
+            class Unmetered(BinaryFileRDD):
+                def compute(self, split):
+                    return BinaryFileRDD.compute(self, split)
+
+            # rather than silently report nothing
+            rd = Unmetered(self.sc, os.path.join(path, '0000.bin'), fmt='I')
+            self.assertRaises(ValueError, rd.with_metrics)
+
+    def test_tfrecord_raw(self):
+        N = 1000
+        expected = ["the %d string" % i for i in range(N)]
+        d = self.sc.makeRDD(expected, 4)
+        with temppath("tfout") as path, temppath("tfcopy") as copy, temppath("tfcompact") as compact:
+            files = d.saveAsTFRecordsFile(path)
+            rd = TfrecordsRDD(self.sc, files[0], splitSize=1<<10, raw=True)
+            frames = rd.collect()
+            self.assertEqual(len(frames), N // 4)
+            self.assertTrue(all(isinstance(f, bytes) for f in frames))
+            self.assertEqual(rd.getRecords([-1, 0]), [frames[-1], frames[0]])
+            rd.saveAsTFRecordsFile(copy, raw=True, index=True)
+            out = os.path.join(copy, '0000.tfrecords')
+            with open(out, 'rb') as f1, open(files[0], 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+            self.assertEqual(TfrecordsRDD(self.sc, out).getRecord(-1), expected[N // 4 - 1])
+
+            shards = compactTFRecords(path, compact, target_bytes=8 << 10, index=True)
+            self.assertTrue(len(shards) > 1)
+            self.assertTrue(all(os.path.getsize(p) <= 8 << 10 for p in shards))
+            self.assertTrue(all(os.path.exists(index_path(p)) for p in shards))
+            self.assertEqual(sum((TfrecordsRDD(self.sc, p).collect() for p in shards), []),
+                             expected)
+
+    def test_tfrecord_tool(self):
+        from dpark import tfrecord_tool
+        N = 100
+        d = self.sc.makeRDD(list(("the %d string" % i) for i in range(N)), 2)
+        with temppath("tfout") as path:
+            files = d.saveAsTFRecordsFile(path)
+            self.assertEqual(tfrecord_tool.expand_paths([path]), files)
+            st = tfrecord_tool.stat_file(files[0])
+            self.assertEqual(st['records'], N // 2)
+            self.assertEqual(st['error'], None)
+            self.assertEqual(tfrecord_tool.verify_file(files[1]), (files[1], N // 2, None))
+            self.assertEqual(tfrecord_tool.index_file(files[0]), (files[0], N // 2, None))
+            self.assertTrue(os.path.exists(index_path(files[0])))
+            self.assertEqual(tfrecord_tool.expand_paths([path]), files)
+            self.assertEqual(tfrecord_tool.index_file(files[0]), (files[0], None, None))
+
+            with open(files[1], 'r+b') as f:
+                f.seek(100)
+                f.write(b'\xff')
+            path_, n, error = tfrecord_tool.verify_file(files[1])
+            self.assertTrue(n < N // 2)
+            self.assertTrue(error)
+        self.assertEqual(tfrecord_tool.parse_range('3:5'), slice(3, 5))
+        self.assertEqual(tfrecord_tool.parse_range('-1'), slice(-1, None))
+
+    def test_tfrecord_tool_compressed(self):
+        import io
+        from dpark import tfrecord_tool
+        N = 100
+        expected = ["the %d string" % i for i in range(N)]
+        d = self.sc.makeRDD(expected, 1)
+        with temppath("tfout") as path:
+            plain, = d.saveAsTFRecordsFile(path)
+            files = [plain + '.bz2']
+            with open(plain, 'rb') as f, open(files[0], 'wb') as out:
+                out.write(bz2.compress(f.read()))
+            os.remove(plain)
+            if zstandard is not None:
+                files += d.saveAsTFRecordsFile(path, codec='zstd', overwrite=False)
+
+            for p in files:
+                st = tfrecord_tool.stat_file(p)
+                self.assertEqual(st['error'], None)
+                self.assertEqual(st['records'], N)
+                self.assertEqual(st['bytes'], sum(len(x) for x in expected))
+                self.assertEqual(tfrecord_tool.verify_file(p), (p, N, None))
+                self.assertEqual(tfrecord_tool.index_file(p), (p, None, None))
+
+                mock_stdout = io.TextIOWrapper(io.BytesIO())
+                stdout, sys.stdout = sys.stdout, mock_stdout
+                try:
+                    self.assertEqual(tfrecord_tool.main(['cat', '--range', '3:5', p]), 0)
+                    self.assertEqual(tfrecord_tool.main(['cat', '--range=-1', p]), 2)
+                finally:
+                    sys.stdout = stdout
+                self.assertEqual(mock_stdout.buffer.getvalue(), b'the 3 string\nthe 4 string\n')
+
+    def test_simpleio(self):
+        import io
+        from dpark.simpleio import (TFRecordWriter, TFRecordReader, read_records,
+                                    read_single_rcd, write_records, encoded_num_bytes)
+        records = [b'', b'x'] + [(b'the %d string' % i) * (i % 7) for i in range(1000)]
+        with temppath('simpleio') as path:
+            os.makedirs(path)
+            for name, compression in [('plain.tfrecords', None), ('zlib.tfrecords', 'zlib'),
+                                      ('gzip.tfrecords', 'gzip'), ('auto.tfrecords.gz', None)]:
+                p = os.path.join(path, name)
+                with TFRecordWriter(p, compression=compression, buffer_size=1 << 10,
+                                    track_offsets=True) as w:
+                    offsets = [w.write(r) for r in records]
+                self.assertEqual(w.offsets, offsets)
+                self.assertEqual(w.tell(), sum(encoded_num_bytes(r) for r in records))
+                self.assertEqual(list(read_records(p, compression=compression, buffer_size=100)),
+                                 records)
+                with TFRecordReader(p, compression=compression, with_offsets=True) as r:
+                    self.assertEqual(list(r), list(zip(offsets, records)))
+
+            with gzip.open(os.path.join(path, 'auto.tfrecords.gz')) as f:
+                self.assertEqual(read_single_rcd(f), records[0])
+            plain = os.path.join(path, 'plain.tfrecords')
+            self.assertEqual(TfrecordsRDD(self.sc, plain).count(), len(records))
+            with open(plain, 'rb') as f:
+                f.seek(offsets[10])
+                self.assertEqual(read_single_rcd(f), records[10])
+                f.seek(0)
+                data = f.read()
+
+            buf = io.BytesIO()
+            write_records(buf, records[:10], compression='zlib')
+            self.assertFalse(buf.closed)
+            buf.seek(0)
+            self.assertEqual(list(read_records(buf, compression='zlib')), records[:10])
+
+            # short reads, as from pipes, are not truncation
+            class ShortReads(object):
+                def __init__(self, data):
+                    self.f = io.BytesIO(data)
+
+                def read(self, n):
+                    return self.f.read(min(n, 5))
+
+            self.assertEqual(list(read_records(ShortReads(data), buffer_size=100)), records)
+            f = ShortReads(data)
+            self.assertEqual([read_single_rcd(f) for _ in records], records)
+            from dpark.tfrecord import iter_frames
+            self.assertEqual([r for _, r in iter_frames(ShortReads(data), read_size=100)],
+                             records)
+
+            # truncated and corrupted files
+            truncated = os.path.join(path, 'truncated.tfrecords')
+            for size in (5, offsets[3] + 10, len(data) - 1):
+                with open(truncated, 'wb') as f:
+                    f.write(data[:size])
+                self.assertRaises(ValueError, list, read_records(truncated))
+            with open(truncated, 'wb') as f:
+                write_records(f, records[:10], compression='zlib')
+                f.truncate(f.tell() // 2)
+            self.assertRaises(ValueError, list, read_records(truncated, compression='zlib'))
+
+            corrupted = bytearray(data)
+            corrupted[offsets[500] + 14] ^= 0xff
+            with open(truncated, 'wb') as f:
+                f.write(corrupted)
+            self.assertRaises(ValueError, list, read_records(truncated))
+            self.assertEqual(len(list(read_records(truncated, check_crc=False))), len(records))
+
+    def test_raw_lines(self):
+        N = 1000
+        d = self.sc.makeRDD(list(range(N)), 1).map(str)
+        expected = [str(i).encode() for i in range(N)]
+        with temppath('tout') as path:
+            d.saveAsTextFile(path)
+            rd = TextFileRDD(self.sc, os.path.join(path, '0000'), splitSize=1<<10, raw=True)
+            self.assertEqual(rd.collect(), expected)
+        with temppath('tout') as path:
+            d.saveAsTextFile(path, compress=True)
+            rd = GZipFileRDD(self.sc, os.path.join(path, '0000.gz'), raw=True)
+            self.assertEqual(rd.collect(), expected)
+            with temppath('tfout') as out:
+                rd.saveAsTFRecordsFile(out)
+                self.assertEqual(self.sc.tfRecordsFile(out).collect(), [str(i) for i in range(N)])
+
+    def test_resolve_hostnames(self):
+        from dpark import util
+        hosts = util.resolve_hostnames(['127.0.0.1', '127.0.0.1'])
+        self.assertEqual(list(hosts), ['127.0.0.1'])
+        host, expire = util._hostnames['127.0.0.1']
+        self.assertEqual(host, hosts['127.0.0.1'])
+        self.assertEqual(util.resolve_hostnames(['127.0.0.1']), hosts)
+        self.assertEqual(util._hostnames['127.0.0.1'][1], expire)
+
     def test_compressed_file(self):
         # compress
         d = self.sc.makeRDD(list(range(100000)), 1)
@@ -390,6 +812,68 @@ class TestRDD(unittest.TestCase):
             rd = self.sc.textFile(path, splitSize=10<<10)
             self.assertEqual(rd.count(), 100000)
 
+            # written at the level of the codec
+            from dpark.codec import get_codec
+            with temppath('tout0') as stored:
+                d.map(lambda i: ('x', str(i))).saveAsTextFileByKey(
+                    stored, codec=get_codec('gzip', level=0))
+                self.assertTrue(os.path.getsize(os.path.join(stored, 'x/0000.gz'))
+                                > 2 * os.path.getsize(os.path.join(path, 'x/0000.gz')))
+                self.assertEqual(self.sc.textFile(stored).count(), 100000)
+
+    def test_gzip_index(self):
+        from dpark import gzindex
+        N = 100000
+        d = self.sc.makeRDD(list(range(N)), 1).map(str)
+        expected = [str(i) for i in range(N)]
+        with temppath('tout') as path:
+            d.saveAsTextFile(path, compress=True, index=True)
+            name = os.path.join(path, '0000.gz')
+            self.assertTrue(os.path.exists(gzindex.index_path(name)))
+            rd = GZipFileRDD(self.sc, name, splitSize=10<<10)
+            self.assertTrue(rd.indexed)
+            self.assertEqual(rd.collect(), expected)
+
+        # every split writes the index of its own file
+        d = self.sc.makeRDD(list(range(N)), 3).map(str)
+        with temppath('tout') as path:
+            names = d.saveAsTextFile(path, compress=True, index=True)
+            self.assertEqual(len(names), 3)
+            lines = []
+            for name in names:
+                rd = GZipFileRDD(self.sc, name, splitSize=10<<10)
+                self.assertTrue(rd.indexed)
+                lines.extend(rd.collect())
+            self.assertEqual(lines, expected)
+
+        with gen_big_text_file(64 << 10, 5 << 20, ext='gz') as f:
+            gzindex.main(['--span', str(256 << 10), f.name])
+            try:
+                rd = GZipFileRDD(self.sc, f.name, splitSize=512 * 1024)
+                self.assertTrue(rd.indexed)
+                self.assertEqual(rd.count(), f.cnt)
+            finally:
+                os.remove(gzindex.index_path(f.name))
+
+    def test_text_file_blocks(self):
+        lines = ['a', 'bb', 'x' * 100, 'ccc', '', 'd' * 15, 'e' * 16, 'last']
+        data = '\n'.join(lines).encode()    # no newline after the last line
+        with temppath('tout') as path:
+            os.makedirs(path)
+            name = os.path.join(path, 'blocks.txt')
+            with open(name, 'wb') as f:
+                f.write(data)
+            # the second split starts right after a newline, or at one
+            self.assertEqual(data[4:5], b'\n')
+            for block_size in (4, 16, TextFileRDD.READ_BLOCK_SIZE):
+                # lines cross blocks, the long one spans many, every
+                # offset is a split boundary for some split size
+                for split_size in range(1, len(data) + 1):
+                    rd = TextFileRDD(self.sc, name, splitSize=split_size)
+                    rd.READ_BLOCK_SIZE = block_size
+                    r = sum((list(rd.compute(s)) for s in rd.splits), [])
+                    self.assertEqual(r, lines, (block_size, split_size))
+
     def test_large_txt_file(self):
         with gen_big_text_file(64 << 10, 5 << 20, ext='txt') as f:
             rd = self.sc.textFile(f.name, splitSize=512 * 1024)
@@ -417,6 +901,16 @@ class TestRDD(unittest.TestCase):
             rd = self.sc.textFile(f.name, splitSize=512 * 1024)
             self.assertEqual(rd.count(), f.cnt)
 
+    def test_bz2_threads(self):
+        with gen_big_text_file(64 << 10, 2 << 20, ext='bz2') as f:
+            rd = BZip2FileRDD(self.sc, f.name, splitSize=256 * 1024)
+            lines = rd.collect()
+            self.assertEqual(len(lines), f.cnt)
+            # decompressed on as many threads as the task has cpus
+            rd = BZip2FileRDD(self.sc, f.name, splitSize=256 * 1024)
+            rd.cpus = 4
+            self.assertEqual(rd.collect(), lines)
+
     def test_binary_file(self):
         d = self.sc.makeRDD(list(range(100000)), 1)
         with temppath("bout") as path:
@@ -425,6 +919,47 @@ class TestRDD(unittest.TestCase):
             rd = self.sc.binaryFile(path, fmt="I", splitSize=10<<10)
             self.assertEqual(rd.count(), 100000)
 
+            # records cut by short reads are joined with the next read
+            rd = BinaryFileRDD(self.sc, os.path.join(path, '0000.bin'), fmt="I", batch=100)
+            open_file = rd.open_file
+
+            class ShortReads(object):
+                def __init__(self, f):
+                    self.f = f
+                    self.seek = f.seek
+                    self.close = f.close
+
+                def read(self, n):
+                    return self.f.read(min(n, 7))
+
+            rd.open_file = lambda metrics=None: ShortReads(open_file(metrics))
+            split = rd.splits[0]
+            self.assertEqual(list(rd.compute(split)),
+                             [(i,) for i in range(rd.splitSize // 4)])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_binary_file_dtype(self):
+        N = 100000
+        dtype = numpy.dtype([('id', '<u4'), ('score', '<f8')])
+        d = self.sc.makeRDD([(i, i * 0.5) for i in range(N)], 2)
+        with temppath("bout") as path:
+            d.saveAsBinaryFile(path, dtype=dtype)
+            rd = BinaryFileRDD(self.sc, os.path.join(path, '0000.bin'), dtype=dtype, batch=1000)
+            arrays = rd.collect()
+            self.assertTrue(all(len(a) <= 1000 for a in arrays))
+            a = numpy.concatenate(arrays + BinaryFileRDD(
+                self.sc, os.path.join(path, '0001.bin'), dtype=dtype).collect())
+            self.assertEqual(a['id'].tolist(), list(range(N)))
+            self.assertEqual(a['score'].sum(), sum(range(N)) * 0.5)
+
+            with temppath("bout2") as out:
+                # batches are written as they are
+                self.assertEqual(rd.saveAsBinaryFile(out, dtype=dtype),
+                                 [os.path.join(out, '0000.bin')])
+                rows = BinaryFileRDD(self.sc, os.path.join(out, '0000.bin'), fmt='<Id',
+                                     splitSize=10 << 10).collect()
+                self.assertEqual(rows, [(i, i * 0.5) for i in range(len(rows))])
+
     def test_table_file(self):
         N = 100000
         d = self.sc.makeRDD(list(zip(list(range(N)), list(range(N)))), 1)
@@ -438,6 +973,151 @@ class TestRDD(unittest.TestCase):
             rd = self.sc.table(path)
             self.assertEqual(rd.map(lambda x:x.f1+x.f2).reduce(lambda x,y:x+y), 2*sum(range(N)))
 
+    def test_table_footer(self):
+        N = 100000
+        d = self.sc.makeRDD([(i, 'k%d' % (i // 10)) for i in range(N)], 2)
+        with temppath('tout') as path:
+            d.saveAsTableFile(path, stats=True)
+            name = os.path.join(path, '0000.tab')
+            rd = TableFileRDD(self.sc, name, splitSize=16 << 10)
+            self.assertTrue(rd.indexed)
+            self.assertEqual(rd.count(), N // 2)
+
+            rd = TableFileRDD(self.sc, name, splitSize=16 << 10,
+                              predicate=(0, '<', 100), columns=[1])
+            self.assertEqual(len(rd), 1)
+            self.assertEqual(rd.collect(), [('k%d' % (i // 10),) for i in range(100)])
+
+            rd = TableFileRDD(self.sc, os.path.join(path, '0001.tab'), splitSize=16 << 10,
+                              predicate=[(0, '>=', 60000), (1, 'in', ['k6001', 'k6500'])])
+            self.assertEqual([r[0] for r in rd.collect()],
+                             list(range(60010, 60020)) + list(range(65000, 65010)))
+
+        from dpark.tablefooter import ColumnStats, block_may_match
+        stats = ColumnStats()
+        for v in (float('nan'), 5.0, 2.0, float('nan'), None):
+            stats.add((v,))
+        self.assertEqual(stats.dump(), [[2.0, 5.0]])
+        self.assertTrue(block_may_match(stats.dump(), [(0, '==', 5.0)]))
+        self.assertFalse(block_may_match(stats.dump(), [(0, '>', 5.0)]))
+
+    @unittest.skipIf(zstandard is None, 'needs zstandard')
+    def test_zstd_file(self):
+        N = 100000
+        d = self.sc.makeRDD(list(range(N)), 1)
+        with temppath('zout') as path:
+            self.assertEqual(d.map(str).saveAsTextFile(path, compress='zstd'),
+                             [os.path.join(path, '0000.zst')])
+            rd = ZstdFileRDD(self.sc, os.path.join(path, '0000.zst'), splitSize=10<<10)
+            self.assertEqual(rd.collect(), [str(i) for i in range(N)])
+            # splits know where lines start from the last bytes of the frames
+            from dpark.zstdfile import SeekTable
+            with open(os.path.join(path, '0000.zst'), 'rb') as f:
+                table = SeekTable.load(f, rd.size)
+            self.assertEqual(table.last_bytes, b'\n' * len(table))
+
+        with temppath('zout') as path:
+            d.map(lambda i: (i, str(i))).saveAsCSVFile(path, compress='zstd')
+            rd = ZstdFileRDD(self.sc, os.path.join(path, '0000.csv.zst'), splitSize=10<<10)
+            self.assertEqual(rd.fromCsv().map(lambda r: int(r[1])).collect(), list(range(N)))
+
+        with temppath('zout') as path:
+            d.map(str).saveAsTFRecordsFile(path, compress='zstd')
+            rd = TfrecordsRDD(self.sc, os.path.join(path, '0000.tfrecords.zst'),
+                              splitSize=10<<10)
+            self.assertEqual(rd.collect(), [str(i) for i in range(N)])
+            # sampling streams the frames, random access is refused
+            sampled = rd.sample(0.1, seed=1).collect()
+            self.assertTrue(0 < len(sampled) < N // 5)
+            self.assertTrue(set(sampled) <= set(str(i) for i in range(N)))
+            self.assertEqual(rd.count(), N)
+            self.assertRaises(ValueError, rd.getRecord, 0)
+            self.assertRaises(ValueError, rd.shuffled)
+
+        with temppath('zout') as path:
+            d.map(lambda i: (i, i)).saveAsTableFile(path, compress='zstd')
+            rd = self.sc.tableFile(path, splitSize=64<<10)
+            self.assertEqual(rd.map(lambda x: x[0]).reduce(lambda x, y: x + y), sum(range(N)))
+
+    def test_codecs(self):
+        from dpark.codec import get_codec, available_codecs
+        N = 10000
+        d = self.sc.makeRDD(list(range(N)), 2).map(str)
+        for name in ('gzip', 'bz2', 'zstd'):
+            if name not in available_codecs():
+                continue
+            codec = get_codec(name, block_size=4 << 10)
+            with temppath('cout') as path:
+                paths = d.saveAsTextFile(path, codec=codec)
+                self.assertEqual(paths, [os.path.join(path, '%04d%s' % (i, codec.ext))
+                                         for i in range(2)])
+                lines = sum((codec.text_rdd(self.sc, p, splitSize=4 << 10).collect()
+                             for p in paths), [])
+                self.assertEqual(lines, [str(i) for i in range(N)])
+
+        with temppath('cout') as path:
+            d.map(lambda x: (x, x)).saveAsTableFile(path, codec=get_codec('zlib', level=6))
+            self.assertEqual(self.sc.tableFile(path).count(), N)
+        with temppath('cout') as path:
+            self.assertRaises(ValueError, d.saveAsTableFile, path, codec='gzip')
+            self.assertRaises(ValueError, d.saveAsTFRecordsFile, path, codec='bz2')
+            self.assertRaises(ValueError, get_codec, 'nope')
+
+        # util.compress goes through the fastest codec installed
+        from dpark import util
+        data = b'dpark codec\n' * 1000
+        self.assertEqual(util.decompress(util.compress(data)), data)
+        self.assertEqual(util._compress_codec().decompress(util.compress(data)), data)
+        self.assertEqual(util.COMPRESS, util._compress_codec().name)
+        self.assertEqual(get_codec(util.COMPRESS).decompress(util.compress(data)), data)
+
+        # an error in the with block is raised, no partial block is written
+        import io
+        f = io.BytesIO()
+
+        def write_and_fail():
+            with get_codec('gzip', threads=1).writer(f) as w:
+                w.write(data)
+                raise KeyError('in the block')
+        self.assertRaises(KeyError, write_and_fail)
+        self.assertEqual(len(f.getvalue()), 10)    # only the gzip header
+
+        from dpark.bench_codecs import bench_codec
+        r = bench_codec(get_codec('gzip'), b'dpark codec\n' * 1000, repeat=1)
+        self.assertTrue(r['block_ratio'] > 1 and r['stream_ratio'] > 1)
+
+    def test_parallel_compress(self):
+        import io
+        from dpark.codec import get_codec
+        N = 100000
+        d = self.sc.makeRDD(list(range(N)), 1)
+        serial = get_codec('gzip', block_size=16 << 10, threads=1)
+        parallel = serial.with_options(threads=4)
+        # one thread unless asked for, or the task has more cpus
+        self.assertEqual(get_codec('gzip').writer(io.BytesIO()).threads, 1)
+        with temppath('pout') as path:
+            out = OutputTextFileRDD(d.map(str).with_cpus(2), path, codec='gzip')
+            self.assertEqual(out.codec.threads, 2)
+        with temppath('pout') as path:
+            d.map(str).saveAsTextFile(path, codec=parallel)
+            name = os.path.join(path, '0000.gz')
+            with gzip.open(name) as f:
+                data = f.read()
+            self.assertEqual(data, ''.join('%d\n' % i for i in range(N)).encode())
+            rd = GZipFileRDD(self.sc, name, splitSize=8 << 10)
+            self.assertEqual(rd.collect(), [str(i) for i in range(N)])
+            with open(name, 'rb') as f:
+                compressed = f.read()
+            d.map(str).saveAsTextFile(path, codec=serial)
+            with open(name, 'rb') as f:
+                self.assertEqual(f.read()[10:], compressed[10:])  # but mtime
+
+        with temppath('pout') as path:
+            d.map(lambda i: (i, 'a,b')).saveAsCSVFile(path, codec=parallel)
+            rd = GZipFileRDD(self.sc, os.path.join(path, '0000.csv.gz'), splitSize=8 << 10)
+            rows = rd.fromCsv().collect()
+            self.assertEqual(rows, [[str(i), 'a,b'] for i in range(N)])
+
     def test_batch(self):
         d = list(range(1234))
         rdd = self.sc.makeRDD(d, 10).batch(100)
@@ -459,6 +1139,8 @@ class TestRDD(unittest.TestCase):
         self.assertEqual('\n'.join(rdd.collect()), d)
         rdd = self.sc.partialTextFile(p, start, l, (l-start)//5)
         self.assertEqual('\n'.join(rdd.collect()), d)
+        rdd = PartialTextFileRDD(self.sc, p, start, l, (l-start)//5, raw=True)
+        self.assertEqual(b'\n'.join(rdd.collect()), d.encode('utf-8'))
 
     def test_beansdb(self):
         N = 100
@@ -574,6 +1256,91 @@ class TestRDD(unittest.TestCase):
         finally:
             shutil.rmtree(checkpoint_path)
 
+    def test_checkpoint_chunks(self):
+        import pickle
+        from dpark.checkpoint import CheckpointWriter, read_checkpoint, MAGIC
+        from dpark.tfrecord import iter_frames
+        from dpark.util import _compress_codec
+        checkpoint_path = mkdtemp()
+        try:
+            d = [(i, 'x' * (i % 100)) for i in range(100000)]
+            rdd = self.sc.makeRDD(d, 2).checkpoint(checkpoint_path)
+            self.assertEqual(rdd.collect(), d)
+            self.assertEqual(rdd.collect(), d)
+            with open(os.path.join(rdd.checkpoint_path, '0'), 'rb') as f:
+                frames = [payload for _, payload in iter_frames(f)]
+            self.assertTrue(len(frames) > 2)
+            # compressed by the codec of util.compress by default
+            self.assertEqual(frames[0], MAGIC + b':' + _compress_codec().name.encode('ascii'))
+
+            p = os.path.join(checkpoint_path, 'c')
+            with open(p, 'wb') as f:
+                w = CheckpointWriter(f, codec='zlib', chunk_size=1024)
+                for x in d:
+                    w.write(x)
+                w.close()
+            with open(p, 'rb') as f:
+                self.assertEqual(list(read_checkpoint(f)), d)
+
+            # big items are not held many at a time
+            big = [b'x' * (64 << 10)] * 8
+            with open(p, 'wb') as f:
+                w = CheckpointWriter(f, codec='zlib', chunk_size=64 << 10)
+                for x in big:
+                    w.write(x)
+                    self.assertTrue(len(w.items) <= 1)
+                w.close()
+            with open(p, 'rb') as f:
+                self.assertEqual(list(read_checkpoint(f)), big)
+
+            # a single pickle, as written by older versions
+            with open(p, 'wb') as f:
+                f.write(pickle.dumps(d[:10], -1))
+            with open(p, 'rb') as f:
+                self.assertEqual(list(read_checkpoint(f)), d[:10])
+        finally:
+            shutil.rmtree(checkpoint_path)
+
+    def test_checkpoint_reuse(self):
+        checkpoint_path = mkdtemp()
+        try:
+            d = list(range(1000))
+
+            def build(n):
+                return self.sc.makeRDD(d, 5).map(lambda x: x + n).groupBy(lambda x: x % 10)
+
+            rdd = build(1).checkpoint(checkpoint_path, reuse=True)
+            r = sorted(rdd.collect())
+            # a rerun with the same lineage finds the checkpoint
+            rdd2 = build(1).checkpoint(checkpoint_path, reuse=True)
+            self.assertEqual(rdd2.checkpoint_path, rdd.checkpoint_path)
+            self.assertEqual(len(os.listdir(rdd2.checkpoint_path)), len(rdd2))
+            self.assertEqual(sorted(rdd2.collect()), r)
+
+            rdd3 = build(2).checkpoint(checkpoint_path, reuse=True)
+            self.assertNotEqual(rdd3.checkpoint_path, rdd.checkpoint_path)
+            d[0] = -1
+            rdd4 = build(1).checkpoint(checkpoint_path, reuse=True)
+            self.assertNotEqual(rdd4.checkpoint_path, rdd.checkpoint_path)
+            self.assertIn(0, dict(rdd4.collect())[0])
+            # not reused by default
+            rdd5 = build(1).checkpoint(checkpoint_path)
+            self.assertFalse(os.path.basename(rdd5.checkpoint_path).startswith('lineage_'))
+
+            # broadcast variables are fingerprinted by their values
+            from dpark.lineage import fingerprint
+
+            def with_broadcast(value):
+                b = self.sc.broadcast(value)
+                return self.sc.makeRDD(d, 5).map(lambda x: x + b.value[x % 2])
+
+            fp = fingerprint(with_broadcast({0: 1, 1: 2}))
+            self.assertTrue(fp)
+            self.assertEqual(fingerprint(with_broadcast({0: 1, 1: 2})), fp)
+            self.assertNotEqual(fingerprint(with_broadcast({0: 1, 1: 3})), fp)
+        finally:
+            shutil.rmtree(checkpoint_path)
+
     def test_long_lineage(self):
         checkpoint_path = mkdtemp()
         try:
@@ -598,6 +1365,21 @@ class TestRDD(unittest.TestCase):
         loads(dumps(rdd))
         self.assertEqual(rdd.collect(), [x+1000 for x in d])
 
+    def test_long_recursion_batches(self):
+        d = list(range(10000))
+        rdd = self.sc.makeRDD(d, 2)
+        for i in range(1000):
+            rdd = rdd.map(lambda x: x+1)
+        self.assertEqual(rdd.collect(), [x+1000 for x in d])
+        self.assertEqual(rdd.take(3), [1000, 1001, 1002])
+
+        def fail(x):
+            if x == 5000:
+                raise KeyError(x)
+            return x
+        six.assertRaisesRegex(self, Exception, '5000',
+                              rdd.map(fail).map(lambda x: x+1).collect)
+
     def test_cache_shuffle(self):
         rdd1 = self.sc.parallelize([(1, 11), (2, 12), (3, 22)]).cache()
         rdd2 = self.sc.parallelize([(1, 33), (2, 44), (4, 55)]).cache()
@@ -619,5 +1401,28 @@ class TestRDDSortShuffle(TestRDD):
         DparkContext._instances.clear()
         GroupByNestedIter.NO_CACHE = False
 
+
+class TestImportTime(unittest.TestCase):
+    # seconds, override by DPARK_IMPORT_BUDGET on slow machines
+    BUDGET = float(os.environ.get('DPARK_IMPORT_BUDGET', 1.0))
+
+    def test_lazy_modules(self):
+        from dpark.bench_import import loaded_modules
+        modules = loaded_modules('dpark.util')
+        # shutil and tempfile import bz2 on python 3, they are lazy too
+        for m in ('pyximport', 'gzip', 'bz2', 'uuid', 'csv', 'snappy', 'dpark.lz4wrapper'):
+            self.assertFalse(m in modules, m)
+        modules = loaded_modules('dpark.rdd')
+        for m in ('pyximport', 'csv', 'bz2', 'mmap', 'dpark.beansdb', 'dpark.tfrecord',
+                  'dpark.gzindex', 'dpark.zstdfile', 'dpark.codec', 'dpark.checkpoint',
+                  'dpark.lineage', 'dpark.buffers', 'dpark.tablefooter'):
+            self.assertFalse(m in modules, m)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs python -X importtime')
+    def test_import_time(self):
+        from dpark.bench_import import import_time
+        t, _ = import_time('dpark.rdd')
+        self.assertTrue(t < self.BUDGET, 'import dpark.rdd took %.3fs' % t)
+
 if __name__ == "__main__":
     unittest.main()
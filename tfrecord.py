@@ -0,0 +1,618 @@
+# TFRecord framing helpers
+#
+# Each record is stored as:
+#   uint64 length, uint32 masked_crc32c(length), byte data[length], uint32 masked_crc32c(data)
+from __future__ import absolute_import
+import os
+import sys
+import errno
+import bisect
+import random
+import struct
+from contextlib import contextmanager, closing
+
+from dpark.util import masked_crc32c, atomic_file, mkdir_p, pread, get_logger
+from dpark.codec import codec_of_path
+
+logger = get_logger(__name__)
+
+HEADER_SIZE = 12
+FOOTER_SIZE = 4
+FRAME_OVERHEAD = HEADER_SIZE + FOOTER_SIZE
+WALK_BLOCK_SIZE = 64 << 10
+
+
+def parse_header(buf):
+    """Return the payload length encoded in a 12-byte frame header,
+    or None if the length crc does not match."""
+    length, length_mask_expected = struct.unpack('<QI', buf)
+    if masked_crc32c(buf[:8]) != length_mask_expected:
+        return None
+    return length
+
+
+def _read_at_least(read, need, size):
+    """Call read(size) until at least need bytes are read or the stream
+    ends, as pipes, sockets and some network files return short reads."""
+    data = read(size)
+    if len(data) >= need or not data:
+        return data
+    chunks = [data]
+    n = len(data)
+    while n < need:
+        data = read(max(size, need) - n)
+        if not data:
+            break
+        chunks.append(data)
+        n += len(data)
+    return b''.join(chunks)
+
+
+def walk_headers(f, start, end, block_size=WALK_BLOCK_SIZE):
+    """Yield (offset, length) of every frame starting in [start, end).
+
+    Only the 12-byte headers are read and checked, payloads are skipped
+    by seeking past `length + 4` bytes. Headers are read in blocks of
+    `block_size`, so small records cost a few reads per megabyte and
+    large records cost one seek each. Stops at EOF or at the first
+    header whose crc does not match.
+    """
+    buf = b''
+    base = pos = start
+    while pos < end:
+        off = pos - base
+        if off + HEADER_SIZE > len(buf):
+            f.seek(pos)
+            buf = _read_at_least(f.read, HEADER_SIZE, block_size)
+            base, off = pos, 0
+        hdr = buf[off:off + HEADER_SIZE]
+        if not hdr:
+            return
+        if len(hdr) != HEADER_SIZE:
+            raise ValueError('Not a valid TFRecord. Fewer than %d bytes: %s' % (HEADER_SIZE, hdr))
+        length = parse_header(hdr)
+        if length is None:
+            return
+        yield pos, length
+        pos += length + FRAME_OVERHEAD
+
+
+def encode_frame(data):
+    """The frame of the bytes data."""
+    length = struct.pack('<Q', len(data))
+    return (length + struct.pack('<I', masked_crc32c(length)) +
+            data + struct.pack('<I', masked_crc32c(data)))
+
+
+def decode_frame(buf):
+    """Check both crcs of a whole frame and return its payload."""
+    length = parse_header(buf[:HEADER_SIZE])
+    if length is None:
+        raise ValueError('Not a valid TFRecord. Mismatch of length mask: %s' % buf[:HEADER_SIZE])
+    if len(buf) != length + FRAME_OVERHEAD:
+        raise ValueError('Not a valid TFRecord. Fewer than %d bytes: %s' % (length + FRAME_OVERHEAD, len(buf)))
+    data = buf[HEADER_SIZE:HEADER_SIZE + length]
+    data_mask_expected, = struct.unpack('<I', buf[HEADER_SIZE + length:])
+    if masked_crc32c(data) != data_mask_expected:
+        raise ValueError('Not a valid TFRecord. Mismatch of data mask')
+    return data
+
+
+def iter_frames(f, check_crc=True, read_size=4 << 20, raw=False):
+    """Yield (offset, payload) of every frame in the stream f, which may
+    be a decompressing file object. Raises ValueError on a corrupted or
+    truncated frame; with check_crc=False only the length crc is checked.
+    With raw=True the whole frame is yielded instead of the payload."""
+    buf = b''
+    pos = offset = 0
+    while True:
+        if len(buf) - pos < HEADER_SIZE:
+            buf = buf[pos:] + _read_at_least(f.read, HEADER_SIZE - len(buf) + pos, read_size)
+            pos = 0
+            if len(buf) < HEADER_SIZE:
+                if buf:
+                    raise ValueError('Not a valid TFRecord. Fewer than %d bytes at %d'
+                                     % (HEADER_SIZE, offset))
+                return
+        length = parse_header(buf[pos:pos + HEADER_SIZE])
+        if length is None:
+            raise ValueError('Not a valid TFRecord. Mismatch of length mask at %d' % offset)
+        end = pos + length + FRAME_OVERHEAD
+        if end > len(buf):
+            buf = buf[pos:]
+            buf += _read_at_least(f.read, end - pos - len(buf), read_size)
+            pos, end = 0, length + FRAME_OVERHEAD
+            if end > len(buf):
+                raise ValueError('Not a valid TFRecord. Fewer than %d bytes at %d'
+                                 % (end, offset))
+        if check_crc:
+            data = decode_frame(buf[pos:end])
+        elif not raw:
+            data = buf[pos + HEADER_SIZE:end - FOOTER_SIZE]
+        yield offset, buf[pos:end] if raw else data
+        offset += end - pos
+        pos = end
+
+
+# The sidecar index of `path` is `.<name>.tfindex` in the same directory,
+# hidden so that directory readers skip it. It holds the little-endian
+# uint64 offset of every record followed by the end offset of the last
+# one, which must equal the file size, otherwise the index is stale.
+INDEX_SUFFIX = '.tfindex'
+
+
+def index_path(path):
+    dirname, name = os.path.split(path)
+    return os.path.join(dirname, '.%s%s' % (name, INDEX_SUFFIX))
+
+
+def build_index(f, size):
+    offsets = []
+    end = 0
+    for offset, length in walk_headers(f, 0, size):
+        offsets.append(offset)
+        end = offset + length + FRAME_OVERHEAD
+    offsets.append(end)
+    return offsets
+
+
+def write_index(path, offsets):
+    with atomic_file(index_path(path)) as f:
+        f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+
+
+def load_index(path, size):
+    """ offsets from the sidecar index of path, None if missing or stale """
+    try:
+        with open(index_path(path), 'rb') as f:
+            d = f.read()
+    except IOError:
+        return None
+    n = len(d) // 8
+    if not n or n * 8 != len(d):
+        return None
+    offsets = list(struct.unpack('<%dQ' % n, d))
+    if offsets[-1] != size:
+        logger.warning('stale index %s, ignored', index_path(path))
+        return None
+    return offsets
+
+
+class OffsetIndex(object):
+    """ The offsets of a sidecar index, read on demand with pread
+
+        Behaves as the read-only list load_index returns, but only the
+        entries asked for are read, so a task touching a few records of
+        a large file does not load its whole index.
+    """
+
+    # entries further apart than this are read separately by runs()
+    RUN_GAP = 64
+
+    def __init__(self, f, n):
+        self.f = f
+        self.n = n
+
+    @classmethod
+    def open(cls, path, size):
+        """ the index of path, None if missing or stale """
+        try:
+            f = open(index_path(path), 'rb')
+        except IOError:
+            return None
+        f.seek(0, 2)
+        n = f.tell() // 8
+        if n and n * 8 == f.tell():
+            last, = struct.unpack('<Q', pread(f, 8, (n - 1) * 8))
+            if last == size:
+                return cls(f, n)
+            logger.warning('stale index %s, ignored', index_path(path))
+        f.close()
+        return None
+
+    def close(self):
+        self.f.close()
+
+    def __len__(self):
+        return self.n
+
+    def _read(self, first, last):
+        if first >= last:
+            return []
+        d = pread(self.f, (last - first) * 8, first * 8)
+        if len(d) != (last - first) * 8:
+            raise ValueError('truncated index %s' % getattr(self.f, 'name', self.f))
+        return list(struct.unpack('<%dQ' % (last - first), d))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            first, last, step = i.indices(self.n)
+            if step != 1:
+                return self._read(first, last)[::step] if first < last else []
+            return self._read(first, last)
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError('index entry out of range: %d' % i)
+        return self._read(i, i + 1)[0]
+
+    def runs(self, indices):
+        """ {i: offsets[i .. i+1]} of the sorted records indices, entries
+            close to each other are fetched in one read """
+        bounds = {}
+        k = 0
+        while k < len(indices):
+            j = k + 1
+            while j < len(indices) and indices[j] - indices[j - 1] <= self.RUN_GAP:
+                j += 1
+            first = indices[k]
+            offsets = self._read(first, indices[j - 1] + 2)
+            for i in indices[k:j]:
+                bounds[i] = (offsets[i - first], offsets[i - first + 1])
+            k = j
+        return bounds
+
+
+def count_records(path, open_file=None):
+    """ number of records in an uncompressed TFRecord file
+
+        Taken from the size of the sidecar index, only its last offset
+        is read to check that it is not stale. The headers are walked
+        when there is none, and the index is written for later readers.
+    """
+    if codec_of_path(path) is not None:
+        raise ValueError('random access is not supported for compressed file: %s' % path)
+    f = open_file(path) if open_file else open(path, 'rb')
+    try:
+        size = file_size(f)
+        idx = OffsetIndex.open(path, size)
+        if idx is not None:
+            with closing(idx):
+                return len(idx) - 1
+        logger.warning('no index for %s, walking the headers', path)
+        offsets = build_index(f, size)
+        if offsets[-1] == size:
+            # so that tasks reading the file do not walk it again
+            try:
+                write_index(path, offsets)
+            except (IOError, OSError) as e:
+                logger.warning('can not write index %s: %s', index_path(path), e)
+        return len(offsets) - 1
+    finally:
+        f.close()
+
+
+def file_size(f):
+    size = getattr(f, 'length', None)
+    if size is None:
+        f.seek(0, 2)
+        size = f.tell()
+    return size
+
+
+class TFRecordFile(object):
+    """ Random access to the records of an uncompressed TFRecord file
+
+        >>> TFRecordFile(path)[10]
+        >>> TFRecordFile(path).get_records([3, 1, 4, 1, 5])
+
+        Offsets come from the sidecar index, of which only the entries
+        of requested records are read, or from a header walk when there
+        is none. Requested frames are fetched with pread, frames closer
+        than COALESCE_GAP are fetched in one read of up to READ_SIZE.
+    """
+
+    COALESCE_GAP = 64 << 10
+    READ_SIZE = 4 << 20
+    INDEX_CHUNK = 64 << 10
+
+    def __init__(self, path, open_file=None, offsets=None):
+        if codec_of_path(path) is not None:
+            raise ValueError('random access is not supported for compressed file: %s' % path)
+        if offsets is not None and not len(offsets):
+            raise ValueError('offsets of %s must end with the end offset of the last record' % path)
+        self.path = path
+        self.f = open_file(path) if open_file else open(path, 'rb')
+        self.size = file_size(self.f)
+        self._own_index = offsets is None
+        if offsets is None:
+            offsets = OffsetIndex.open(path, self.size)
+        if offsets is None:
+            logger.warning('no index for %s, walking the headers', path)
+            offsets = build_index(self.f, self.size)
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.get_records(range(*idx.indices(len(self))))
+        return self.get_records([idx])[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.f.close()
+        if self._own_index and isinstance(self.offsets, OffsetIndex):
+            self.offsets.close()
+
+    def get_records(self, indices, raw=False):
+        """ payloads of the records, or their checked frames with raw=True """
+        n = len(self)
+        indices = [i + n if i < 0 else i for i in indices]
+        for i in indices:
+            if not 0 <= i < n:
+                raise IndexError('record index out of range: %d' % i)
+
+        wanted = sorted(set(indices))
+        bounds = self._bounds(wanted)
+        records = {}
+        for group in self._coalesce(wanted, bounds):
+            base = bounds[group[0]][0]
+            buf = pread(self.f, bounds[group[-1]][1] - base, base)
+            for i in group:
+                start, end = bounds[i]
+                frame = buf[start - base:end - base]
+                data = decode_frame(frame)
+                records[i] = frame if raw else data
+        return [records[i] for i in indices]
+
+    def iter_records(self, first=0, last=None):
+        """ records first .. last-1 in order, read in chunks of about READ_SIZE """
+        if last is None:
+            last = len(self)
+        while first < last:
+            # the offsets are taken INDEX_CHUNK entries at a time
+            stop = min(last, first + self.INDEX_CHUNK)
+            offsets = self.offsets[first:stop + 1]
+            k, m = 0, stop - first
+            while k < m:
+                base = offsets[k]
+                end = bisect.bisect_right(offsets, base + self.READ_SIZE, k + 1, m + 1) - 1
+                end = max(end, k + 1)
+                buf = pread(self.f, offsets[end] - base, base)
+                for j in range(k, end):
+                    yield decode_frame(buf[offsets[j] - base:offsets[j + 1] - base])
+                k = end
+            first = stop
+
+    def _bounds(self, indices):
+        """ {i: (start, end)} of the frames of the sorted indices """
+        offsets = self.offsets
+        if isinstance(offsets, OffsetIndex):
+            return offsets.runs(indices)
+        return dict((i, (offsets[i], offsets[i + 1])) for i in indices)
+
+    def _coalesce(self, indices, bounds):
+        """ group sorted indices whose frames can be fetched in one read
+            of at most READ_SIZE, unless a single frame is larger """
+        group = []
+        for i in indices:
+            if group and (bounds[i][0] - bounds[group[-1]][1] > self.COALESCE_GAP
+                          or bounds[i][1] - bounds[group[0]][0] > self.READ_SIZE):
+                yield group
+                group = []
+            group.append(i)
+        if group:
+            yield group
+
+
+class Permutation(object):
+    """ Pseudo random permutation of range(n) keyed by seed
+
+        perm[i] is computed on demand by a small Feistel network with
+        cycle walking, so the permutation is never materialized and
+        every task can evaluate its own share of positions.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, n, seed):
+        self.n = n
+        bits = max((n - 1).bit_length(), 2)
+        bits += bits & 1
+        self.half = bits // 2
+        self.mask = (1 << self.half) - 1
+        rd = random.Random(seed)
+        self.keys = [rd.getrandbits(32) for _ in range(self.ROUNDS)]
+
+    def __len__(self):
+        return self.n
+
+    def _round(self, r, k):
+        h = ((r * 0x9e3779b1) ^ k) & 0xffffffff
+        h ^= h >> 16
+        h = (h * 0x85ebca6b) & 0xffffffff
+        h ^= h >> 13
+        return h & self.mask
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.n:
+            raise IndexError('permutation index out of range: %d' % i)
+        half, mask = self.half, self.mask
+        x = i
+        while True:
+            left, right = x >> half, x & mask
+            for k in self.keys:
+                left, right = right, left ^ self._round(right, k)
+            x = (left << half) | right
+            if x < self.n:
+                return x
+
+
+def expand_paths(paths):
+    """ files of paths, directories are walked, hidden files are skipped """
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                files.extend(os.path.join(root, n) for n in sorted(names)
+                             if not n.startswith('.'))
+        else:
+            files.append(path)
+    return files
+
+
+@contextmanager
+def _open_stream(path, codec):
+    "file-like reader of the decompressed TFRecords of path"
+    if codec is None:
+        with open(path, 'rb') as f:
+            yield f
+    elif codec.name == 'gzip':
+        import gzip
+        with gzip.open(path, 'rb') as f:
+            yield f
+    elif codec.name == 'zstd':
+        from dpark.zstdfile import SeekTable, ZstdFrameReader
+        with open(path, 'rb') as f:
+            table = SeekTable.load(f, file_size(f))
+            if table is None:
+                raise ValueError('%s is not a seekable zstd file' % path)
+            yield ZstdFrameReader(f, table, 0)
+    elif codec.name == 'bz2':
+        import bz2
+        with bz2.BZ2File(path, 'rb') as f:
+            yield f
+    else:
+        raise ValueError('TFRecords can not be read from %s files: %s' % (codec.name, path))
+
+
+def copy_range(fin, fout, offset, count):
+    """ append count bytes at offset of fin to fout, by copy_file_range
+        or sendfile when the platform has them, so data stays in the kernel """
+    fd_in, fd_out = fin.fileno(), fout.fileno()
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    while count > 0:
+        try:
+            if copy_file_range is not None:
+                n = copy_file_range(fd_in, fd_out, count, offset)
+            elif sendfile is not None:
+                n = sendfile(fd_out, fd_in, offset, count)
+            else:
+                d = pread(fin, min(count, 4 << 20), offset)
+                n = len(d) and os.write(fd_out, d)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            if copy_file_range is not None:
+                copy_file_range = None
+            elif sendfile is not None:
+                sendfile = None
+            else:  # the plain read and write failed, nothing left to fall back to
+                raise
+            continue
+        if not n:
+            raise ValueError('unexpected end of %s at %d' % (getattr(fin, 'name', fin), offset))
+        offset += n
+        count -= n
+
+
+class _ShardWriter(object):
+    "write frames into dst/NNNN.tfrecords files of about target_bytes"
+
+    def __init__(self, dst, target_bytes, index):
+        self.dst = dst
+        self.target_bytes = target_bytes
+        self.index = index
+        self.paths = []
+        self.f = None
+
+    def room(self):
+        return self.target_bytes - self.size if self.f is not None else self.target_bytes
+
+    def _open(self):
+        self.path = os.path.join(self.dst, '%04d.tfrecords' % len(self.paths))
+        self._cm = atomic_file(self.path)
+        self.f = self._cm.__enter__()
+        self.size = 0
+        self.offsets = []
+
+    def write(self, frame):
+        if self.f is None:
+            self._open()
+        self.f.write(frame)
+        self.offsets.append(self.size)
+        self.size += len(frame)
+
+    def copy(self, fin, offsets, first, last):
+        """ append frames first .. last-1 of fin, whose offsets are given """
+        if self.f is None:
+            self._open()
+        base = offsets[first]
+        self.f.flush()
+        copy_range(fin, self.f, base, offsets[last] - base)
+        self.offsets.extend(self.size + o - base for o in offsets[first:last])
+        self.size += offsets[last] - base
+
+    def close(self, exc_info=(None, None, None)):
+        if self.f is None:
+            return
+        f, self.f = self.f, None
+        f.flush()
+        self._cm.__exit__(*exc_info)
+        if exc_info[0] is None:
+            self.paths.append(self.path)
+            if self.index:
+                write_index(self.path, self.offsets + [self.size])
+
+
+def compactTFRecords(src, dst, target_bytes=256 << 20, index=False, verify=False):
+    """ Merge the TFRecord files of src into dst/NNNN.tfrecords shards of
+        about target_bytes, without decoding the records.
+
+        src: a file, a directory or a list of them, in the order of output
+        index: also write the .tfindex sidecar of every shard
+        verify: check the crcs of every payload instead of the headers only
+
+        Frames of uncompressed files are copied as whole-record byte ranges
+        by copy_file_range / sendfile, .gz and .zst files are decompressed
+        and copied frame by frame. A shard only exceeds target_bytes when it holds a
+        single larger record. Returns the paths of the shards.
+    """
+    mkdir_p(dst)
+    out = _ShardWriter(dst, target_bytes, index)
+    try:
+        for path in expand_paths(src):
+            codec = codec_of_path(path)
+            if codec is not None or verify:
+                with _open_stream(path, codec) as f:
+                    for _, frame in iter_frames(f, check_crc=verify, raw=True):
+                        if len(frame) > out.room() and out.f is not None and out.size:
+                            out.close()
+                        out.write(frame)
+                continue
+
+            with open(path, 'rb') as f:
+                size = file_size(f)
+                offsets = load_index(path, size) or build_index(f, size)
+                if offsets[-1] != size:
+                    raise ValueError('Not a valid TFRecord. Bad frame header at %d in %s'
+                                     % (offsets[-1], path))
+                n = len(offsets) - 1
+                first = 0
+                while first < n:
+                    last = bisect.bisect_right(offsets, offsets[first] + out.room(), first + 1, n + 1) - 1
+                    if last == first:
+                        if out.f is not None and out.size:
+                            out.close()
+                            continue
+                        last = first + 1
+                    out.copy(f, offsets, first, last)
+                    first = last
+                    if out.room() <= 0:
+                        out.close()
+    except:
+        out.close(sys.exc_info())
+        raise
+    out.close()
+    return out.paths
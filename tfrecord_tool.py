@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""tfrecords command line tool
+
+    python -m dpark.tfrecord_tool count  PATH...
+    python -m dpark.tfrecord_tool stat   PATH...
+    python -m dpark.tfrecord_tool verify -j 16 PATH...
+    python -m dpark.tfrecord_tool index  PATH...
+    python -m dpark.tfrecord_tool cat --range 100:200 FILE
+
+A PATH may be a file or a directory, hidden files (such as the
+`.tfindex` sidecars) are skipped. count and stat only walk the frame
+headers of uncompressed files, compressed ones (.gz, .zst, .bz2) are
+read through, verify checks every crc. Files are processed in parallel
+by a process pool of -j workers.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys
+import codecs
+import argparse
+import itertools
+from multiprocessing import Pool, cpu_count
+
+from dpark.codec import codec_of_path
+from dpark.tfrecord import (
+    walk_headers, iter_frames, build_index, write_index, load_index, file_size,
+    expand_paths, TFRecordFile, FRAME_OVERHEAD, _open_stream
+)
+
+
+def _sizes(path, check_crc=False):
+    """ payload size of every record in path """
+    codec = codec_of_path(path)
+    if codec is not None:
+        with _open_stream(path, codec) as f:
+            for _, data in iter_frames(f, check_crc):
+                yield len(data)
+        return
+
+    with open(path, 'rb') as f:
+        if check_crc:
+            for _, data in iter_frames(f):
+                yield len(data)
+            return
+        size = file_size(f)
+        offsets = load_index(path, size)
+        if offsets is not None:
+            for i in range(len(offsets) - 1):
+                yield offsets[i + 1] - offsets[i] - FRAME_OVERHEAD
+            return
+        end = 0
+        for offset, length in walk_headers(f, 0, size):
+            end = offset + length + FRAME_OVERHEAD
+            yield length
+        if end != size:
+            raise ValueError('Not a valid TFRecord. Bad frame header at %d' % end)
+
+
+def stat_file(path):
+    st = dict(path=path, records=0, bytes=0, min_size=None, max_size=None, error=None)
+    try:
+        for n in _sizes(path):
+            st['records'] += 1
+            st['bytes'] += n
+            if st['min_size'] is None or n < st['min_size']:
+                st['min_size'] = n
+            if st['max_size'] is None or n > st['max_size']:
+                st['max_size'] = n
+    except (IOError, ValueError) as e:
+        st['error'] = str(e)
+    return st
+
+
+def verify_file(path):
+    """ (path, number of good records, error or None) """
+    n = 0
+    try:
+        for _ in _sizes(path, check_crc=True):
+            n += 1
+    except (IOError, ValueError) as e:
+        return path, n, str(e)
+    return path, n, None
+
+
+def index_file(path, force=False):
+    """ (path, records or None if skipped, error or None) """
+    if codec_of_path(path) is not None:
+        return path, None, None
+    try:
+        with open(path, 'rb') as f:
+            size = file_size(f)
+            if not force and load_index(path, size) is not None:
+                return path, None, None
+            offsets = build_index(f, size)
+        if offsets[-1] != size:
+            raise ValueError('Not a valid TFRecord. Bad frame header at %d' % offsets[-1])
+        write_index(path, offsets)
+    except (IOError, ValueError) as e:
+        return path, None, str(e)
+    return path, len(offsets) - 1, None
+
+
+def _index_file_forced(path):
+    return index_file(path, True)
+
+
+def parse_range(s):
+    """ 'a:b', 'a:' or ':b' as a slice, 'a' as the single record a """
+    if ':' not in s:
+        i = int(s)
+        return slice(i, i + 1 if i != -1 else None)
+    first, last = s.split(':', 1)
+    return slice(int(first) if first else None, int(last) if last else None)
+
+
+def _map(func, paths, jobs):
+    if jobs <= 1 or len(paths) <= 1:
+        for r in map(func, paths):
+            yield r
+        return
+    pool = Pool(min(jobs, len(paths)))
+    try:
+        for r in pool.imap(func, paths):
+            yield r
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def cmd_count(args):
+    total, failed = 0, False
+    for st in _map(stat_file, expand_paths(args.paths), args.jobs):
+        if st['error']:
+            failed = True
+            print('%s\tERROR %s' % (st['path'], st['error']), file=sys.stderr)
+        else:
+            print('%d\t%s' % (st['records'], st['path']))
+            total += st['records']
+    print('%d\ttotal' % total)
+    return 1 if failed else 0
+
+
+def cmd_stat(args):
+    total = dict(files=0, records=0, bytes=0, min_size=None, max_size=None)
+    failed = False
+    for st in _map(stat_file, expand_paths(args.paths), args.jobs):
+        if st['error']:
+            failed = True
+            print('%s\tERROR %s' % (st['path'], st['error']), file=sys.stderr)
+            continue
+        print('%s\trecords=%d bytes=%d min=%s max=%s' % (
+            st['path'], st['records'], st['bytes'], st['min_size'], st['max_size']))
+        total['files'] += 1
+        total['records'] += st['records']
+        total['bytes'] += st['bytes']
+        for k, f in (('min_size', min), ('max_size', max)):
+            if st[k] is not None:
+                total[k] = st[k] if total[k] is None else f(total[k], st[k])
+    print('total\tfiles=%d records=%d bytes=%d min=%s max=%s avg=%.1f' % (
+        total['files'], total['records'], total['bytes'], total['min_size'],
+        total['max_size'], float(total['bytes']) / total['records'] if total['records'] else 0))
+    return 1 if failed else 0
+
+
+def cmd_verify(args):
+    bad = 0
+    files = expand_paths(args.paths)
+    for path, n, error in _map(verify_file, files, args.jobs):
+        if error:
+            bad += 1
+            print('BAD\t%s\tafter %d records: %s' % (path, n, error))
+        elif args.verbose:
+            print('OK\t%s\t%d records' % (path, n))
+    print('%d files, %d bad' % (len(files), bad), file=sys.stderr)
+    return 1 if bad else 0
+
+
+def cmd_index(args):
+    failed = False
+    func = _index_file_forced if args.force else index_file
+    for path, n, error in _map(func, expand_paths(args.paths), args.jobs):
+        if error:
+            failed = True
+            print('%s\tERROR %s' % (path, error), file=sys.stderr)
+        elif n is None:
+            print('skip\t%s' % path)
+        else:
+            print('%d\t%s' % (n, path))
+    return 1 if failed else 0
+
+
+def cmd_cat(args):
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    delimiter = codecs.escape_decode(args.delimiter)[0]
+    rng = parse_range(args.range) if args.range else slice(None)
+    codec = codec_of_path(args.path)
+    if codec is not None:
+        if (rng.start or 0) < 0 or (rng.stop or 0) < 0:
+            print('negative range is not supported for compressed file', file=sys.stderr)
+            return 2
+        with _open_stream(args.path, codec) as f:
+            records = (data for _, data in iter_frames(f))
+            for data in itertools.islice(records, rng.start, rng.stop):
+                out.write(data)
+                out.write(delimiter)
+    else:
+        with TFRecordFile(args.path) as f:
+            first, last, _ = rng.indices(len(f))
+            for data in f.iter_records(first, max(first, last)):
+                out.write(data)
+                out.write(delimiter)
+    out.flush()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='tfrecords', description='TFRecord file tool')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    for name, func, help in (('count', cmd_count, 'number of records, header walk only'),
+                             ('stat', cmd_stat, 'record count and sizes, header walk only'),
+                             ('verify', cmd_verify, 'check every crc'),
+                             ('index', cmd_index, 'write .tfindex sidecars')):
+        p = sub.add_parser(name, help=help)
+        p.add_argument('paths', nargs='+', metavar='PATH')
+        p.add_argument('-j', '--jobs', type=int, default=cpu_count(), help='worker processes')
+        p.set_defaults(func=func)
+        if name == 'verify':
+            p.add_argument('-v', '--verbose', action='store_true', help='print good files too')
+        elif name == 'index':
+            p.add_argument('-f', '--force', action='store_true', help='rebuild fresh indexes')
+
+    p = sub.add_parser('cat', help='dump records by number')
+    p.add_argument('path', metavar='FILE')
+    p.add_argument('-r', '--range', help='FIRST:LAST (exclusive), FIRST:, :LAST or N, '
+                        'write negative ones as --range=-N:')
+    p.add_argument('-d', '--delimiter', default='\\n',
+                   help='written after every record, backslash escapes allowed, default \\n')
+    p.set_defaults(func=cmd_cat)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,22 +5,13 @@ import re
 import sys
 import threading
 import errno
-import uuid
 import time
-import tempfile
 import logging
 import os.path
-import gzip
+import six
 import zlib
 import struct
 from contextlib import contextmanager
-from zlib import compress as _compress
-try:
-    from dpark.portable_hash import portable_hash as _hash
-except ImportError:
-    import pyximport
-    pyximport.install(inplace=True)
-    from dpark.portable_hash import portable_hash as _hash
 
 try:
     from cStringIO import StringIO
@@ -37,19 +28,40 @@ except:
     def getuser():
         return getpass.getuser()
 
-COMPRESS = 'zlib'
+def _compress_codec():
+    """ the Codec of compress() and decompress(), the fastest one installed,
+        chosen on first use so that importing util loads none of them """
+    if _compress_codec.codec is None:
+        from dpark.codec import get_codec
+        for name in ('lz4', 'snappy', 'zlib'):
+            codec = get_codec(name)
+            if codec.available():
+                break
+        _compress_codec.codec = codec
+    return _compress_codec.codec
+
+_compress_codec.codec = None
+
+
+# COMPRESS, the name of that codec, is compared by env between the
+# master and the executors. Python 2 has no module __getattr__, there
+# it is picked at import.
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name == 'COMPRESS':
+            return _compress_codec().name
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+else:
+    COMPRESS = _compress_codec().name
+
+
 def compress(s):
-    return _compress(s, 1)
+    return _compress_codec().compress(s)
+
+
+def decompress(s):
+    return _compress_codec().decompress(s)
 
-try:
-    from dpark.lz4wrapper import compress, decompress
-    COMPRESS = 'lz4'
-except ImportError:
-    try:
-        from snappy import compress, decompress
-        COMPRESS = 'snappy'
-    except ImportError:
-        pass
 
 def spawn(target, *args, **kw):
     t = threading.Thread(target=target, name=target.__name__, args=args, kwargs=kw)
@@ -57,9 +69,24 @@ def spawn(target, *args, **kw):
     t.start()
     return t
 
+def _load_hash():
+    try:
+        from dpark.portable_hash import portable_hash
+    except ImportError:
+        # compile on first use, not when dpark.util is imported
+        import pyximport
+        pyximport.install(inplace=True)
+        from dpark.portable_hash import portable_hash
+    return portable_hash
+
+_hash = None
+
 # hash(None) is id(None), different from machines
 # http://effbot.org/zone/python-hash.htm
 def portable_hash(value):
+    global _hash
+    if _hash is None:
+        _hash = _load_hash()
     return _hash(value)
 
 # similar to itertools.chain.from_iterable, but faster in PyPy
@@ -101,59 +128,227 @@ def memory_str_to_mb(str):
     return number * scale_factors[unit]
 
 MIN_REMAIN_RECURSION_LIMIT = 80
-def recurion_limit_breaker(f):
-    def _(*a, **kw):
-        try:
-            sys._getframe(sys.getrecursionlimit() - MIN_REMAIN_RECURSION_LIMIT)
-        except ValueError:
-            return f(*a, **kw)
 
-        def __():
-            result = []
-            finished = []
-            cond = threading.Condition(threading.Lock())
-            def _run():
-                it = iter(f(*a, **kw))
-                with cond:
-                    while True:
-                        while result:
-                            cond.wait()
-                        try:
-                            result.append(next(it))
-                            cond.notify()
-                        except StopIteration:
-                            break
+# items of a deep iterator are handed over in batches growing up to
+# BREAKER_BATCH_SIZE, at most BREAKER_QUEUE_SIZE batches ahead
+BREAKER_BATCH_SIZE = 1024
+BREAKER_QUEUE_SIZE = 4
+BREAKER_IDLE_TIMEOUT = 60
 
-                    finished.append(1)
-                    cond.notify()
 
+class _BreakerThreads(object):
+    """ Threads which run iterators on a fresh stack, idle ones are
+        reused and exit after BREAKER_IDLE_TIMEOUT seconds """
 
-            t = spawn(_run)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = six.moves.queue.Queue()
+        self.idle = 0
+
+    def submit(self, job):
+        with self.lock:
+            if self.idle:
+                self.idle -= 1
+            else:
+                spawn(self._worker)
+            self.jobs.put(job)
 
-            with cond:
-                while True:
-                    while not finished and not result:
-                        cond.wait()
+    def _worker(self):
+        while True:
+            try:
+                job = self.jobs.get(timeout=BREAKER_IDLE_TIMEOUT)
+            except six.moves.queue.Empty:
+                with self.lock:
+                    # a job may have been put for this thread meanwhile
+                    if not self.jobs.empty():
+                        continue
+                    self.idle -= 1
+                return
+            job()
+            with self.lock:
+                self.idle += 1
+
+_breaker_threads = _BreakerThreads()
+
+
+def _iterate_in_thread(func, args, kwargs):
+    """ items of func(*args, **kwargs), iterated by a breaker thread """
+    q = six.moves.queue.Queue(BREAKER_QUEUE_SIZE)
+    cancelled = []
+
+    def put(item):
+        while not cancelled:
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except six.moves.queue.Full:
+                pass
+        return False
+
+    def run():
+        it = None
+        try:
+            it = iter(func(*args, **kwargs))
+            size = 1
+            batch = []
+            for item in it:
+                batch.append(item)
+                if len(batch) >= size:
+                    if not put(batch):
+                        return
+                    batch = []
+                    size = min(size * 2, BREAKER_BATCH_SIZE)
+            if not batch or put(batch):
+                put(None)
+        except BaseException:
+            # SystemExit too, or the consumer would wait forever
+            put(sys.exc_info())
+        finally:
+            close = getattr(it, 'close', None)
+            if cancelled and close is not None:
+                close()
+
+    _breaker_threads.submit(run)
+    try:
+        while True:
+            batch = q.get()
+            if batch is None:
+                return
+            if isinstance(batch, tuple):
+                six.reraise(*batch)
+            for item in batch:
+                yield item
+    finally:
+        cancelled.append(1)
 
-                    if result:
-                        yield result.pop()
-                        cond.notify()
 
-                    if finished:
-                        assert not result
-                        break
+def recurion_limit_breaker(f):
+    """ calls f on another thread when the stack is close to the
+        recursion limit, f returns an iterable """
+    def _(*a, **kw):
+        try:
+            sys._getframe(sys.getrecursionlimit() - MIN_REMAIN_RECURSION_LIMIT)
+        except ValueError:
+            return f(*a, **kw)
+        return _iterate_in_thread(f, a, kw)
 
-            t.join()
+    return _
 
-        return __()
+def pread(f, size, offset):
+    "read size bytes at offset, without moving the file position if possible"
+    if isinstance(f, MeteredFile):
+        return f.pread(size, offset)
+    if hasattr(os, 'pread'):
+        try:
+            fd = f.fileno()
+        except Exception:
+            fd = None
+        if fd is not None:
+            chunks = []
+            while size > 0:
+                d = os.pread(fd, size, offset)
+                if not d:
+                    break
+                chunks.append(d)
+                size -= len(d)
+                offset += len(d)
+            return b''.join(chunks)
+    f.seek(offset)
+    return f.read(size)
+
+class IOMetrics(object):
+    """ I/O counters of a split, times are in seconds """
+    FIELDS = ('bytes_read', 'bytes_decompressed', 'records', 'bytes_skipped',
+              'corrupt_frames', 'io_time', 'decompress_time', 'crc_time', 'decode_time')
 
-    return _
+    def __init__(self):
+        for k in self.FIELDS:
+            setattr(self, k, 0)
+
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in self.FIELDS)
+
+    def wrap(self, fn, field):
+        "fn with its running time added to field"
+        def _(*a):
+            t = time.time()
+            try:
+                return fn(*a)
+            finally:
+                setattr(self, field, getattr(self, field) + time.time() - t)
+        return _
+
+    def timed(self, it, field):
+        "time spent in next(it) except reading, added to field"
+        it = iter(it)
+        while True:
+            t, io = time.time(), self.io_time
+            try:
+                v = next(it)
+            except StopIteration:
+                return
+            finally:
+                setattr(self, field, getattr(self, field)
+                        + time.time() - t - (self.io_time - io))
+            yield v
+
+class MeteredFile(object):
+    "count bytes and time of reads on f into metrics"
+    def __init__(self, f, metrics):
+        self.__dict__['_f'] = f
+        self.__dict__['_metrics'] = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._f, name, value)
+
+    def read(self, *a):
+        m = self._metrics
+        t = time.time()
+        d = self._f.read(*a)
+        m.io_time += time.time() - t
+        m.bytes_read += len(d)
+        return d
+
+    def pread(self, size, offset):
+        m = self._metrics
+        t = time.time()
+        d = pread(self._f, size, offset)
+        m.io_time += time.time() - t
+        m.bytes_read += len(d)
+        return d
+
+    def readline(self, *a):
+        m = self._metrics
+        t = time.time()
+        d = self._f.readline(*a)
+        m.io_time += time.time() - t
+        m.bytes_read += len(d)
+        return d
+
+    def __iter__(self):
+        m = self._metrics
+        it = iter(self._f)
+        while True:
+            t = time.time()
+            try:
+                line = next(it)
+            except StopIteration:
+                return
+            finally:
+                m.io_time += time.time() - t
+            m.bytes_read += len(line)
+            yield line
 
 class AbortFileReplacement(Exception):
     pass
 
 @contextmanager
 def atomic_file(filename, mode='w+b', bufsize=-1):
+    import uuid
+    import tempfile
     path, name = os.path.split(filename)
     path = path or None
     prefix = '.%s.' % (name,) if name else '.'
@@ -346,6 +541,7 @@ logger = get_logger(__name__)
 
 
 def gzip_decompressed_fh_2(f, path):
+    import gzip
     dz = zlib.decompressobj(-zlib.MAX_WBITS)
     while True:
         d = f.read(32 << 10)       # the same as the block size in gzip_find_block()
@@ -374,6 +570,7 @@ def gzip_decompressed_fh_2(f, path):
 
 
 def gzip_decompressed_fh(f, path, split, splitSize):
+    import gzip
     if split.index == 0:
         zf = gzip.GzipFile(mode='rb', fileobj=f)
         if hasattr(zf, '_buffer'):
@@ -444,3 +641,57 @@ class Scope(object):
         self.dpark_func_name = fn
         self.call_site = "@".join([fn, pos])
 
+
+
+# hostname of chunkserver addresses, shared by all RDDs of the process
+HOSTNAME_TTL = 3600
+HOSTNAME_NEGATIVE_TTL = 60
+RESOLVE_THREADS = 32
+_hostnames = {}     # addr -> (hostname, expire time)
+_hostnames_lock = threading.Lock()
+
+
+def _gethostbyaddr(addr):
+    import socket
+    try:
+        return socket.gethostbyaddr(addr)[0], True
+    except (IOError, OSError) as e:
+        logger.warning('get hostname exec %s for loc %s', e, addr)
+        return addr, False
+
+
+def resolve_hostnames(addrs):
+    """ {addr: hostname} of addrs, an address that can not be resolved is its own hostname.
+
+        Results are cached for HOSTNAME_TTL seconds, failures for
+        HOSTNAME_NEGATIVE_TTL seconds, uncached addresses are resolved
+        in parallel by up to RESOLVE_THREADS threads.
+    """
+    now = time.time()
+    result = {}
+    todo = []
+    with _hostnames_lock:
+        for addr in set(addrs):
+            cached = _hostnames.get(addr)
+            if cached is not None and cached[1] > now:
+                result[addr] = cached[0]
+            else:
+                todo.append(addr)
+
+    if len(todo) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(RESOLVE_THREADS, len(todo)))
+        try:
+            resolved = pool.map(_gethostbyaddr, todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        resolved = [_gethostbyaddr(addr) for addr in todo]
+
+    now = time.time()
+    with _hostnames_lock:
+        for addr, (host, ok) in zip(todo, resolved):
+            _hostnames[addr] = (host, now + (HOSTNAME_TTL if ok else HOSTNAME_NEGATIVE_TTL))
+            result[addr] = host
+    return result
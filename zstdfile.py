@@ -0,0 +1,199 @@
+# Seekable zstd files
+#
+# The layout is the seekable format of zstd (contrib/seekable_format):
+# independent zstd frames, followed by a skippable frame holding the
+# seek table
+#
+#   uint32 0x184D2A5E, uint32 size of the rest,
+#   count * (uint32 compressed size, uint32 decompressed size),
+#   uint32 count, uint8 descriptor, uint32 0x8F92EAB1
+#
+# so a reader finds every frame from the last bytes of the file and can
+# start decompressing at any of them. Frames written by ZstdWriter end
+# where a write() ends, so they hold whole lines or records.
+#
+# ZstdWriter also puts a skippable frame before the seek table holding
+# the last decompressed byte of every frame, listed in the table as a
+# frame of no data, so that a reader knows whether a frame starts a line
+# without decompressing the one before it.
+#
+# Needs the `zstandard` package, which is only imported when used.
+from __future__ import absolute_import
+import time
+import bisect
+import struct
+import threading
+
+from dpark.codec import BlockWriter
+
+SKIPPABLE_MAGIC = 0x184D2A5E
+LAST_BYTES_MAGIC = 0x184D2A5D
+SEEKABLE_MAGIC = 0x8F92EAB1
+FOOTER = struct.Struct('<IBI')
+FRAME_HEADER = struct.Struct('<II')
+CHECKSUM_FLAG = 0x80
+DEFAULT_FRAME_SIZE = 1 << 20    # uncompressed bytes
+DEFAULT_LEVEL = 3
+
+
+def seek_table(frames):
+    """ the skippable frame holding the seek table of frames,
+        a list of (compressed size, decompressed size) """
+    entries = b''.join(FRAME_HEADER.pack(c, d) for c, d in frames)
+    footer = FOOTER.pack(len(frames), 0, SEEKABLE_MAGIC)
+    return (FRAME_HEADER.pack(SKIPPABLE_MAGIC, len(entries) + len(footer)) +
+            entries + footer)
+
+
+def last_bytes_frame(last_bytes):
+    "the skippable frame holding the last byte of every frame"
+    return FRAME_HEADER.pack(LAST_BYTES_MAGIC, len(last_bytes)) + last_bytes
+
+
+class ZstdWriter(BlockWriter):
+    """ file-like writer of a seekable zstd stream on top of f
+
+        A frame is cut after the write() which fills frame_size, text is
+        written as utf-8. close() writes the seek table but keeps f open.
+    """
+
+    def __init__(self, f, level=DEFAULT_LEVEL, frame_size=DEFAULT_FRAME_SIZE, threads=1):
+        import zstandard
+        BlockWriter.__init__(self, f, frame_size, threads)
+        self.level = level
+        self.frames = []
+        self.last_bytes = []
+        self._zstd = zstandard
+        self._local = threading.local()   # a compressor can not be shared
+
+    def compress_block(self, data):
+        cctx = getattr(self._local, 'cctx', None)
+        if cctx is None:
+            cctx = self._local.cctx = self._zstd.ZstdCompressor(level=self.level)
+        return cctx.compress(data)
+
+    def emit(self, data, frame):
+        self.f.write(frame)
+        self.frames.append((len(frame), len(data)))
+        # an empty frame ends as the one before it, the file starts a line
+        self.last_bytes.append(data[-1:] or (self.last_bytes[-1] if self.last_bytes else b'\n'))
+
+    def finish(self):
+        trailer = last_bytes_frame(b''.join(self.last_bytes))
+        self.f.write(trailer)
+        self.f.write(seek_table(self.frames + [(len(trailer), 0)]))
+
+
+class SeekTable(object):
+    """ (offset, uoffset, compressed size, decompressed size) of every frame,
+        and the last byte of every frame when the file has them """
+
+    def __init__(self, entries, last_bytes=None):
+        self.entries = entries
+        self.offsets = [e[0] for e in entries]
+        self.last_bytes = last_bytes
+
+    @classmethod
+    def load(cls, f, size):
+        """ None if the file of size bytes is not in the seekable format """
+        if size < FOOTER.size:
+            return None
+        f.seek(size - FOOTER.size)
+        count, descriptor, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != SEEKABLE_MAGIC:
+            return None
+        entry_size = 12 if descriptor & CHECKSUM_FLAG else 8
+        table_size = FRAME_HEADER.size + count * entry_size + FOOTER.size
+        if table_size > size:
+            return None
+        f.seek(size - table_size)
+        d = f.read(table_size - FOOTER.size)
+        magic, frame_size = FRAME_HEADER.unpack_from(d)
+        if magic != SKIPPABLE_MAGIC or frame_size != table_size - FRAME_HEADER.size:
+            return None
+
+        entries = []
+        offset = uoffset = 0
+        for i in range(count):
+            c, u = FRAME_HEADER.unpack_from(d, FRAME_HEADER.size + i * entry_size)
+            entries.append((offset, uoffset, c, u))
+            offset += c
+            uoffset += u
+        if offset != size - table_size:
+            return None
+
+        last_bytes = None
+        if entries and entries[-1][3] == 0 and entries[-1][2] == FRAME_HEADER.size + count - 1:
+            f.seek(entries[-1][0])
+            d = f.read(entries[-1][2])
+            magic, n = FRAME_HEADER.unpack_from(d)
+            if magic == LAST_BYTES_MAGIC and n == count - 1:
+                entries.pop()
+                last_bytes = d[FRAME_HEADER.size:]
+        return cls(entries, last_bytes)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def frames_in(self, begin, end):
+        """ indices of the frames starting in [begin, end) """
+        return (bisect.bisect_left(self.offsets, begin),
+                bisect.bisect_left(self.offsets, end))
+
+    def uoffset(self, i):
+        return self.entries[i][1]
+
+    def last_byte(self, i):
+        "the last byte of the data of frame i, None if the file has no last bytes"
+        if self.last_bytes is None:
+            return None
+        return self.last_bytes[i:i + 1]
+
+    def usize(self):
+        if not self.entries:
+            return 0
+        _, uoffset, _, u = self.entries[-1]
+        return uoffset + u
+
+
+class ZstdFrameReader(object):
+    """ file-like reader of the data of frames [first, last) of the
+        seekable zstd file f, one frame is decompressed at a time """
+
+    def __init__(self, f, table, first, last=None, metrics=None):
+        import zstandard
+        self.f = f
+        self.table = table
+        self.next = first
+        self.last = len(table) if last is None else last
+        self.metrics = metrics
+        self.dctx = zstandard.ZstdDecompressor()
+        self._buf = b''
+        if first < self.last:
+            f.seek(table.entries[first][0])
+
+    def read_frame(self, i):
+        offset, _, c, u = self.table.entries[i]
+        if self.f.tell() != offset:
+            self.f.seek(offset)
+        frame = self.f.read(c)
+        if len(frame) != c:
+            raise IOError('unexpected end of zstd frame %d at %d' % (i, offset))
+        if self.metrics is None:
+            return self.dctx.decompress(frame, max_output_size=u)
+        t = time.time()
+        data = self.dctx.decompress(frame, max_output_size=u)
+        self.metrics.decompress_time += time.time() - t
+        self.metrics.bytes_decompressed += len(data)
+        return data
+
+    def read(self, size):
+        while len(self._buf) < size and self.next < self.last:
+            data = self.read_frame(self.next)
+            self._buf = self._buf + data if self._buf else data
+            self.next += 1
+        d, self._buf = self._buf[:size], self._buf[size:]
+        return d
+
+    def unread(self, d):
+        self._buf = d + self._buf